@@ -6,9 +6,10 @@ from psycopg import Error as dbError
 import time
 import os
 import uuid
-from osgeo import gdal
 
 from lidar_processor.dependencies.db import Database
+from lidar_processor.dependencies.storage import gdal_path
+from lidar_processor.dependencies.partition import dem_edition
 from lidar_processor.schemas.config import DBConfig, StorageConfig, LidarConfig
 from lidar_processor.model.state_processing.records_creation import laz_files_creation, dem_files_creation
 from lidar_processor.model.state_processing.download_files import download_files
@@ -28,6 +29,8 @@ def parse_args(arg_list: List[str] | None):
     parser.add_argument("-c", "--config", help="configuration path", default='./config.yaml')
     parser.add_argument("-i", "--id", help="identifier", default=str(uuid.uuid4().hex.upper()))
     parser.add_argument("-r", "--recovery", help="identifier to recover", default=None)
+    parser.add_argument("-d", "--demand", help="only the dem sheets needed by the pending laz files of the config",
+                        action='store_true')
     parser.add_argument("-log", "--loglevel", help="configuration path", default='info')
     args = parser.parse_args(arg_list)
     return args
@@ -72,12 +75,20 @@ def main(arg_list: List[str] | None = None):
     try:
         start = time.time()
         logging.info(f'{__name__} [{id_} {suffix}] Download DEM and create VRT ')
+        # the campaigns are grouped by DEM edition, every edition gets its rows and its vrt
+        editions = {}
+        for c in lidarconfig.campaigns:
+            editions.setdefault(dem_edition(c.dem_year), []).append(c)
+        laz_filenames = {e: [f'{m}_{c.laz_year}_{c.laz_type}.laz' for c in cs for m in lidarconfig.laz_mapsheets]
+                         for e, cs in editions.items()}
         if (recovery_mode is not None):
-            id_, laz_list, dem_list = recovery(db, id_)
+            id_, laz_list, dem_list = recovery(db, id_, sum(laz_filenames.values(), []), sorted(editions.keys()))
             logging.info(f'{__name__} [{id_} {suffix}] {len(dem_list)} new dem files for download.')
         if (recovery_mode is None):
             # enter state 0 (dem_files_creation) return new dem(s) need to download (dem filename, state)
-            dem_list = dem_files_creation(db, lidarconfig.dem_year, id_)
+            dem_list = []
+            for edition, cs in sorted(editions.items()):
+                dem_list += dem_files_creation(db, cs[0].dem_year, id_, laz_filenames[edition] if (args.demand) else None)
             logging.info(f'{__name__} [{id_} {suffix}] {len(dem_list)} new dem files for download.')
         # enter state 1 or -1 , return tuple of list that download successfully,  the first is laz filename and second is dem filename
         download_result = download_files(db, [r[0] for r in dem_list], storageconfig.bucket + '/' + storageconfig.dem_path, 'dem_files')
@@ -89,25 +100,40 @@ def main(arg_list: List[str] | None = None):
         rerun = []
         for s in state:
             result = db.execute_sql('select filename from dem_files where state=%(state)s and \
-                                     filename=ANY(%(filename)s)', {'state': s, 'filename': dem_filenames})
+                                     filename=ANY(%(filename)s) and year=ANY(%(dem_years)s)',
+                                    {'state': s, 'filename': dem_filenames, 'dem_years': sorted(editions.keys())})
             result = [i[0] for i in result]
             rerun += result
             logging.info(f'{__name__} [{id_} {suffix}] state {s} files : {result}')
         if (len(rerun) > 0):
             logging.warning(f'{__name__} [{id_} {suffix}] need recover')
             os.sys.exit(-1)
-        cur = db.conn.cursor()
-        with db.conn.transaction():
-            cur.execute(f"select filename from dem_files where state=1 and \
-                                     identifier like '%{id_.replace('_R', '')}%' for update nowait;")
-            dem_filenames = [i[0] for i in cur.fetchall()]
-            dem_filepaths = [storageconfig.bucket.replace("gs://", "/vsigs/") + '/' + storageconfig.dem_path + '/' + d for d in dem_filenames]
-            vrt_filepath = storageconfig.bucket.replace("gs://", "/vsigs/") + '/' + storageconfig.dem_path + '/' + f'dem_{lidarconfig.dem_year}.vrt'
-            gdal.BuildVRT(vrt_filepath, dem_filepaths)
-            logging.info(f'{__name__} [{id_} {suffix}] exported vrt : {vrt_filepath}')
-            data = [(storageconfig.bucket + '/' + storageconfig.dem_path + '/' + f'dem_{lidarconfig.dem_year}.vrt', d) for d in dem_filenames]
-            statement = 'update dem_files set vrt_path=%s where filename=%s'
-            cur.executemany(statement, data)
+        from osgeo import gdal
+        # the 2017-2020 DEM rows are shared by the jobs of 2017 to 2020 and kept under 2017,
+        # so the query and the vrt go by the edition and not by the dem_year of the config
+        for edition in sorted(editions.keys()):
+            vrt_path = storageconfig.bucket + '/' + storageconfig.dem_path + '/' + f'dem_{edition}.vrt'
+            cur = db.conn.cursor()
+            with db.conn.transaction():
+                if (args.demand):
+                    # the vrt covers every downloaded sheet of the edition, including those of other demand jobs
+                    cur.execute("select filename from dem_files where state=1 and year=%(dem_year)s;",
+                                {'dem_year': edition})
+                else:
+                    cur.execute("select filename from dem_files where state=1 and year=%(dem_year)s and \
+                                 identifier like %(identifier)s for update nowait;",
+                                {'dem_year': edition, 'identifier': f"%{id_.replace('_R', '')}%"})
+                dem_filenames = [i[0] for i in cur.fetchall()]
+                if (len(dem_filenames) == 0):
+                    logging.warning(f'{__name__} [{id_} {suffix}] no downloaded dem files of {edition}')
+                    continue
+                dem_filepaths = [gdal_path(storageconfig.bucket + '/' + storageconfig.dem_path + '/' + d) for d in dem_filenames]
+                vrt_filepath = gdal_path(vrt_path)
+                gdal.BuildVRT(vrt_filepath, dem_filepaths)
+                logging.info(f'{__name__} [{id_} {suffix}] exported vrt : {vrt_filepath}')
+                data = [(vrt_path, d) for d in dem_filenames]
+                statement = 'update dem_files set vrt_path=%s where filename=%s'
+                cur.executemany(statement, data)
         os.sys.exit(0)
     except dbError as e:
         logging.error(f'{__name__} [{id_} {suffix}] {e}')
@@ -0,0 +1,38 @@
+from multiprocessing import cpu_count
+import os
+import logging
+
+
+# 'auto' uses chunk-parallel lazrs when the worker has more than one core for itself
+laz_codecs = ['default', 'lazrs', 'lazrs_parallel', 'auto']
+
+
+def codec_threads(workers: int, reserved: int = 0) -> int:
+    # cores left for each worker once the reserved cores (prefetch threads of the job) are taken,
+    # so that workers * threads never exceeds the allocation
+    cpus = int(os.environ.get('SLURM_CPUS_PER_TASK', cpu_count()))
+    return max(1, (cpus - reserved) // max(1, workers))
+
+
+def laz_backend(codec: str, threads: int):
+    # laspy backend for the codec, None keeps laspy's default selection
+    import laspy
+    if ((codec == 'lazrs_parallel') or ((codec == 'auto') and (threads > 1))):
+        # rayon reads the pool size when lazrs first uses it, which is after the worker process started
+        os.environ['RAYON_NUM_THREADS'] = str(threads)
+        if (laspy.LazBackend.LazrsParallel.is_available()):
+            return laspy.LazBackend.LazrsParallel
+        logging.debug('laz_backend: lazrs parallel not available')
+    if ((codec in ['lazrs', 'lazrs_parallel', 'auto']) and laspy.LazBackend.Lazrs.is_available()):
+        return laspy.LazBackend.Lazrs
+    return None
+
+
+def pdal_reader_threads(codec: str, threads: int) -> int | None:
+    # readers.las decodes with a thread pool since PDAL 2.6, writers.las stays single threaded
+    import pdal
+    if ((codec in ['default', 'lazrs']) or (threads < 2)):
+        return None
+    if ((pdal.info.major, pdal.info.minor) < (2, 6)):
+        return None
+    return threads
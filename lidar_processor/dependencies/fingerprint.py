@@ -0,0 +1,21 @@
+from typing import Any
+import hashlib
+import importlib.util
+import json
+
+
+def code_version(*modules: str) -> str:
+    # hash of the module sources, read without importing them (pdal / laspy stay unloaded)
+    digest = hashlib.sha256()
+    for module in modules:
+        with open(importlib.util.find_spec(module).origin, 'rb') as f:
+            digest.update(f.read())
+    return digest.hexdigest()[:16]
+
+
+def fingerprint(**parts: Any) -> str:
+    """Hash of everything a stage output depends on: input versions, ancillary data, code, options.
+
+    Equal fingerprints mean the stored output would be reproduced, so the stage can be skipped.
+    """
+    return hashlib.sha256(json.dumps(parts, sort_keys=True, default=str).encode()).hexdigest()
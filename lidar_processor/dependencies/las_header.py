@@ -0,0 +1,57 @@
+from typing import Any, Callable, Dict, List, Tuple
+import struct
+
+# LAS 1.4 public header block, the largest one
+header_bytes = 375
+vlr_header_bytes = 54
+# VLRs beyond this are not read (LASzip and CRS VLRs are a few kB)
+max_vlr_bytes = 2**20
+
+# LASF_Projection records: OGC WKT (2112), OGC math transform WKT (2111), GeoKeyDirectory (34735)
+crs_records = [2111, 2112, 34735]
+
+
+def parse_header(data: bytes) -> Dict[str, Any]:
+    if ((len(data) < 227) or (data[:4] != b'LASF')):
+        raise ValueError('not a LAS file')
+    major, minor = struct.unpack_from('<BB', data, 24)
+    header_size, offset_to_points, vlr_count, point_format = struct.unpack_from('<HIIB', data, 94)
+    point_count = struct.unpack_from('<I', data, 107)[0]
+    if (((major, minor) >= (1, 4)) and (len(data) >= 255)):
+        # 64 bit point count, the legacy field is 0 for more than 2**32 points or formats > 5
+        point_count = struct.unpack_from('<Q', data, 247)[0] or point_count
+    max_x, min_x, max_y, min_y, max_z, min_z = struct.unpack_from('<6d', data, 179)
+    return {'las_version': f'{major}.{minor}',
+            # bit 7 (and 6) flag the LASzip compression of the point records
+            'point_format': point_format & 0x3F,
+            'point_count': point_count,
+            'bounds': [min_x, min_y, max_x, max_y],
+            'global_encoding': struct.unpack_from('<H', data, 6)[0],
+            'header_size': header_size,
+            'offset_to_points': offset_to_points,
+            'vlr_count': vlr_count}
+
+
+def parse_vlrs(data: bytes, count: int) -> List[Tuple[str, int]]:
+    # (user id, record id) of the VLRs found in data
+    vlrs, offset = [], 0
+    for i in range(count):
+        if (offset + vlr_header_bytes > len(data)):
+            break
+        user_id, record_id, length = struct.unpack_from('<16sHH', data, offset + 2)
+        vlrs.append((user_id.split(b'\0', 1)[0].decode('ascii', 'replace'), record_id))
+        offset += vlr_header_bytes + length
+    return vlrs
+
+
+def probe(read: Callable[[int, int], bytes]) -> Dict[str, Any]:
+    """Header summary of a LAS / LAZ file from two range reads, read(start, length) returns the bytes.
+
+    Returns point_count, bounds [minx, miny, maxx, maxy], las_version, point_format and has_crs.
+    """
+    header = parse_header(read(0, header_bytes))
+    length = min(header['offset_to_points'] - header['header_size'], max_vlr_bytes)
+    vlrs = parse_vlrs(read(header['header_size'], length), header['vlr_count']) if (length > 0) else []
+    has_crs = any(((user_id == 'LASF_Projection') and (record_id in crs_records)) for user_id, record_id in vlrs)
+    return {'point_count': header['point_count'], 'bounds': header['bounds'], 'las_version': header['las_version'],
+            'point_format': header['point_format'], 'has_crs': has_crs}
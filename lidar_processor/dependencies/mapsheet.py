@@ -0,0 +1,57 @@
+from typing import Dict, List, Tuple
+
+
+# laz map sheets are 1 km tiles named after their lower left corner in L-EST97 (EPSG:3301),
+# {northing km - 6000}{easting km}, e.g. 447696 -> (696000, 6447000)
+tile_size = 1000
+
+
+def mapsheet_grid(mapsheet: int) -> Tuple[int, int]:
+    # (row, col) of the tile in the 1 km grid
+    return (int(mapsheet) // 1000, int(mapsheet) % 1000)
+
+
+def grid_mapsheet(row: int, col: int) -> int:
+    return row * 1000 + col
+
+
+def mapsheet_bounds(mapsheet: int) -> List[float]:
+    row, col = mapsheet_grid(mapsheet)
+    minx, miny = col * tile_size, (6000 + row) * tile_size
+    return [minx, miny, minx + tile_size, miny + tile_size]
+
+
+def point_mapsheet(x: float, y: float) -> int:
+    return grid_mapsheet(int(y // tile_size) - 6000, int(x // tile_size))
+
+
+def hilbert_index(row: int, col: int, order: int = 10) -> int:
+    # position of the cell on a Hilbert curve over a 2**order grid (1024 km covers Estonia)
+    n = 2 ** order
+    x, y, d = col % n, row % n, 0
+    s = n // 2
+    while (s > 0):
+        rx = 1 if ((x & s) > 0) else 0
+        ry = 1 if ((y & s) > 0) else 0
+        d += s * s * ((3 * rx) ^ ry)
+        if (ry == 0):
+            if (rx == 1):
+                x, y = s - 1 - x, s - 1 - y
+            x, y = y, x
+        s //= 2
+    return d
+
+
+def spatial_order(mapsheets: List[int], groups: Dict[int, int] | None = None) -> List[int]:
+    """Indices of mapsheets ordered along a Hilbert curve.
+
+    When groups maps a mapsheet to its DEM 1:10000 sheet (mapsheets_mapping.nr10000), the tiles of a
+    group are kept back-to-back and the groups follow the curve of their first tile.
+    """
+    keys = [hilbert_index(*mapsheet_grid(m)) for m in mapsheets]
+    groups = groups or {}
+    group_keys: Dict[int, int] = {}
+    for i, m in enumerate(mapsheets):
+        g = groups.get(int(m), int(m))
+        group_keys[g] = min(group_keys.get(g, keys[i]), keys[i])
+    return sorted(range(len(mapsheets)), key=lambda i: (group_keys[groups.get(int(mapsheets[i]), int(mapsheets[i]))], keys[i]))
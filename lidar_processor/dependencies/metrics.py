@@ -0,0 +1,125 @@
+from typing import Dict, Tuple
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import os
+import threading
+import time
+import logging
+
+
+class Metrics():
+    """Process-wide counters and gauges of the running batch, rendered in the Prometheus text format.
+
+    Counters end with _total. For every counter a `<name>_per_second` gauge is derived at each export,
+    so a plain file reader gets the rates without a Prometheus server.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters: Dict[Tuple[str, Tuple], float] = {}
+        self.gauges: Dict[Tuple[str, Tuple], float] = {}
+        self.rates: Dict[Tuple[str, Tuple], float] = {}
+        self.last: Tuple[float, Dict[Tuple[str, Tuple], float]] = (time.monotonic(), {})
+
+    def inc(self, name: str, value: float = 1, **labels) -> None:
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set(self, name: str, value: float, **labels) -> None:
+        with self.lock:
+            self.gauges[(name, tuple(sorted(labels.items())))] = value
+
+    def add(self, name: str, value: float, **labels) -> None:
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.gauges[key] = self.gauges.get(key, 0) + value
+
+    def remove(self, name: str, **labels) -> None:
+        # drop gauges matching the labels, e.g. the RSS of finished workers
+        with self.lock:
+            for key in [k for k in self.gauges.keys() if ((k[0] == name) and set(labels.items()) <= set(k[1]))]:
+                del self.gauges[key]
+
+    def update_rates(self) -> None:
+        now = time.monotonic()
+        with self.lock:
+            elapsed = now - self.last[0]
+            if (elapsed > 0):
+                self.rates = {key: (value - self.last[1].get(key, 0)) / elapsed for key, value in self.counters.items()}
+            self.last = (now, dict(self.counters))
+
+    def render(self) -> str:
+        def line(name: str, labels: Tuple, value: float) -> str:
+            label_text = ','.join(f'{k}="{v}"' for k, v in labels)
+            return f'lidar_{name}{{{label_text}}} {value:g}' if (label_text != '') else f'lidar_{name} {value:g}'
+        with self.lock:
+            lines = [line(name, labels, value) for (name, labels), value in sorted(self.counters.items())]
+            lines += [line(name, labels, value) for (name, labels), value in sorted(self.gauges.items())]
+            lines += [line(name.replace('_total', '_per_second'), labels, value) for (name, labels), value in sorted(self.rates.items())]
+        return '\n'.join(lines) + '\n'
+
+
+# instrumented by the stages, exported only when an exporter runs
+registry = Metrics()
+
+
+def process_rss(pid: int) -> int | None:
+    # resident set size in bytes from /proc (Linux)
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            for row in f:
+                if (row.startswith('VmRSS:')):
+                    return int(row.split()[1]) * 1024
+    except OSError:
+        return None
+    return None
+
+
+class MetricsExporter():
+    """Writes the registry every `interval` seconds to a Prometheus textfile (atomic rename) and/or
+    serves it on http://127.0.0.1:<port>/metrics."""
+
+    def __init__(self, path: str | None = None, port: int | None = None, interval: float = 5):
+        self.path = path
+        self.interval = interval
+        self.stop_event = threading.Event()
+        self.server = None
+        if (port is not None):
+            class Handler(BaseHTTPRequestHandler):
+                def do_GET(self):
+                    body = registry.render().encode()
+                    self.send_response(200)
+                    self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                    self.send_header('Content-Length', str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+
+                def log_message(self, format, *args):
+                    pass
+            self.server = ThreadingHTTPServer(('127.0.0.1', port), Handler)
+            threading.Thread(target=self.server.serve_forever, name='metrics_http', daemon=True).start()
+        self.thread = threading.Thread(target=self._loop, name='metrics', daemon=True)
+        self.thread.start()
+        logging.info(f'metrics: exporting to {path or "-"} / port {port or "-"} every {interval} s')
+
+    def write(self) -> None:
+        registry.update_rates()
+        if (self.path is not None):
+            tmp = f'{self.path}.{os.getpid()}.tmp'
+            with open(tmp, 'w') as f:
+                f.write(registry.render())
+            os.replace(tmp, self.path)
+
+    def _loop(self) -> None:
+        while (not self.stop_event.wait(self.interval)):
+            try:
+                self.write()
+            except OSError as e:
+                logging.warning(f'metrics: write failed {e}')
+
+    def close(self) -> None:
+        self.stop_event.set()
+        self.thread.join()
+        self.write()
+        if (self.server is not None):
+            self.server.shutdown()
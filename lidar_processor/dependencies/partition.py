@@ -0,0 +1,48 @@
+from typing import Any, Dict, List, Tuple
+from lidar_processor.dependencies.db import Database
+import logging
+
+# laz_files can be partitioned by year and laz_type, dem_files by year (setup/db_scripts/partitioning.sql).
+# Both keys follow from the filenames, the queries of a batch carry them so Postgres only scans and locks
+# the partitions of the campaign. On unpartitioned tables the predicates are plain column filters.
+
+
+def file_year(filename: str) -> int:
+    # {mapsheet}_{year}_{type}.laz, {mapsheet}_dem_1m_2017-2020.tif, {mapsheet}_dtm_1m_{year}.tif
+    parts = filename.split('.')[0].split('_')
+    return int(parts[1]) if (len(parts) == 3) else int(parts[3][:4])
+
+
+def dem_edition(dem_year: int) -> int:
+    # the 2017-2020 DEM is one product, its rows are kept under 2017
+    return 2017 if (dem_year <= 2020) else dem_year
+
+
+def partition_filter(table: str, filenames: List[str], alias: str | None = None) -> Tuple[str, Dict[str, Any]]:
+    """Predicate restricting `table` to the partitions of filenames and its parameters."""
+    prefix = f'{alias or table}.'
+    data = {'partition_years': sorted({file_year(f) for f in filenames})}
+    if (table != 'laz_files'):
+        return (f'{prefix}year = ANY(%(partition_years)s)', data)
+    data['partition_types'] = sorted({f.split('.')[0].split('_')[2] for f in filenames})
+    return (f'{prefix}year = ANY(%(partition_years)s) and {prefix}laz_type = ANY(%(partition_types)s)', data)
+
+
+def partitioned(db: Database, table: str) -> bool:
+    result = db.execute_sql("select relkind from pg_class where oid = to_regclass(%(table)s)", {'table': table})
+    return (result is not None) and (len(result) > 0) and (result[0][0] == 'p')
+
+
+def ensure_partitions(db: Database, table: str, filenames: List[str]) -> None:
+    # new campaigns get their partitions before the first insert
+    if ((len(filenames) == 0) or (not partitioned(db, table))):
+        return
+    if (table == 'laz_files'):
+        keys = sorted({(file_year(f), f.split('.')[0].split('_')[2]) for f in filenames})
+        for year, laz_type in keys:
+            db.execute_sql('select create_laz_partition(%s, %s)', (year, laz_type))
+    else:
+        keys = sorted({(file_year(f),) for f in filenames})
+        for (year,) in keys:
+            db.execute_sql('select create_dem_partition(%s)', (year,))
+    logging.debug(f'ensure_partitions: {table} {keys}')
@@ -0,0 +1,156 @@
+from typing import Any, Callable, Dict, List, Set, Tuple
+from collections import deque
+from multiprocessing import connection
+import multiprocessing
+import time
+import logging
+from tqdm import tqdm
+
+from lidar_processor.dependencies.retry import backoff_delay, is_transient
+from lidar_processor.dependencies.metrics import registry, process_rss
+
+
+def _task_entry(conn: connection.Connection, fn: Callable, args: Tuple, level: int, formatter: logging.Formatter | None) -> None:
+    # forkserver processes start without the logging setup of the job
+    logging.basicConfig(level=level)
+    if (formatter is not None):
+        logging.getLogger().handlers[0].setFormatter(formatter)
+    try:
+        conn.send(fn(*args))
+    finally:
+        conn.close()
+
+
+class TaskPool():
+    """Process pool running every task in its own process, so a stuck task can be killed.
+    The processes are started by a forkserver, `fn` and the task arguments must be picklable.
+
+    Tasks exceeding `timeout` seconds (or killed, e.g. by the OOM killer) are requeued into a heavy
+    lane that runs after the normal lane with `heavy_workers` processes and `heavy_timeout`, leaving
+    each of them more memory. Tasks failing in the heavy lane too are reported in `timed_out`.
+
+    Tasks returning a transient failure (see retry.failure) are requeued up to `retries` times after
+    an exponential backoff with jitter, without blocking the other tasks.
+
+    `lane_workers` is the process count of the running lane, `prepare` can size the task on it.
+    `on_done` gets the tasks that returned a result, `on_lost` the ones the heavy lane gave up on.
+    """
+
+    def __init__(self, workers: int, timeout: float | None = None, heavy_workers: int = 1, heavy_timeout: float | None = None,
+                 retries: int = 0, backoff: float = 30, backoff_cap: float = 600, name: str = 'task'):
+        self.name = name
+        self.workers = workers
+        self.timeout = timeout
+        self.heavy_workers = heavy_workers
+        self.heavy_timeout = heavy_timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.backoff_cap = backoff_cap
+        self.attempts: Dict[int, int] = {}
+        self.lane_workers = workers
+        # the job runs threads (upload stager, prefetch, metrics) while tasks start, a forked task could
+        # inherit a lock held by one of them, forkserver starts the tasks from a single threaded process
+        self.context = multiprocessing.get_context('forkserver')
+        root = logging.getLogger()
+        self.log = (root.getEffectiveLevel(), root.handlers[0].formatter if (len(root.handlers) > 0) else None)
+        self.timed_out: Set[int] = set()
+        self.crashed: Set[int] = set()
+
+    def _run(self, fn: Callable, params: List[Tuple], queue: deque, workers: int, timeout: float | None,
+             results: List[Any], progress: tqdm, on_done: Callable | None, before_submit: Callable | None,
+             prepare: Callable | None) -> List[int]:
+        running: Dict[int, Tuple[multiprocessing.Process, connection.Connection, float | None]] = {}
+        # (time the retry is due, task) of transient failures waiting for their backoff
+        delayed: List[Tuple[float, int]] = []
+        failed = []
+        self.lane_workers = workers
+        while ((len(queue) > 0) or (len(running) > 0) or (len(delayed) > 0)):
+            for due, i in [d for d in delayed if (d[0] <= time.monotonic())]:
+                delayed.remove((due, i))
+                queue.appendleft(i)
+            while ((len(queue) > 0) and (len(running) < workers)):
+                # prepare returns None while the inputs of the next task are not staged yet
+                args = params[queue[0]] if (prepare is None) else prepare(queue[0], params[queue[0]])
+                if (args is None):
+                    break
+                if (before_submit is not None):
+                    before_submit()
+                i = queue.popleft()
+                recv, send = self.context.Pipe(duplex=False)
+                process = self.context.Process(target=_task_entry, args=(send, fn, args, *self.log))
+                process.start()
+                send.close()
+                running[i] = (process, recv, (time.monotonic() + timeout) if (timeout is not None) else None)
+            registry.set('queue_depth', len(queue) + len(delayed), stage=self.name)
+            registry.set('active_workers', len(running), stage=self.name)
+            if (len(running) == 0):
+                time.sleep(0.5)
+                continue
+            ready = connection.wait([r[1] for r in running.values()], timeout=1)
+            now = time.monotonic()
+            for i, (process, recv, deadline) in list(running.items()):
+                rss = process_rss(process.pid)
+                if (rss is not None):
+                    registry.set('worker_rss_bytes', rss, stage=self.name, task=i)
+                if (recv in ready):
+                    try:
+                        results[i] = recv.recv()
+                    except EOFError:
+                        # the process died without a result (segfault, OOM killer)
+                        process.join()
+                        logging.warning(f'task_pool: task {i} exited with code {process.exitcode}')
+                        failed.append(i)
+                        self.crashed.add(i)
+                        registry.inc('failures_total', stage=self.name, reason='crash')
+                    else:
+                        process.join()
+                        attempt = self.attempts.get(i, 0)
+                        if (is_transient(results[i]) and (attempt < self.retries)):
+                            delay = backoff_delay(attempt, self.backoff, self.backoff_cap)
+                            logging.warning(f'task_pool: task {i} transient failure, retry {attempt + 1}/{self.retries} in {delay:.0f} s')
+                            self.attempts[i] = attempt + 1
+                            delayed.append((now + delay, i))
+                            registry.inc('retries_total', stage=self.name)
+                            registry.remove('worker_rss_bytes', stage=self.name, task=i)
+                            recv.close()
+                            del running[i]
+                            continue
+                        progress.update()
+                        if ((results[i] is not None) and (results[i][0] > 0)):
+                            registry.inc('tiles_total', stage=self.name)
+                        else:
+                            registry.inc('failures_total', stage=self.name, reason='failed')
+                        if (on_done is not None):
+                            on_done(i, results[i])
+                elif ((deadline is not None) and (now > deadline)):
+                    logging.warning(f'task_pool: task {i} timed out after {timeout} s, killed')
+                    process.kill()
+                    process.join()
+                    failed.append(i)
+                    self.timed_out.add(i)
+                    registry.inc('failures_total', stage=self.name, reason='timeout')
+                else:
+                    continue
+                registry.remove('worker_rss_bytes', stage=self.name, task=i)
+                recv.close()
+                del running[i]
+        return failed
+
+    def map(self, fn: Callable, params: List[Tuple], on_done: Callable | None = None,
+            before_submit: Callable | None = None, prepare: Callable | None = None,
+            on_lost: Callable | None = None) -> List[Any | None]:
+        """Run fn(*params[i]) for all params, results are in order, None for tasks that never returned."""
+        results: List[Any | None] = [None] * len(params)
+        self.timed_out, self.crashed, self.attempts = set(), set(), {}
+        with tqdm(total=len(params)) as progress:
+            heavy = self._run(fn, params, deque(range(len(params))), self.workers, self.timeout,
+                              results, progress, on_done, before_submit, prepare)
+            if (len(heavy) > 0):
+                logging.info(f'task_pool: {len(heavy)} tasks requeued to the heavy lane ({self.heavy_workers} workers)')
+                self.timed_out, self.crashed = set(), set()
+                lost = self._run(fn, params, deque(heavy), self.heavy_workers, self.heavy_timeout,
+                                 results, progress, on_done, before_submit, prepare)
+                for i in lost:
+                    if (on_lost is not None):
+                        on_lost(i)
+        return results
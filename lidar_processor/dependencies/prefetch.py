@@ -0,0 +1,195 @@
+from typing import Dict, List, Tuple
+from concurrent.futures import Future, ThreadPoolExecutor
+from functools import partial
+import os
+import shutil
+import tempfile
+import threading
+import logging
+
+from lidar_processor.dependencies.storage import gdal_path
+
+# ETAK layers used by the overlays of the reclassification pipeline
+etak_layers = ['E_201_meri_a', 'E_601_elektriliin_j', 'E_202_seisuveekogu_a', 'E_203_vooluveekogu_a',
+               'E_401_hoone_ka', 'E_403_muu_rajatis_ka']
+
+
+# reserved for an ETAK subset until the first one is staged
+etak_bytes = 64 * 2**20
+
+
+def raster_info(src: str) -> Tuple[float, float, int]:
+    # pixel size and bytes per pixel (all bands) of the source, the window is staged uncompressed
+    from osgeo import gdal
+    gdal.UseExceptions()
+    ds = gdal.Open(gdal_path(src))
+    transform = ds.GetGeoTransform()
+    band = ds.GetRasterBand(1)
+    return (abs(transform[1]), abs(transform[5]), ds.RasterCount * gdal.GetDataTypeSize(band.DataType) // 8)
+
+
+def fetch_raster(src: str, dst: str, bounds: List[float]) -> str:
+    from osgeo import gdal
+    gdal.UseExceptions()
+    # decoded once: uncompressed and tiled, filters.hag_dem of every worker reads the blocks it needs
+    gdal.Translate(dst, gdal_path(src), projWin=[bounds[0], bounds[3], bounds[2], bounds[1]], format='GTiff',
+                   creationOptions=['TILED=YES', 'BLOCKXSIZE=256', 'BLOCKYSIZE=256'])
+    return dst
+
+
+def clean_stale(scratch_path: str) -> None:
+    # folders left by killed jobs of the node (tmpfs keeps them until reboot), the pid is in the folder name
+    for name in os.listdir(scratch_path) if (os.path.isdir(scratch_path)) else []:
+        parts = name.split('_')
+        if ((not name.startswith('lidar_prefetch_')) or (len(parts) < 4) or (not parts[2].isdigit())):
+            continue
+        try:
+            os.kill(int(parts[2]), 0)
+        except ProcessLookupError:
+            logging.info(f'prefetch: removing stale {name}')
+            shutil.rmtree(os.path.join(scratch_path, name), ignore_errors=True)
+        except PermissionError:
+            # a job of another user
+            pass
+
+
+def fetch_etak(src: str, dst: str, bounds: List[float]) -> str:
+    from osgeo import gdal
+    gdal.UseExceptions()
+    gdal.VectorTranslate(dst, gdal_path(src), format='GPKG', layers=etak_layers, spatFilter=bounds)
+    return dst
+
+
+class AncillaryPrefetcher():
+    """Stages DEM / NDVI windows and ETAK subsets of the next queued tiles on local disk or in shared memory.
+
+    `prepare` is called by the task pool before it dispatches task i: it requests the ancillary data of
+    tasks i .. i + lookahead and returns the task parameters pointing to local copies once they are
+    ready (None until then). `release` is called when task i is finished.
+
+    A copy is keyed by its source and window and counts the queued tasks using it: the DEM / NDVI window
+    of a 1:10000 DEM sheet (`windows`) is decoded once for all its tiles, whichever worker runs them, and
+    removed when no queued task needs it any more.
+
+    `max_bytes` bounds the staged and the running fetches: a fetch reserves its estimated size when it is
+    submitted (window pixels of the raster, largest ETAK subset so far) and settles on the real size.
+    """
+
+    def __init__(self, tiles: List[Tuple[List[float], str, str, str]], scratch_path: str | None = None,
+                 lookahead: int = 8, max_bytes: int = 10 * 2**30, workers: int = 2, buffer: float = 50,
+                 windows: List[List[float]] | None = None):
+        # tiles: (bounds, dem, etak, ndvi) of every task in queue order, windows: raster window of every task
+        # (the tile bounds by default)
+        self.tiles = tiles
+        self.windows = windows or [t[0] for t in tiles]
+        self.lookahead = lookahead
+        self.max_bytes = max_bytes
+        self.buffer = buffer
+        scratch_path = scratch_path or os.environ.get('TMPDIR') or tempfile.gettempdir()
+        clean_stale(scratch_path)
+        self.scratch = tempfile.mkdtemp(prefix=f'lidar_prefetch_{os.getpid()}_', dir=scratch_path)
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='prefetch')
+        self.fetches: Dict[int, List[Tuple]] = {}
+        self.files: Dict[Tuple, Future] = {}
+        self.refs: Dict[Tuple, int] = {}
+        # bytes counted in used_bytes for every key: reserved while running, file size once staged
+        self.sizes: Dict[Tuple, int] = {}
+        self.sources: Dict[str, Tuple[float, float, int] | None] = {}
+        self.etak_bytes = etak_bytes
+        for i in range(len(tiles)):
+            for key in self.keys(i):
+                self.refs[key] = self.refs.get(key, 0) + 1
+        self.count = 0
+        self.used_bytes = 0
+        self.lock = threading.Lock()
+
+    def keys(self, i: int) -> List[Tuple]:
+        def buffered(bounds: List[float]) -> Tuple:
+            return (bounds[0] - self.buffer, bounds[1] - self.buffer, bounds[2] + self.buffer, bounds[3] + self.buffer)
+        bounds, dem, etak, ndvi = self.tiles[i]
+        return [('dem', dem, buffered(self.windows[i])), ('etak', etak, buffered(bounds)), ('ndvi', ndvi, buffered(self.windows[i]))]
+
+    def estimate(self, key: Tuple) -> int:
+        kind, src, bounds = key
+        if (kind == 'etak'):
+            return self.etak_bytes
+        if (src not in self.sources):
+            try:
+                self.sources[src] = raster_info(src)
+            except Exception as e:
+                logging.debug(f'prefetch: {src} size unknown: {e}')
+                self.sources[src] = None
+        info = self.sources[src]
+        if (info is None):
+            return 0
+        return int((bounds[2] - bounds[0]) / info[0] * (bounds[3] - bounds[1]) / info[1] * info[2])
+
+    def _fetch(self, key: Tuple, dst: str) -> str:
+        kind, src, bounds = key
+        try:
+            result = fetch_etak(src, dst, list(bounds)) if (kind == 'etak') else fetch_raster(src, dst, list(bounds))
+        except Exception:
+            with self.lock:
+                self.used_bytes -= self.sizes.get(key, 0)
+                self.sizes[key] = 0
+            raise
+        size = os.path.getsize(result)
+        with self.lock:
+            self.used_bytes += size - self.sizes.get(key, 0)
+            self.sizes[key] = size
+            if (kind == 'etak'):
+                self.etak_bytes = max(self.etak_bytes, size)
+        return result
+
+    def request(self, i: int) -> None:
+        if ((i >= len(self.tiles)) or (i in self.fetches)):
+            return
+        keys = self.keys(i)
+        for key in keys:
+            if (key not in self.files):
+                self.count += 1
+                dst = os.path.join(self.scratch, f'{self.count}_{key[0]}.' + ('gpkg' if (key[0] == 'etak') else 'tif'))
+                reserved = self.estimate(key)
+                with self.lock:
+                    self.used_bytes += reserved
+                    self.sizes[key] = reserved
+                self.files[key] = self.executor.submit(self._fetch, key, dst)
+        self.fetches[i] = keys
+
+    def prepare(self, i: int, params: Tuple) -> Tuple | None:
+        self.request(i)
+        for j in range(i + 1, i + 1 + self.lookahead):
+            if (self.used_bytes >= self.max_bytes):
+                break
+            self.request(j)
+        files = [self.files[key] for key in self.fetches[i]]
+        if (not all(f.done() for f in files)):
+            return None
+        try:
+            dem, etak, ndvi = [f.result() for f in files]
+        except Exception as e:
+            # the task falls back to the remote files
+            logging.warning(f'prefetch: tile {i} failed, using remote data: {e}')
+            return params
+        return (params[0], params[1], dem, etak, ndvi, *params[5:])
+
+    def _evict(self, key: Tuple, fetch: Future) -> None:
+        with self.lock:
+            self.used_bytes -= self.sizes.pop(key, 0)
+        if ((not fetch.cancelled()) and (fetch.exception() is None) and os.path.exists(fetch.result())):
+            os.remove(fetch.result())
+
+    def release(self, i: int) -> None:
+        # called for finished tasks and for the tasks the pool gave up on (timeout / crash in the heavy lane)
+        for key in self.keys(i):
+            self.refs[key] -= 1
+            fetch = self.files.get(key)
+            if ((self.refs[key] > 0) or (fetch is None)):
+                continue
+            # evicted, no queued task needs the window; a running fetch is removed once it completes
+            del self.files[key]
+            fetch.add_done_callback(partial(self._evict, key))
+
+    def close(self) -> None:
+        self.executor.shutdown(wait=True, cancel_futures=True)
+        shutil.rmtree(self.scratch, ignore_errors=True)
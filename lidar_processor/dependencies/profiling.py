@@ -0,0 +1,156 @@
+from typing import Any, Callable, Dict, List, Set
+from collections import Counter
+import json
+import os
+import resource
+import signal
+import time
+import logging
+
+
+# values recorded by the processing scripts while a profiled task runs (None when not profiling)
+_records: Dict[str, Any] | None = None
+
+
+def active() -> bool:
+    return _records is not None
+
+
+def record(key: str, value: Any) -> None:
+    if (_records is not None):
+        _records[key] = value
+
+
+class SamplingProfiler():
+    """Samples the Python stack on CPU time (ITIMER_PROF). Stacks are kept collapsed (flamegraph.pl format).
+
+    Python runs the handler on the main thread between bytecodes: the signals raised during a long PDAL /
+    GDAL / LAZ call collapse into one sample, so the counts only rank the Python code. The time of the
+    native stages comes from the timed sections the scripts record (decode_s, execute_s, ...).
+    """
+
+    def __init__(self, interval: float = 0.005):
+        self.interval = interval
+        self.samples: Counter = Counter()
+
+    def _sample(self, signum, frame) -> None:
+        stack = []
+        while (frame is not None):
+            stack.append(f'{os.path.basename(frame.f_code.co_filename)}:{frame.f_code.co_name}')
+            frame = frame.f_back
+        self.samples[';'.join(reversed(stack))] += 1
+
+    def start(self) -> None:
+        signal.signal(signal.SIGPROF, self._sample)
+        # restart the system calls (reads, waits) the timer interrupts instead of failing them with EINTR
+        signal.siginterrupt(signal.SIGPROF, False)
+        signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+
+    def stop(self) -> None:
+        signal.setitimer(signal.ITIMER_PROF, 0)
+        signal.signal(signal.SIGPROF, signal.SIG_DFL)
+
+    def top(self, n: int = 30) -> List[List]:
+        # functions with the most samples at the top of the stack, a count and not a duration (see above)
+        leaves: Counter = Counter()
+        for stack, count in self.samples.items():
+            leaves[stack.rsplit(';', 1)[-1]] += count
+        return [[f, c] for f, c in leaves.most_common(n)]
+
+
+def gdal_network_stats(reset: bool = False) -> Dict | None:
+    # bytes and requests of the GDAL virtual file systems (/vsigs/, /vsicurl/), GDAL >= 3.7
+    try:
+        from osgeo import gdal
+    except ImportError:
+        return None
+    if (not hasattr(gdal, 'NetworkStatsGetAsSerializedJSON')):
+        return None
+    if (reset):
+        gdal.SetConfigOption('CPL_VSIL_NETWORK_STATS_ENABLED', 'YES')
+        gdal.NetworkStatsReset()
+        return None
+    return json.loads(gdal.NetworkStatsGetAsSerializedJSON() or '{}')
+
+
+def profiled(fn: Callable, profile_dir: str, tiles: Set[str], *args) -> Any:
+    """Run fn(*args) in the worker, with profiling when the tile of args[0] is in tiles.
+
+    Writes <profile_dir>/<tile>.json (timings, top functions, records of the script, GDAL network stats)
+    and <tile>.folded (collapsed stacks).
+    """
+    global _records
+    tile = os.path.basename(args[0]).split('.')[0]
+    if (tile not in tiles):
+        return fn(*args)
+    _records = {}
+    profiler = SamplingProfiler()
+    gdal_network_stats(reset=True)
+    start, usage = time.perf_counter(), resource.getrusage(resource.RUSAGE_SELF)
+    profiler.start()
+    try:
+        return fn(*args)
+    finally:
+        profiler.stop()
+        end_usage = resource.getrusage(resource.RUSAGE_SELF)
+        artifact = {'tile': tile, 'function': f'{fn.__module__}.{fn.__name__}',
+                    'wall_s': time.perf_counter() - start,
+                    'cpu_s': (end_usage.ru_utime - usage.ru_utime) + (end_usage.ru_stime - usage.ru_stime),
+                    'max_rss_mb': end_usage.ru_maxrss / 1024,
+                    'python_samples': profiler.top(),
+                    'gdal_network': gdal_network_stats(),
+                    'records': _records}
+        _records = None
+        try:
+            os.makedirs(profile_dir, exist_ok=True)
+            with open(os.path.join(profile_dir, f'{tile}.json'), 'w') as f:
+                json.dump(artifact, f, indent=2, default=str)
+            with open(os.path.join(profile_dir, f'{tile}.folded'), 'w') as f:
+                f.writelines(f'{stack} {count}\n' for stack, count in profiler.samples.items())
+        except OSError as e:
+            logging.warning(f'profiled: writing the profile of {tile} failed {e}')
+
+
+def profile_tiles(filenames: List[str], count: int) -> Set[str]:
+    # tiles spread evenly over the queue
+    if (count <= 0):
+        return set()
+    step = max(1, len(filenames) // count)
+    return {os.path.basename(f).split('.')[0] for f in filenames[::step][:count]}
+
+
+def summarize(profile_dir: str) -> Dict | None:
+    """Merge the per-tile profiles of profile_dir into summary.json."""
+    profiles = []
+    for name in sorted(os.listdir(profile_dir)) if (os.path.isdir(profile_dir)) else []:
+        if (name.endswith('.json') and (name != 'summary.json')):
+            with open(os.path.join(profile_dir, name)) as f:
+                profiles.append(json.load(f))
+    if (len(profiles) == 0):
+        return None
+    summary: Dict[str, Any] = {}
+    for function in sorted({p['function'] for p in profiles}):
+        group = [p for p in profiles if (p['function'] == function)]
+        top: Counter = Counter()
+        timed: Counter = Counter()
+        for p in group:
+            for f, count in p['python_samples']:
+                top[f] += count
+            # the timed sections hold the native time the samples can not see
+            for key, value in (p['records'] or {}).items():
+                if (key.endswith('_s') and isinstance(value, (int, float))):
+                    timed[key] += value
+        network = [p['gdal_network'] for p in group if (p['gdal_network'] is not None)]
+        summary[function] = {'tiles': len(group),
+                             'wall_s': sum(p['wall_s'] for p in group),
+                             'cpu_s': sum(p['cpu_s'] for p in group),
+                             'max_rss_mb': max(p['max_rss_mb'] for p in group),
+                             'timed_s': dict(timed),
+                             'python_samples': top.most_common(30),
+                             'gdal_network': network}
+    with open(os.path.join(profile_dir, 'summary.json'), 'w') as f:
+        json.dump(summary, f, indent=2, default=str)
+    for function, s in summary.items():
+        logging.info(f'profile: {function}: {s["tiles"]} tiles, wall {s["wall_s"]:.1f} s, cpu {s["cpu_s"]:.1f} s, '
+                     f'{", ".join(f"{k} {v:.1f}" for k, v in s["timed_s"].items())}')
+    return summary
@@ -0,0 +1,72 @@
+from typing import Callable, Tuple
+import random
+import re
+import time
+import logging
+
+# HTTP status codes worth retrying (timeouts, throttling, server side errors)
+transient_status = [408, 429, 500, 502, 503, 504]
+
+# parts of GDAL / PDAL / gcsfs messages of network failures, they only raise RuntimeError / OSError
+transient_messages = ['http error', 'http response code', 'curl error', 'connection reset', 'connection aborted',
+                      'connection refused', 'timed out', 'timeout', 'temporarily unavailable', 'service unavailable',
+                      'too many requests', 'broken pipe', 'remote end closed']
+permanent_messages = ['no such file', 'does not exist', 'not recognized', 'not found', 'permission denied']
+# status code in the messages ('HTTP error code: 503', 'HTTP response code: 404'), the text also holds tile
+# paths whose map sheet numbers may contain any three digits
+status_pattern = re.compile(r'\b(?:http|response)\b[\w ]*?\bcode\s*[:=]?\s*(\d{3})\b')
+permanent_pattern = re.compile(r'\b(?:' + '|'.join(re.escape(m) for m in permanent_messages) + r')\b')
+
+
+def transient_error(e: BaseException) -> bool:
+    """True for failures that may pass when retried: network, 5xx / 429, GDAL virtual file system read errors."""
+    if (isinstance(e, (ConnectionError, TimeoutError))):
+        return True
+    try:
+        import urllib3
+        if (isinstance(e, (urllib3.exceptions.ProtocolError, urllib3.exceptions.TimeoutError, urllib3.exceptions.MaxRetryError))):
+            return True
+    except ImportError:
+        pass
+    # gcsfs HttpError, google api errors
+    status = getattr(e, 'code', None) or getattr(e, 'status', None)
+    if (isinstance(status, int) and (100 <= status < 600)):
+        return status in transient_status
+    message = str(e).lower()
+    match = status_pattern.search(message)
+    if (match is not None):
+        return int(match.group(1)) in transient_status
+    if (permanent_pattern.search(message) is not None):
+        return False
+    if (('/vsigs/' in message) or ('/vsis3/' in message) or ('/vsicurl/' in message)):
+        # read errors of remote rasters / vectors
+        return True
+    return any(m in message for m in transient_messages)
+
+
+def failure(state: int, e: BaseException, *extra) -> Tuple:
+    # result of a failed task, the last element tells whether a retry may help
+    from datetime import datetime, timezone
+    return (state, datetime.now(timezone.utc), *extra, transient_error(e))
+
+
+def is_transient(result: Tuple | None) -> bool:
+    return (result is not None) and (result[0] < 0) and (result[-1] is True)
+
+
+def backoff_delay(attempt: int, backoff: float, cap: float) -> float:
+    # exponential backoff with jitter, retries of many workers do not hit the service together
+    delay = min(cap, backoff * 2 ** attempt)
+    return random.uniform(delay / 2, delay)
+
+
+def retry_call(fn: Callable, args: Tuple, retries: int, backoff: float, cap: float = 600) -> Tuple:
+    result = fn(*args)
+    for attempt in range(retries):
+        if (not is_transient(result)):
+            break
+        delay = backoff_delay(attempt, backoff, cap)
+        logging.warning(f'retry_call: transient failure, retry {attempt + 1}/{retries} in {delay:.0f} s')
+        time.sleep(delay)
+        result = fn(*args)
+    return result
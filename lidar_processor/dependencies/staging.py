@@ -0,0 +1,105 @@
+from typing import Callable, Dict, List, Tuple
+from concurrent.futures import Future, ThreadPoolExecutor
+import os
+import shutil
+import tempfile
+import threading
+import time
+import logging
+
+from lidar_processor.dependencies.storage import get_storage
+from lidar_processor.dependencies.pool import TaskPool
+from lidar_processor.dependencies.metrics import registry
+
+
+class UploadStager():
+    """Outputs are written to node-local scratch and uploaded in the background.
+
+    Scratch usage is bounded by `max_bytes`: compute tasks are only dispatched while the
+    files waiting for upload fit in the budget.
+    """
+
+    def __init__(self, scratch_path: str | None = None, workers: int = 4, max_bytes: int = 50 * 2**30, retries: int = 3):
+        scratch_path = scratch_path or os.environ.get('TMPDIR') or tempfile.gettempdir()
+        os.makedirs(scratch_path, exist_ok=True)
+        self.scratch = tempfile.mkdtemp(prefix='lidar_staging_', dir=scratch_path)
+        self.max_bytes = max_bytes
+        self.retries = retries
+        self.pending_bytes = 0
+        self.condition = threading.Condition()
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='uploader')
+        self.uploads: Dict[str, Future] = {}
+
+    def local_path(self, target: str) -> str:
+        return os.path.join(self.scratch, target.split('/')[-1])
+
+    def wait_capacity(self) -> None:
+        with self.condition:
+            while (self.pending_bytes >= self.max_bytes):
+                self.condition.wait()
+
+    def _upload(self, local_path: str, target: str, size: int) -> bool:
+        try:
+            for attempt in range(self.retries + 1):
+                try:
+                    get_storage(target).put_file(local_path, target)
+                    registry.inc('upload_bytes_total', size)
+                    return True
+                except Exception as e:
+                    logging.warning(f'upload: {target.split("/")[-1]} attempt {attempt + 1} failed: {e}')
+                    if (attempt < self.retries):
+                        time.sleep(2 ** attempt)
+            logging.error(f'upload: {target} failed after {self.retries + 1} attempts')
+            return False
+        finally:
+            os.remove(local_path)
+            with self.condition:
+                self.pending_bytes -= size
+                registry.set('upload_pending_bytes', self.pending_bytes)
+                self.condition.notify_all()
+
+    def submit(self, local_path: str, target: str) -> Future:
+        size = os.path.getsize(local_path)
+        with self.condition:
+            self.pending_bytes += size
+            registry.set('upload_pending_bytes', self.pending_bytes)
+        future = self.executor.submit(self._upload, local_path, target, size)
+        self.uploads[target] = future
+        return future
+
+    def discard(self, local_path: str) -> None:
+        if (os.path.exists(local_path)):
+            os.remove(local_path)
+
+    def map(self, pool: TaskPool, fn: Callable, params: List[Tuple], outputs: List[List[Tuple[str, str]]],
+            prepare: Callable | None = None, on_done: Callable | None = None,
+            on_lost: Callable | None = None) -> List[Tuple | None]:
+        """Run fn(*params[i]) on pool, upload the (local path, target) pairs of outputs[i] once the task succeeds.
+
+        Returns the task results in order. A task whose uploads are not all confirmed gets its state negated.
+        prepare / on_done / on_lost are passed on to the pool.
+        """
+        def upload(i: int, result: Tuple) -> None:
+            for local_path, target in outputs[i]:
+                if ((result[0] > 0) and os.path.exists(local_path)):
+                    self.submit(local_path, target)
+                else:
+                    self.discard(local_path)
+            if (on_done is not None):
+                on_done(i, result)
+
+        results = pool.map(fn, params, on_done=upload, before_submit=self.wait_capacity, prepare=prepare, on_lost=on_lost)
+        # the state only advances after the uploads are confirmed
+        for i, result in enumerate(results):
+            if (result is None):
+                for local_path, target in outputs[i]:
+                    self.discard(local_path)
+                continue
+            uploads = [self.uploads.get(target) for local_path, target in outputs[i]]
+            if ((result[0] > 0) and any(((u is None) or (not u.result())) for u in uploads)):
+                results[i] = (-result[0], *result[1:])
+        return results
+
+    def close(self) -> None:
+        self.executor.shutdown(wait=True)
+        shutil.rmtree(self.scratch, ignore_errors=True)
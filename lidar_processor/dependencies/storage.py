@@ -0,0 +1,175 @@
+from typing import Dict, List, Tuple
+from concurrent.futures import ThreadPoolExecutor
+import os
+import shutil
+import logging
+
+
+# map the object storage scheme to the GDAL virtual file system prefix
+gdal_prefix = {'gs://': '/vsigs/', 's3://': '/vsis3/'}
+
+
+def gdal_path(path: str) -> str:
+    for scheme, prefix in gdal_prefix.items():
+        if (path.startswith(scheme)):
+            return path.replace(scheme, prefix, 1)
+    return path
+
+
+def sibling_path(path: str, suffix: str) -> str:
+    # product written next to a file, e.g. x_reclassified.laz -> x_reclassified_metrics.tif
+    return path.rsplit('.', 1)[0] + suffix
+
+
+class Storage():
+    """Common interface of the storage backends, paths are always full paths (gs://bucket/..., /scratch/...)."""
+
+    def open(self, path: str, mode: str = 'rb'):
+        raise NotImplementedError
+
+    def exists(self, paths: List[str]) -> List[bool]:
+        return [s is not None for s in self.sizes(paths)]
+
+    def sizes(self, paths: List[str]) -> List[int | None]:
+        raise NotImplementedError
+
+    def versions(self, paths: List[str]) -> List[str | None]:
+        # identifier of the object content (generation / etag), changes whenever the object is rewritten
+        raise NotImplementedError
+
+    def read_range(self, path: str, start: int, length: int) -> bytes:
+        raise NotImplementedError
+
+    def get_file(self, path: str, local_path: str) -> None:
+        raise NotImplementedError
+
+    def put_file(self, local_path: str, path: str) -> None:
+        raise NotImplementedError
+
+    def copy(self, src: str, dst: str) -> None:
+        raise NotImplementedError
+
+    def remove(self, path: str) -> None:
+        raise NotImplementedError
+
+    def gdal_path(self, path: str) -> str:
+        return gdal_path(path)
+
+
+class LocalStorage(Storage):
+    """POSIX filesystem (local disk, NFS, Lustre scratch)."""
+
+    def open(self, path: str, mode: str = 'rb'):
+        if ('w' in mode):
+            os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        return open(path, mode)
+
+    def sizes(self, paths: List[str]) -> List[int | None]:
+        result = []
+        for p in paths:
+            try:
+                result.append(os.stat(p).st_size)
+            except FileNotFoundError:
+                result.append(None)
+        return result
+
+    def versions(self, paths: List[str]) -> List[str | None]:
+        result = []
+        for p in paths:
+            try:
+                stat = os.stat(p)
+                result.append(f'{stat.st_size}-{stat.st_mtime_ns}')
+            except FileNotFoundError:
+                result.append(None)
+        return result
+
+    def read_range(self, path: str, start: int, length: int) -> bytes:
+        with open(path, 'rb') as f:
+            f.seek(start)
+            return f.read(length)
+
+    def get_file(self, path: str, local_path: str) -> None:
+        shutil.copyfile(path, local_path)
+
+    def put_file(self, local_path: str, path: str) -> None:
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        shutil.copyfile(local_path, path)
+
+    def copy(self, src: str, dst: str) -> None:
+        self.put_file(src, dst)
+
+    def remove(self, path: str) -> None:
+        if (os.path.exists(path)):
+            os.remove(path)
+
+
+class GCSStorage(Storage):
+    """Google Cloud Storage through gcsfs, one filesystem client per process."""
+
+    # streaming block size for reads and resumable uploads
+    block_size = 16 * 2**20
+    # concurrent metadata requests of sizes / versions
+    info_threads = 16
+
+    def __init__(self):
+        import gcsfs
+        self.fs = gcsfs.GCSFileSystem()
+
+    def open(self, path: str, mode: str = 'rb'):
+        return self.fs.open(path, mode, block_size=self.block_size)
+
+    def _info(self, path: str) -> Dict | None:
+        try:
+            info = self.fs.info(path, refresh=True)
+            return info if (info['type'] == 'file') else None
+        except FileNotFoundError:
+            return None
+
+    def _details(self, paths: List[str]) -> List[Dict | None]:
+        # one metadata request per object of the batch, a campaign folder holds far more objects than a batch
+        if (len(paths) <= 1):
+            return [self._info(p) for p in paths]
+        with ThreadPoolExecutor(min(self.info_threads, len(paths))) as executor:
+            return list(executor.map(self._info, paths))
+
+    def sizes(self, paths: List[str]) -> List[int | None]:
+        return [int(d['size']) if (d is not None) else None for d in self._details(paths)]
+
+    def versions(self, paths: List[str]) -> List[str | None]:
+        return [str(d.get('generation') or d.get('etag')) if (d is not None) else None for d in self._details(paths)]
+
+    def read_range(self, path: str, start: int, length: int) -> bytes:
+        # one ranged GET, open() would fetch a whole block
+        return self.fs.cat_file(path, start=start, end=start + length)
+
+    def get_file(self, path: str, local_path: str) -> None:
+        self.fs.get_file(path, local_path)
+
+    def put_file(self, local_path: str, path: str) -> None:
+        self.fs.put_file(local_path, path)
+
+    def copy(self, src: str, dst: str) -> None:
+        # object rewrite, the data does not leave the storage
+        if (src.startswith('gs://')):
+            self.fs.copy(src, dst)
+        else:
+            self.put_file(src, dst)
+
+    def remove(self, path: str) -> None:
+        if (self.fs.exists(path)):
+            self.fs.rm(path)
+
+
+backends = {'gs://': GCSStorage}
+
+# clients are kept per process, forked pool workers must not reuse the parent's connections
+_pool: Dict[Tuple[int, str], Storage] = {}
+
+
+def get_storage(path: str) -> Storage:
+    scheme = next((s for s in backends.keys() if (path.startswith(s))), '')
+    key = (os.getpid(), scheme)
+    if (key not in _pool):
+        logging.debug(f'get_storage: new {scheme or "local"} client in process {key[0]}')
+        _pool[key] = backends[scheme]() if (scheme != '') else LocalStorage()
+    return _pool[key]
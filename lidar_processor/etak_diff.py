@@ -0,0 +1,213 @@
+import yaml
+import argparse
+import logging
+import hashlib
+import os
+import uuid
+from typing import Dict, List, Set, Tuple
+from psycopg import Error as dbError
+
+from lidar_processor.dependencies.db import Database
+from lidar_processor.dependencies.storage import gdal_path
+from lidar_processor.dependencies.mapsheet import mapsheet_bounds, point_mapsheet, tile_size
+from lidar_processor.dependencies.prefetch import etak_layers
+from lidar_processor.dependencies.partition import partition_filter, dem_edition
+from lidar_processor.schemas.config import DBConfig, StorageConfig, LidarConfig, ProcessingConfig, Campaign
+from lidar_processor.model.state_processing.reclassify import etak_mapping, etak_filename, ndvi_mapping, reclassify_fingerprints
+
+
+loglevel = {'info': logging.INFO,
+            'debug': logging.DEBUG,
+            'error': logging.ERROR,
+            'warning': logging.WARNING}
+
+# attribute read by the overlay of each layer, a change of it changes the overlay too
+layer_columns = {'E_201_meri_a': 'kood', 'E_601_elektriliin_j': 'nimipinge', 'E_202_seisuveekogu_a': 'kood',
+                 'E_203_vooluveekogu_a': 'kood', 'E_401_hoone_ka': 'kood', 'E_403_muu_rajatis_ka': 'kood'}
+
+# powerlines only count when overhead high voltage, with the 13 m buffer of the pipeline
+powerline_voltages = [110, 220, 330]
+powerline_buffer = 13
+
+
+def parse_args(arg_list: List[str] | None):
+    parser = argparse.ArgumentParser(description='Queue for reclassification only the tiles whose ETAK overlays differ between two editions.')
+    parser.add_argument("-c", "--config", help="configuration path", default='./config.yaml')
+    parser.add_argument("-i", "--id", help="identifier of the queued tiles", default=str(uuid.uuid4().hex.upper()))
+    parser.add_argument("--old", help="current ETAK folder (default: the etak_edition or the edition of laz_year of each campaign)", default=None)
+    parser.add_argument("--new", help="new ETAK folder under storage.etak_path", required=True)
+    parser.add_argument("--dry-run", help="only report the changed map sheets", action='store_true')
+    parser.add_argument("-log", "--loglevel", help="log level", default='info')
+    args = parser.parse_args(arg_list)
+    return args
+
+
+def layer_features(ds, name: str, extent: List[float]) -> Dict[str, Tuple[bytes, str]]:
+    # (geometry wkb, overlay attribute) per feature, keyed by etak_id when the layer has it
+    layer = ds.GetLayerByName(name)
+    if (layer is None):
+        return {}
+    layer.SetSpatialFilterRect(*extent)
+    column = layer_columns[name]
+    has_id = layer.GetLayerDefn().GetFieldIndex('etak_id') >= 0
+    features = {}
+    for feature in layer:
+        geometry = feature.GetGeometryRef()
+        if (geometry is None):
+            continue
+        value = str(feature.GetField(column))
+        if ((name == 'E_601_elektriliin_j') and (feature.GetField(column) not in powerline_voltages)):
+            continue
+        wkb = bytes(geometry.ExportToWkb())
+        key = str(feature.GetField('etak_id')) if (has_id) else hashlib.sha1(wkb + value.encode()).hexdigest()
+        features[key] = (wkb, value)
+    return features
+
+
+def changed_geometries(old: Dict[str, Tuple[bytes, str]], new: Dict[str, Tuple[bytes, str]]) -> List:
+    # area where the overlay may differ: added / removed features, the changed part of edited geometries
+    from osgeo import ogr
+    changed = []
+    for key in set(old.keys()) | set(new.keys()):
+        a, b = old.get(key), new.get(key)
+        if ((a is not None) and (b is not None)):
+            if (a == b):
+                continue
+            ga, gb = ogr.CreateGeometryFromWkb(a[0]), ogr.CreateGeometryFromWkb(b[0])
+            # the whole feature when the overlay value changed, otherwise only the moved part
+            changed.append(ga.Union(gb) if (a[1] != b[1]) else ga.SymDifference(gb))
+        else:
+            changed.append(ogr.CreateGeometryFromWkb((a or b)[0]))
+    return changed
+
+
+def geometry_mapsheets(geometry, candidates: Set[int]) -> Set[int]:
+    from osgeo import ogr
+    minx, maxx, miny, maxy = geometry.GetEnvelope()
+    result = set()
+    for y in range(int(miny // tile_size), int(maxy // tile_size) + 1):
+        for x in range(int(minx // tile_size), int(maxx // tile_size) + 1):
+            m = point_mapsheet(x * tile_size, y * tile_size)
+            if ((m not in candidates) or (m in result)):
+                continue
+            b = mapsheet_bounds(m)
+            ring = ogr.Geometry(ogr.wkbLinearRing)
+            for px, py in [(b[0], b[1]), (b[2], b[1]), (b[2], b[3]), (b[0], b[3]), (b[0], b[1])]:
+                ring.AddPoint_2D(px, py)
+            box = ogr.Geometry(ogr.wkbPolygon)
+            box.AddGeometry(ring)
+            if (geometry.Intersects(box)):
+                result.add(m)
+    return result
+
+
+def changed_mapsheets(old_file: str, new_file: str, mapsheets: List[int]) -> Set[int]:
+    from osgeo import ogr
+    ogr.UseExceptions()
+    bounds = [mapsheet_bounds(m) for m in mapsheets]
+    extent = [min(b[0] for b in bounds), min(b[1] for b in bounds), max(b[2] for b in bounds), max(b[3] for b in bounds)]
+    old_ds, new_ds = ogr.Open(gdal_path(old_file)), ogr.Open(gdal_path(new_file))
+    candidates = set(mapsheets)
+    result: Set[int] = set()
+    for name in etak_layers:
+        changed = changed_geometries(layer_features(old_ds, name, extent), layer_features(new_ds, name, extent))
+        layer_result: Set[int] = set()
+        for geometry in changed:
+            if (geometry.IsEmpty()):
+                continue
+            if (name == 'E_601_elektriliin_j'):
+                geometry = geometry.Buffer(powerline_buffer)
+            layer_result |= geometry_mapsheets(geometry, candidates)
+        logging.info(f'etak_diff: {name}: {len(changed)} changed features, {len(layer_result)} map sheets')
+        result |= layer_result
+    return result
+
+
+def requeue(cur, campaign: Campaign, mapsheets: List[int], changed: Set[int], old_file: str, new_file: str,
+            storageconfig: StorageConfig, processingconfig: ProcessingConfig, id_: str) -> Tuple[List[str], List[Tuple]]:
+    filenames = [f'{m}_{campaign.laz_year}_{campaign.laz_type}.laz' for m in mapsheets]
+    queued = [f'{m}_{campaign.laz_year}_{campaign.laz_type}.laz' for m in changed]
+    partition, partition_data = partition_filter('laz_files', filenames)
+    statement = "select laz_files.filename, dem_files.filename, laz_files.reclassify_fingerprint from laz_files \
+                 join mapsheets_mapping on mapsheets_mapping.nr = laz_files.laz_map_sheet \
+                 join dem_files on dem_files.dem_map_sheet = mapsheets_mapping.nr10000 \
+                 where laz_files.state = 3 and dem_files.state = 1 and laz_files.filename = ANY(%(filenames)s) \
+                 and dem_files.year = %(dem_year)s and " + partition
+    # tiles of changed map sheets go back to fixed (state 2), the next run reclassifies them
+    cur.execute(f'update laz_files set (state, identifier) = (2, %(id)s) where state = 3 and filename = ANY(%(filenames)s) \
+                 and {partition} returning filename', {'id': id_, 'filenames': queued, **partition_data})
+    requeued = [r[0] for r in cur.fetchall()]
+    # the other tiles keep their output: their fingerprint moves to the new edition when it matches the old one
+    cur.execute(statement, {'filenames': [f for f in filenames if (f not in queued)],
+                            'dem_year': dem_edition(campaign.dem_year), **partition_data})
+    unchanged = cur.fetchall()
+    rebased = []
+    if (len(unchanged) > 0):
+        laz_fixed_filepath = storageconfig.bucket + '/' + storageconfig.fix_path
+        ndvi_full_path = storageconfig.ndvi_path + '/' + ndvi_mapping[campaign.laz_type].format(year=campaign.laz_year)
+        options = processingconfig.reclassify.model_dump()
+        parts = ([r[0] for r in unchanged], [r[1] for r in unchanged], laz_fixed_filepath)
+        old_fingerprints = reclassify_fingerprints(*parts, old_file, ndvi_full_path, options)
+        new_fingerprints = reclassify_fingerprints(*parts, new_file, ndvi_full_path, options)
+        rebased = [(new_fingerprints[i], r[0]) for i, r in enumerate(unchanged)
+                   if ((old_fingerprints[i] is not None) and (old_fingerprints[i] == r[2]))]
+        cur.executemany('update laz_files set reclassify_fingerprint = %s where filename = %s', rebased)
+    return (requeued, rebased)
+
+
+def main(arg_list: List[str] | None = None):
+    args = parse_args(arg_list)
+    logging.basicConfig(format='%(asctime)s.%(msecs)03d %(levelname)7s {%(module)s} [%(funcName)s] %(message)s',
+                        datefmt='%Y-%m-%d,%H:%M:%S', level=loglevel[args.loglevel.lower()])
+    try:
+        with open(args.config) as f:
+            config = yaml.safe_load(f)
+        dbconfig = DBConfig(**config['db'])
+        storageconfig = StorageConfig(**config['storage'])
+        lidarconfig = LidarConfig(**config['lidar'])
+        processingconfig = ProcessingConfig(**config.get('processing', {}))
+    except (yaml.YAMLError, OSError, KeyError) as e:
+        logging.error(f'etak_diff: load {args.config} failed: {e}')
+        os.sys.exit(-1)
+    # the campaigns are diffed against their own edition, --old applies to all of them
+    groups: Dict[str, List[Campaign]] = {}
+    for c in lidarconfig.campaigns:
+        old_edition = args.old or c.etak_edition or etak_mapping.get(c.laz_year)
+        if (old_edition is None):
+            logging.error(f'etak_diff: no ETAK edition for {c.laz_year}, use --old')
+            os.sys.exit(-1)
+        groups.setdefault(old_edition, []).append(c)
+    new_file = storageconfig.etak_path + '/' + args.new + '/' + etak_filename
+    changed: Dict[str, Set[int]] = {}
+    for old_edition in sorted(groups.keys()):
+        old_file = storageconfig.etak_path + '/' + old_edition + '/' + etak_filename
+        changed[old_edition] = changed_mapsheets(old_file, new_file, lidarconfig.laz_mapsheets)
+        logging.info(f'etak_diff: {len(changed[old_edition])} of {len(lidarconfig.laz_mapsheets)} map sheets changed '
+                     f'between {old_edition} and {args.new}')
+    if (args.dry_run):
+        print('\n'.join(str(m) for m in sorted(set().union(*changed.values()))))
+        os.sys.exit(0)
+
+    requeued, rebased = [], []
+    try:
+        db = Database(**dbconfig.__dict__)
+        cur = db.conn.cursor()
+        with db.conn.transaction():
+            for old_edition, campaigns in sorted(groups.items()):
+                old_file = storageconfig.etak_path + '/' + old_edition + '/' + etak_filename
+                for c in campaigns:
+                    result = requeue(cur, c, lidarconfig.laz_mapsheets, changed[old_edition], old_file, new_file,
+                                     storageconfig, processingconfig, args.id)
+                    requeued += result[0]
+                    rebased += result[1]
+    except dbError as e:
+        logging.error(f'etak_diff: db error {e}')
+        os.sys.exit(-1)
+    logging.info(f'etak_diff: {len(requeued)} tiles queued for reclassification with identifier {args.id}, '
+                 f'{len(rebased)} unchanged tiles moved to {args.new}')
+    logging.info(f'etak_diff: set etak_edition: {args.new} (of the campaigns) in {args.config} and run lidar_processor/main.py')
+    os.sys.exit(0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,56 @@
+import yaml
+import argparse
+import logging
+import os
+from typing import List
+from psycopg import Error as dbError
+
+from lidar_processor.dependencies.db import Database
+from lidar_processor.schemas.config import DBConfig, StorageConfig, LidarConfig
+from lidar_processor.model.state_processing.reclassify import etak_mapping, etak_filename
+from lidar_processor.model.state_processing.etak_presence import load_etak
+
+
+loglevel = {'info': logging.INFO,
+            'debug': logging.DEBUG,
+            'error': logging.ERROR,
+            'warning': logging.WARNING}
+
+
+def parse_args(arg_list: List[str] | None):
+    parser = argparse.ArgumentParser(description='Load the ETAK overlay layers into PostGIS for the batch presence checks of reclassify.')
+    parser.add_argument("-c", "--config", help="configuration path", default='./config.yaml')
+    parser.add_argument("-e", "--edition", help="ETAK folder under storage.etak_path (default: the editions of the campaigns)",
+                        action='append', default=None)
+    parser.add_argument("-log", "--loglevel", help="log level", default='info')
+    args = parser.parse_args(arg_list)
+    return args
+
+
+def main(arg_list: List[str] | None = None):
+    args = parse_args(arg_list)
+    logging.basicConfig(format='%(asctime)s.%(msecs)03d %(levelname)7s {%(module)s} [%(funcName)s] %(message)s',
+                        datefmt='%Y-%m-%d,%H:%M:%S', level=loglevel[args.loglevel.lower()])
+    try:
+        with open(args.config) as f:
+            config = yaml.safe_load(f)
+        dbconfig = DBConfig(**config['db'])
+        storageconfig = StorageConfig(**config['storage'])
+        lidarconfig = LidarConfig(**config['lidar'])
+    except (yaml.YAMLError, OSError, KeyError) as e:
+        logging.error(f'etak_postgis: load {args.config} failed: {e}')
+        os.sys.exit(-1)
+    editions = args.edition or sorted({c.etak_edition or etak_mapping.get(c.laz_year) for c in lidarconfig.campaigns} - {None})
+    try:
+        db = Database(**dbconfig.__dict__)
+        for edition in editions:
+            load_etak(db, storageconfig.etak_path + '/' + edition + '/' + etak_filename, edition)
+    except (dbError, RuntimeError) as e:
+        logging.error(f'etak_postgis: load failed {e}')
+        os.sys.exit(-1)
+    logging.info(f'etak_postgis: {len(editions)} editions loaded, set processing.etak_postgis: true in {args.config}')
+    os.sys.exit(0)
+
+
+if __name__ == "__main__":
+    main()
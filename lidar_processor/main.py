@@ -1,16 +1,24 @@
 import yaml
 import argparse
 import logging
-from typing import List
+from typing import Any, Dict, List
 from psycopg import Error as dbError
 import time
 import os
 import uuid
+from multiprocessing import cpu_count
 
 from lidar_processor.dependencies.db import Database
-from lidar_processor.schemas.config import DBConfig, StorageConfig, LidarConfig
+from lidar_processor.schemas.config import DBConfig, StorageConfig, LidarConfig, ProcessingConfig
+from lidar_processor.dependencies.staging import UploadStager
+from lidar_processor.dependencies.pool import TaskPool
+from lidar_processor.dependencies.metrics import MetricsExporter
+from lidar_processor.dependencies.profiling import summarize
+from lidar_processor.dependencies.mapsheet import spatial_order
+from lidar_processor.dependencies.partition import partition_filter, dem_edition
 from lidar_processor.model.state_processing.records_creation import laz_files_creation, dem_files_creation
 from lidar_processor.model.state_processing.download_files import download_files
+from lidar_processor.model.state_processing.probe_headers import probe_headers
 from lidar_processor.model.state_processing.fix_lidar import fix_lidar
 from lidar_processor.model.state_processing.reclassify import reclassify
 from lidar_processor.model.state_processing.recovery import recovery
@@ -27,12 +35,38 @@ def parse_args(arg_list: List[str] | None):
     parser.add_argument("-c", "--config", help="configuration path", default='./config.yaml')
     parser.add_argument("-i", "--id", help="identifier", default=str(uuid.uuid4().hex.upper()))
     parser.add_argument("-r", "--recovery", help="identifier to recover", default=None)
+    parser.add_argument("--profile", help="profile N tiles per stage (default 5) in the workers", nargs='?', type=int, const=5, default=0)
+    parser.add_argument("--profile-dir", help="folder of the profiles (default ./profile_<identifier>)", default=None)
     parser.add_argument("-log", "--loglevel", help="configuration path", default='info')
     args = parser.parse_args(arg_list)
     return args
 
 
+def heavy_timeout(timeout: int | None, factor: float) -> float | None:
+    return (timeout * factor) if (timeout is not None) else None
+
+
+def prefetch_options(processingconfig: ProcessingConfig) -> Dict[str, Any] | None:
+    if (processingconfig.prefetch_lookahead <= 0):
+        return None
+    scratch_path = processingconfig.prefetch_path or processingconfig.scratch_path
+    return {'scratch_path': scratch_path, 'lookahead': processingconfig.prefetch_lookahead,
+            'max_bytes': int(processingconfig.prefetch_limit_gb * 2**30), 'workers': processingconfig.prefetch_workers}
+
+
+def dedup_options(processingconfig: ProcessingConfig) -> Dict[str, Any] | None:
+    if (not processingconfig.dedup):
+        return None
+    return {'tolerance': processingconfig.dedup_tolerance, 'time_tolerance': processingconfig.dedup_time_tolerance,
+            'chunk_size': processingconfig.dedup_chunk_size}
+
+
 def main(arg_list: List[str] | None = None):
+    # lidarprocessing status ... : progress report without loading the processing stack
+    arg_list = os.sys.argv[1:] if (arg_list is None) else arg_list
+    if ((len(arg_list) > 0) and (arg_list[0] == 'status')):
+        from lidar_processor.status import main as status
+        status(arg_list[1:])
     args = parse_args(arg_list)
     # get config yaml file path from args
     configpath = args.config
@@ -53,11 +87,12 @@ def main(arg_list: List[str] | None = None):
         os.sys.exit(-1)
 
     # pre-checking
-    db, dbconfig, storageconfig, lidarconfig = None, None, None, None
+    db, dbconfig, storageconfig, lidarconfig, processingconfig = None, None, None, None, None
     try:
         dbconfig = DBConfig(**config['db'])
         storageconfig = StorageConfig(**config['storage'])
         lidarconfig = LidarConfig(**config['lidar'])
+        processingconfig = ProcessingConfig(**config.get('processing', {}))
     except KeyError as e:
         logging.error(f"[{id_}] config file missing section: {e}")
         os.sys.exit(-1)
@@ -68,15 +103,27 @@ def main(arg_list: List[str] | None = None):
         logging.error(f'[{id_}] lidar_processor{suffix}: db initialization failed {e}')
         os.sys.exit(-1)
     # we should filter out those laz mapsheet that doesn't belongs to Estonia
-    filtered_range = db.execute_sql("""select nr from mapsheets_mapping where nr = ANY (%(laz_mapsheets)s)""",
+    filtered_range = db.execute_sql("""select nr, nr10000 from mapsheets_mapping where nr = ANY (%(laz_mapsheets)s)""",
                                     {'laz_mapsheets': lidarconfig.laz_mapsheets})
     if (len(filtered_range) > 0):
+        # batch in spatial order, tiles sharing a DEM sheet back-to-back
+        filtered_range = [filtered_range[i] for i in spatial_order([r[0] for r in filtered_range], {r[0]: r[1] for r in filtered_range})]
         try:
             start = time.time()
+            exporter = None
+            stager = None
+            profile = None
+            if (args.profile > 0):
+                profile = {'dir': args.profile_dir or f'./profile_{id_}', 'count': args.profile}
+                logging.info(f'[{id_}] lidar_processor{suffix}: profiling {args.profile} tiles per stage into {profile["dir"]}')
+            if ((processingconfig.metrics_path is not None) or (processingconfig.metrics_port is not None)):
+                metrics_path = processingconfig.metrics_path.format(id=id_) if (processingconfig.metrics_path is not None) else None
+                exporter = MetricsExporter(metrics_path, processingconfig.metrics_port, processingconfig.metrics_interval)
             logging.info(f'[{id_}] lidar_processor{suffix}: identifier {id_}')
-            laz_filename = [f'{mapsheet[0]}_{lidarconfig.laz_year}_{lidarconfig.laz_type}.laz' for mapsheet in filtered_range]
+            # the campaigns of a map sheet follow each other and share its ancillary data
+            laz_filename = [f'{mapsheet[0]}_{c.laz_year}_{c.laz_type}.laz' for mapsheet in filtered_range for c in lidarconfig.campaigns]
             if (recovery_mode is not None):
-                id_, laz_list, dem_list = recovery(db, id_)
+                id_, laz_list, dem_list = recovery(db, id_, laz_filename, sorted({dem_edition(c.dem_year) for c in lidarconfig.campaigns}))
                 laz_filename = [i[0] for i in laz_list]
                 laz_recovery_map_sheets = [f.split('_')[0] for f in laz_filename]
                 logging.info(f'[{id_}] lidar_processor{suffix}: {len(laz_list)} laz files for processing.')
@@ -92,25 +139,45 @@ def main(arg_list: List[str] | None = None):
                 # enter state 0 (dem_files_creation) return new dem(s) need to download (dem filename, state)
                 #dem_list = dem_files_creation(db, laz_mapsheets, lidarconfig.dem_year, id_)
                 #logging.info(f'[{id_}] lidar_processor{suffix}: {len(dem_list)} new dem files for download.')
+            if (processingconfig.probe_headers):
+                # header metadata only, from the bucket when downloaded and from the geoportal otherwise
+                probe_headers(db, laz_filename)
             # enter state 1 or -1 , return tuple of list that download successfully,  the first is laz filename and second is dem filename
-            download_result = download_files(db, [r[0] for r in laz_list], storageconfig.bucket + '/' + storageconfig.laz_path, 'laz_files')
+            download_result = download_files(db, [r[0] for r in laz_list], storageconfig.bucket + '/' + storageconfig.laz_path, 'laz_files',
+                                             processingconfig.retries, processingconfig.retry_backoff)
             logging.info(f'[{id_}] lidar_processor{suffix}: {len(download_result)} laz files downloaded')
-            # enter state 2 or -2 , return tuple of list , (fixed , fix_failed , not_found, fix_no_need)
+            stager = UploadStager(processingconfig.scratch_path, processingconfig.upload_workers,
+                                  int(processingconfig.scratch_limit_gb * 2**30), processingconfig.upload_retries)
+            mp = int(os.environ.get('SLURM_CPUS_PER_TASK', cpu_count() - 1))
+            retry = {'retries': processingconfig.retries, 'backoff': processingconfig.retry_backoff,
+                     'backoff_cap': processingconfig.retry_backoff_cap}
+            fix_pool = TaskPool(mp, processingconfig.fix_timeout, processingconfig.heavy_workers,
+                                heavy_timeout(processingconfig.fix_timeout, processingconfig.heavy_timeout_factor), name='fix', **retry)
+            reclassify_pool = TaskPool(mp, processingconfig.reclassify_timeout, processingconfig.heavy_workers,
+                                       heavy_timeout(processingconfig.reclassify_timeout, processingconfig.heavy_timeout_factor), name='reclassify', **retry)
+            # enter state 2 or -2 (-12 timeout) , return tuple of list , (fixed , fix_failed , not_found, fix_no_need)
             fix_result = fix_lidar(db, laz_filename, storageconfig.bucket + '/' + storageconfig.fix_path,
-                                   lidarconfig.laz_to_crs)
+                                   lidarconfig.laz_to_crs, stager, fix_pool, processingconfig.laz_codec, profile,
+                                   dedup_options(processingconfig))
             fixed_laz = fix_result[0] + fix_result[3]
             print('here')
-            # enter state 3 or -3, return tuple of list , (reclassified , reclasify_failed , not_found)
-            reclassify_result = reclassify(db, fixed_laz, lidarconfig.laz_year, lidarconfig.laz_type, lidarconfig.dem_year,
+            # enter state 3 or -3 (-13 timeout), return tuple of list , (reclassified , reclasify_failed , not_found)
+            reclassify_result = reclassify(db, fixed_laz, lidarconfig.campaigns,
                                            storageconfig.bucket + '/' + storageconfig.fix_path,
                                            storageconfig.bucket + '/' + storageconfig.reclassify_path,
-                                           storageconfig.etak_path, storageconfig.ndvi_path)
+                                           storageconfig.etak_path, storageconfig.ndvi_path, stager, reclassify_pool,
+                                           dict(processingconfig.reclassify.model_dump(), laz_codec=processingconfig.laz_codec),
+                                           prefetch_options(processingconfig), profile, processingconfig.etak_postgis)
+            if (profile is not None):
+                summarize(profile['dir'])
             end = time.time()
             logging.info(f'[{id_}] lidar_processor{suffix}: completed {(end-start)/60} mins.')
-            state = [0, 1, 2,  -1, -2, -3]
+            state = [0, 1, 2,  -1, -2, -3, -12, -13]
             rerun = []
+            partition, partition_data = partition_filter('laz_files', laz_filename)
             for s in state:
-                result = db.execute_sql('select filename from laz_files where state=%(state)s and filename=ANY(%(filename)s)', {'state': s, 'filename': laz_filename})
+                result = db.execute_sql(f'select filename from laz_files where state=%(state)s and filename=ANY(%(filename)s) and {partition}',
+                                        {'state': s, 'filename': laz_filename, **partition_data})
                 result = [i[0] for i in result]
                 rerun += result
                 logging.info(f'[{id_}] lidar_processor{suffix}: state {s} files : {result}')
@@ -118,7 +185,8 @@ def main(arg_list: List[str] | None = None):
                 logging.warning(f'[{id_}] lidar_processor{suffix}: {id_} need recover')
                 os.sys.exit(-1)
             else:
-                result = db.execute_sql('select count(filename) from laz_files where state=3 and filename=ANY(%(filename)s)', {'filename': laz_filename})
+                result = db.execute_sql(f'select count(filename) from laz_files where state=3 and filename=ANY(%(filename)s) and {partition}',
+                                        {'filename': laz_filename, **partition_data})
                 logging.info(f'[{id_}] lidar_processor{suffix}: completed successfully, reclassified {result[0][0]} laz files.')
                 os.sys.exit(0)
         except dbError as e:
@@ -131,6 +199,12 @@ def main(arg_list: List[str] | None = None):
             logging.error(f'[{id_}] {e}')
             logging.warning(f'[{id_}] lidar_processor{suffix}: {id_} need recover')
             os.sys.exit(-1)
+        finally:
+            # uploads in flight finish and the last metrics are written also when a stage failed
+            if (stager is not None):
+                stager.close()
+            if (exporter is not None):
+                exporter.close()
     else:
         logging.error(f'[{id_}] lidar_processor{suffix}: laz map sheets range is incorrect.')
         os.sys.exit(-1)
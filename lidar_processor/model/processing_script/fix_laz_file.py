@@ -1,15 +1,18 @@
 import argparse
+from typing import Any, Dict, Tuple
 
 import numpy as np
 import pyproj
 import laspy
-import gcsfs
-import io
-import tempfile
 import logging
 import tempfile
+import time
 from datetime import datetime, timezone
-from google.cloud import storage
+
+from lidar_processor.dependencies.storage import get_storage
+from lidar_processor.dependencies.codec import laz_backend
+from lidar_processor.dependencies.retry import failure
+from lidar_processor.dependencies import profiling
 
 # Remove points flagged as overlaps
 def remove_overlapping_points(laz_points: laspy.LasData) -> laspy.LasData:
@@ -29,57 +32,113 @@ def remove_overlapping_points(laz_points: laspy.LasData) -> laspy.LasData:
     return laz_points
 
 
+# Cell index of a coordinate, tolerance 0 keeps the scaled integer value (exact duplicates)
+def quantize(values: np.ndarray, tolerance: float) -> np.ndarray:
+    if (tolerance <= 0):
+        return np.asarray(values).astype(np.int64)
+    return np.floor(np.asarray(values) / tolerance).astype(np.int64)
+
+
+# Remove exact and near duplicate points (flight line seams, tile edges) missed by the overlap flag
+def remove_duplicate_points(
+        laz_points: laspy.LasData,
+        tolerance: float = 0,
+        time_tolerance: float | None = 0,
+        chunk_size: int = 5000000
+    ) -> Tuple[laspy.LasData, int]:
+
+    # Points are duplicates when they fall in the same cell of tolerance m in X, Y, Z
+    # and of time_tolerance s in GPS time (when the point format has it, None leaves GPS time out:
+    # the copies of a flight line seam were recorded on both passes and only match in XYZ)
+    if (tolerance <= 0):
+        keys = [laz_points.X, laz_points.Y, laz_points.Z]
+    else:
+        keys = [quantize(laz_points.x, tolerance), quantize(laz_points.y, tolerance), quantize(laz_points.z, tolerance)]
+    if ((time_tolerance is not None) and ("gps_time" in laz_points.point_format.dimension_names)):
+        keys.append(quantize(laz_points.gps_time, time_tolerance) if (time_tolerance > 0)
+                    else np.asarray(laz_points.gps_time).view(np.int64))
+    keys = np.column_stack([np.asarray(k).astype(np.int64) for k in keys])
+
+    # Chunks of about chunk_size points cut between X cells, so duplicates never span two chunks
+    order = np.argsort(keys[:, 0], kind="stable")
+    changes = np.flatnonzero(np.diff(keys[order, 0])) + 1
+    cuts = np.unique(changes[np.minimum(np.searchsorted(changes, np.arange(chunk_size, len(order), chunk_size)), len(changes) - 1)]) \
+        if (len(changes) > 0) else np.array([], dtype=np.int64)
+
+    # Keep the first point of every cell in file order
+    keep = np.zeros(len(order), dtype=bool)
+    for ids in np.split(order, cuts):
+        first = np.unique(keys[ids], axis=0, return_index=True)[1]
+        keep[ids[first]] = True
+    removed = int(len(keep) - keep.sum())
+    if (removed > 0):
+        laz_points.points.array = laz_points.points.array[keep]
+        laz_points.header.point_count = int(keep.sum())
+    return laz_points, removed
+
+
 # Add CRS to points
 def add_crs(laz_points: laspy.LasData, out_crs: str) -> laspy.LasData:
     laz_points.header.add_crs(pyproj.CRS.from_string(out_crs))
     return laz_points
 
 
-def main(input_file: str, output_file: str, out_crs: str) -> int:
+def main(input_file: str, output_file: str, out_crs: str, codec: str = 'default', threads: int = 1,
+         dedup: Dict[str, Any] | None = None) -> int:
 
     # Read points
-    # To support gcp access
+    # streamed through the storage backend (gs:// or local/NFS path)
     try:
-        if (input_file.lower().startswith('gs://')):
-            temp = tempfile.NamedTemporaryFile('wb', suffix='.laz')
-            path = input_file.split('/')
-            client = storage.Client()
-            obj = client.get_bucket(path[2])
-            obj = obj.get_blob('/'.join(path[3:]))
-            with open(temp.name, 'wb') as f:
-                obj.download_to_file(f)
-
-            input_file = temp.name
-        with open(input_file, 'rb') as f:
-            laz_points = laspy.read(f)
+        backend = laz_backend(codec, threads)
+        start = time.perf_counter()
+        with get_storage(input_file).open(input_file, 'rb') as f:
+            laz_points = laspy.read(f, laz_backend=backend)
+        decode_time = time.perf_counter() - start
 
         # Remove overlapping points
         laz_points = remove_overlapping_points(laz_points)
 
+        # Remove duplicate points
+        removed = 0
+        if (dedup is not None):
+            start = time.perf_counter()
+            laz_points, removed = remove_duplicate_points(laz_points, **dedup)
+            logging.info(f'fix laz: {input_file.split("/")[-1]} {removed} duplicate points removed in {time.perf_counter() - start:.1f} s')
+            profiling.record('dedup_s', time.perf_counter() - start)
+            profiling.record('duplicates', removed)
+
         # Add CRS
         laz_points = add_crs(laz_points, out_crs)
 
         # Write fixed output file
-        if (output_file.lower().startswith('gs://')):
-            # have to give the .laz suffix , otherwise, the laz file will be very large.
-            # Seems like lazpy does the compression depends on the file extension
-            tmp = tempfile.NamedTemporaryFile(suffix='.laz')
-            laz_points.write(tmp.name)
-            fs = gcsfs.GCSFileSystem() if (output_file.lower().startswith('gs://')) else io
-            fs.put_file(tmp.name, output_file)
+        # laspy seeks back to patch the header and chunk table, object storage writes can not seek:
+        # remote outputs go through a local temporary file, local/NFS paths are written in place
+        start = time.perf_counter()
+        storage = get_storage(output_file)
+        if (output_file.startswith('gs://')):
+            # have to give the .laz suffix, laspy picks the compression from the extension
+            with tempfile.NamedTemporaryFile(suffix='.laz') as tmp:
+                laz_points.write(tmp.name, laz_backend=backend)
+                storage.put_file(tmp.name, output_file)
         else:
-            laz_points.write(output_file)
-        return (2, datetime.now(timezone.utc))
+            with storage.open(output_file, 'wb') as f:
+                laz_points.write(f, do_compress=True, laz_backend=backend)
+        logging.info(f'fix laz: {input_file.split("/")[-1]} codec {backend}: decode {decode_time:.1f} s, '
+                     f'encode {time.perf_counter() - start:.1f} s')
+        profiling.record('decode_s', decode_time)
+        profiling.record('encode_s', time.perf_counter() - start)
+        profiling.record('points', len(laz_points.points))
+        return (2, datetime.now(timezone.utc), removed, len(laz_points.points))
     except Exception as e:
         logging.error(f'fix laz: {input_file.split("/")[-1]} failed: {e}')
-        return (-2, datetime.now(timezone.utc))
+        return failure(-2, e)
 
 
 if __name__ == "__main__":
 
     parser = argparse.ArgumentParser(
     description=(
-            "Remove overlapping points, assign CRS and "
+            "Remove overlapping (and optionally duplicate) points, assign CRS and "
             "write out as LAZ 1.4 file."
         )
     )
@@ -90,6 +149,40 @@ if __name__ == "__main__":
         help="output CRS (default: %(default)s)",
         default="EPSG:3301"
     )
+    parser.add_argument(
+        "--codec",
+        help="LAZ codec: default, lazrs, lazrs_parallel or auto (default: %(default)s)",
+        default="default"
+    )
+    parser.add_argument(
+        "--threads",
+        help="threads for the parallel codec (default: %(default)s)",
+        type=int,
+        default=1
+    )
+
+    parser.add_argument(
+        "--dedup",
+        help="remove duplicate points: same cell of --dedup_tolerance m in XYZ and of --dedup_time_tolerance s in GPS time",
+        action="store_true"
+    )
+    parser.add_argument(
+        "--dedup_tolerance",
+        help="XYZ cell size in m, 0 for exact duplicates (default: %(default)s)",
+        type=float,
+        default=0
+    )
+    parser.add_argument(
+        "--dedup_time_tolerance",
+        help="GPS time cell size in s, 0 for exact duplicates (default: %(default)s)",
+        type=float,
+        default=0
+    )
+    parser.add_argument(
+        "--dedup_ignore_time",
+        help="leave GPS time out of the duplicate key (seam duplicates of two passes)",
+        action="store_true"
+    )
 
     # Parse the arguments
     args = parser.parse_args()
@@ -102,7 +195,9 @@ if __name__ == "__main__":
     try:
 
         # Run main function
-        main(input_file, output_file, out_crs)
+        time_tolerance = None if (args.dedup_ignore_time) else args.dedup_time_tolerance
+        dedup = {"tolerance": args.dedup_tolerance, "time_tolerance": time_tolerance} if (args.dedup) else None
+        main(input_file, output_file, out_crs, args.codec, args.threads, dedup)
 
     except Exception as e:
         print(f"Error: {str(e)}")
@@ -1,15 +1,30 @@
 import json
-from typing import List
+from typing import Any, Dict, List, Tuple
 import os
 import argparse
+import shutil
+import tempfile
+import time
+import concurrent.futures
 from datetime import datetime, timezone
 import logging
 
+import numpy as np
+from numpy.lib import recfunctions as rfn
 import pdal
 from osgeo import ogr
 
+from lidar_processor.dependencies.storage import gdal_path, get_storage, sibling_path
+from lidar_processor.dependencies.codec import pdal_reader_threads
+from lidar_processor.dependencies.mapsheet import mapsheet_bounds
+from lidar_processor.dependencies.retry import failure
+from lidar_processor.dependencies import profiling
+
 ogr.UseExceptions()
 
+# NDVIScaled of the points without NDVI (outside the raster, nodata -9999 or NaN) in the compact profile
+ndvi_scaled_nodata = -32768
+
 
 class ReclassificationPipeline:
 
@@ -19,20 +34,44 @@ class ReclassificationPipeline:
             output_file: str,
             dem_file: str,
             etak_file: str,
-            ndvi_file: str
+            ndvi_file: str,
+            split_size_mb: float | None = None,
+            split_length: float = 250,
+            split_workers: int = 4,
+            laz_codec: str = "default",
+            codec_threads: int = 1,
+            streaming: bool = False,
+            chunk_size: int = 100000,
+            output_profile: str = "full",
+            metrics: List[str] | None = None,
+            metrics_resolution: float = 10,
+            cover_height: float = 1.3,
+            subsets: Dict[str, str] | None = None,
+            overlays: List[str] | None = None
         ) -> None:
 
         # Store input arguments as instance attributes
         self.input_file = input_file
+        self.split_size_mb = split_size_mb
+        self.split_length = split_length
+        self.split_workers = split_workers
+        self.reader_threads = pdal_reader_threads(laz_codec, codec_threads)
+        self.streaming = streaming
+        self.chunk_size = chunk_size
         self.output_file = output_file
-        if (dem_file.startswith("gs://")):
-            dem_file = dem_file.replace("gs://", "/vsigs/")
+        self.metrics = metrics or []
+        self.metrics_resolution = metrics_resolution
+        self.cover_height = cover_height
+        self.metrics_file = sibling_path(output_file, "_metrics.tif")
+        self.subsets = subsets or {}
+        # points written, set by run()
+        self.point_count = 0
+        # overlays present in the tile from the batch query of reclassify, None checks the ETAK file
+        self.overlays = overlays
+        dem_file = gdal_path(dem_file)
         self.dem_file = dem_file
         self.etak_file = etak_file
-        if (ndvi_file.startswith("gs://")):
-            ndvi_file = ndvi_file.replace("gs://", "/vsigs/")
-        if (ndvi_file.startswith("s3://")):
-            ndvi_file = ndvi_file.replace("s3://", "/vsis3/")
+        ndvi_file = gdal_path(ndvi_file)
         self.ndvi_file = ndvi_file
 
         # Default pipeline structure
@@ -127,7 +166,12 @@ class ReclassificationPipeline:
                 }
             ]
         }
+        if (self.reader_threads is not None):
+            self.pipeline["pipeline"][0]["threads"] = self.reader_threads
         self.update_pipeline(input_file, etak_file)
+        if (output_profile == "compact"):
+            self.compact_output()
+        self.add_subset_writers()
 
     # Get bounds of LAZ file
     def get_laz_bounds(self, input_file: str) -> List[float]:
@@ -139,9 +183,13 @@ class ReclassificationPipeline:
                 }
             ]
         }
+        # the bounds are in the header, no need to load the points
+        pipeline_dict["pipeline"][0]["count"] = 0
         pipeline_json = json.dumps(pipeline_dict)
         pipeline_obj = pdal.Pipeline(pipeline_json)
+        start = time.perf_counter()
         pipeline_obj.execute()
+        profiling.record("bounds_s", time.perf_counter() - start)
         metadata = pipeline_obj.metadata
         minx = metadata["metadata"]["readers.las"]["minx"]
         miny = metadata["metadata"]["readers.las"]["miny"]
@@ -167,6 +215,12 @@ class ReclassificationPipeline:
 
         return has_features
 
+    # Check if an overlay is present, from the batch presence query when available
+    def overlay_exists(self, overlay: str, etak_file: str, query: str) -> bool:
+        if (self.overlays is not None):
+            return overlay in self.overlays
+        return self.features_exist(etak_file, query)
+
     # Update overlay bounding box based on LAZ file bounds
     def update_overlay_bbox(self, laz_bounds: List[float], query: str) -> str:
         minx = laz_bounds[0]
@@ -215,7 +269,7 @@ class ReclassificationPipeline:
                 "'POLYGON((minx miny, maxx miny, maxx maxy, minx maxy, minx miny))', 3301))"
             )
         )
-        if self.features_exist(etak_file, sea_query):
+        if self.overlay_exists("sea", etak_file, sea_query):
             overlay_steps.append({
                 "type": "filters.overlay",
                 "dimension": "WithinSea",
@@ -236,7 +290,7 @@ class ReclassificationPipeline:
                 "AND ST_Intersects(geom, ST_GeomFromText('POLYGON((minx miny, maxx miny, maxx maxy, minx maxy, minx miny))', 3301))"
             )
         )
-        if self.features_exist(etak_file, powerline_query):
+        if self.overlay_exists("powerline", etak_file, powerline_query):
             overlay_steps.append({
                 "type": "filters.overlay",
                 "dimension": "WithinPowerline",
@@ -261,7 +315,7 @@ class ReclassificationPipeline:
                 "WHERE ST_Intersects(geom, ST_GeomFromText('POLYGON((minx miny, maxx miny, maxx maxy, minx maxy, minx miny))', 3301))"
             )
         )
-        if self.features_exist(etak_file, water_query):
+        if self.overlay_exists("water", etak_file, water_query):
             overlay_steps.append({
                 "type": "filters.overlay",
                 "dimension": "WithinWaterBody",
@@ -286,7 +340,7 @@ class ReclassificationPipeline:
                 "WHERE ST_Intersects(geom, ST_GeomFromText('POLYGON((minx miny, maxx miny, maxx maxy, minx maxy, minx miny))', 3301))"
             )
         )
-        if self.features_exist(etak_file, building_query):
+        if self.overlay_exists("building", etak_file, building_query):
             overlay_steps.append({
                 "type": "filters.overlay",
                 "dimension": "WithinBuilding",
@@ -319,22 +373,184 @@ class ReclassificationPipeline:
                 "Classification = 5 WHERE ((WithinSea == 0) && (OriginalClassification == 2) && (HeightAboveGround > 0.2) && (NDVI > 0.33))"
             )
 
+    # Pack the added attributes into compact extra bytes of the output file
+    def compact_output(self) -> None:
+        self.pipeline["pipeline"][-1:-1] = [
+            # Bitfield of the overlay masks
+            {
+                "type": "filters.ferry",
+                "dimensions": "=>OverlayFlags"
+            },
+            {
+                "type": "filters.assign",
+                "value": "OverlayFlags = WithinSea + WithinPowerline * 2 + WithinWaterBody * 4 + WithinBuilding * 8"
+            },
+            # NDVI clamped to [-1, 1] and scaled by 10000, nodata gets a sentinel outside that range
+            {
+                "type": "filters.ferry",
+                "dimensions": "=>NDVIScaled"
+            },
+            {
+                "type": "filters.assign",
+                "value": [
+                    "NDVIScaled = NDVI * 10000",
+                    "NDVIScaled = 10000 WHERE NDVI > 1",
+                    "NDVIScaled = -10000 WHERE NDVI < -1",
+                    f"NDVIScaled = {ndvi_scaled_nodata} WHERE (NDVI < -1000) || (NDVI > 1000) || (NDVI != NDVI)"
+                ]
+            }
+        ]
+        self.pipeline["pipeline"][-1]["extra_dims"] = (
+            "OverlayFlags=uint8,NDVIScaled=int16,HeightAboveGround=float32,OriginalClassification=uint8"
+        )
+
+    # Write the point subsets (e.g. ground only) next to the output from the same view
+    def add_subset_writers(self) -> None:
+        writer = self.pipeline["pipeline"][-1]
+        for name, expression in self.subsets.items():
+            self.pipeline["pipeline"].append(dict(writer, filename=self.subset_file(name), where=expression))
+
+    def subset_file(self, name: str) -> str:
+        return sibling_path(self.output_file, f"_{name}.laz")
+
+    # Number of points of every written subset, from the file headers
+    def subset_counts(self) -> Dict[str, int]:
+        counts = {}
+        for name in self.subsets.keys():
+            reader_obj = pdal.Pipeline(json.dumps({"pipeline": [{"type": "readers.las", "filename": self.subset_file(name), "count": 0}]}))
+            reader_obj.execute()
+            counts[name] = int(reader_obj.metadata["metadata"]["readers.las"]["count"])
+        return counts
+
+    # Check if the input is large enough to be split into sub-tiles
+    def split_required(self) -> bool:
+        if ((self.split_size_mb is None) or (self.split_workers < 2)):
+            return False
+        size = get_storage(self.input_file).sizes([self.input_file])[0]
+        return (size is not None) and (size > self.split_size_mb * 2**20)
+
+    # Run the pipeline on sub-tiles in parallel and merge them in the original point order
+    def run_split(self) -> None:
+
+        # Read all points once, remember their position
+        reader_obj = pdal.Pipeline(json.dumps({"pipeline": self.pipeline["pipeline"][:1]}))
+        start = time.perf_counter()
+        reader_obj.execute()
+        logging.info(f"reclassify: {os.path.basename(self.input_file)} decode {time.perf_counter() - start:.1f} s "
+                     f"({self.reader_threads or 1} threads)")
+        profiling.record("decode_s", time.perf_counter() - start)
+        header = reader_obj.metadata["metadata"]["readers.las"]
+        points = reader_obj.arrays[0]
+        points = rfn.append_fields(points, "PointIndex", np.arange(len(points), dtype=np.uint64), usemask=False)
+
+        # Assign points to a grid of split_length cells
+        cols = ((points["X"] - points["X"].min()) // self.split_length).astype(np.int64)
+        rows = ((points["Y"] - points["Y"].min()) // self.split_length).astype(np.int64)
+        cells = rows * (cols.max() + 1) + cols
+        order = np.argsort(cells, kind="stable")
+        bounds = np.flatnonzero(np.diff(cells[order])) + 1
+        logging.info(f"reclassify: {os.path.basename(self.input_file)} split into {len(bounds) + 1} sub-tiles")
+
+        # Run all filters except reader and writers on every sub-tile
+        writers = len(self.subsets) + 1
+        filters_json = json.dumps({"pipeline": self.pipeline["pipeline"][1:-writers]})
+        workdir = tempfile.mkdtemp(dir=os.path.dirname(os.path.abspath(self.output_file)))
+        try:
+            subtiles = []
+            for i, ids in enumerate(np.split(order, bounds)):
+                subtile = os.path.join(workdir, f"{i}.npy")
+                np.save(subtile, points[ids])
+                subtiles.append(subtile)
+            del points, order
+            with concurrent.futures.ProcessPoolExecutor(self.split_workers) as executor:
+                list(executor.map(run_subtile, [filters_json] * len(subtiles), subtiles))
+            merged = np.concatenate([np.load(subtile) for subtile in subtiles])
+        finally:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+        # Restore the original point order and write the output file and its subsets
+        merged = rfn.drop_fields(merged[np.argsort(merged["PointIndex"])], "PointIndex", usemask=False)
+        self.point_count = len(merged)
+        header_options = {f"{k}_{axis}": header[f"{k}_{axis}"] for k in ["scale", "offset"] for axis in "xyz"}
+        header_options["a_srs"] = header["srs"]["wkt"]
+        writer_list = [dict(writer, **header_options) for writer in self.pipeline["pipeline"][-writers:]]
+        writer_obj = pdal.Pipeline(json.dumps({"pipeline": writer_list}), arrays=[merged])
+        start = time.perf_counter()
+        writer_obj.execute()
+        logging.info(f"reclassify: {os.path.basename(self.output_file)} encode {time.perf_counter() - start:.1f} s")
+        profiling.record("encode_s", time.perf_counter() - start)
+        if (len(self.metrics) > 0):
+            self.write_metrics(merged, header["srs"]["wkt"])
+
+    # Write the vegetation metric grids of the tile from the reclassified points
+    def write_metrics(self, points: np.ndarray, srs_wkt: str) -> None:
+        from lidar_processor.model.processing_script.vegetation_metrics import grid_metrics, write_metrics
+
+        # The grid is aligned to the map sheet, so the rasters of neighbouring tiles mosaic without resampling
+        bounds = mapsheet_bounds(int(os.path.basename(self.input_file).split("_")[0]))
+        start = time.perf_counter()
+        grids = grid_metrics(points, bounds, self.metrics_resolution, self.metrics, self.cover_height)
+        write_metrics(grids, bounds, self.metrics_resolution, self.metrics_file, srs_wkt)
+        logging.info(f"reclassify: {os.path.basename(self.metrics_file)} metrics {time.perf_counter() - start:.1f} s")
+        profiling.record("metrics_s", time.perf_counter() - start)
+
     def run(self) -> None:
+        if (self.split_required()):
+            self.run_split()
+            return
         pipeline_json = json.dumps(self.pipeline)
-        pipeline_obj = pdal.Pipeline(pipeline_json)
-        pipeline_obj.execute()
+        # the PDAL debug log of a profiled tile holds the per-stage messages
+        pipeline_obj = pdal.Pipeline(pipeline_json, loglevel=logging.DEBUG if (profiling.active()) else logging.ERROR)
+        start = time.perf_counter()
+        try:
+            self.execute(pipeline_obj)
+            # decode, filters and encode run in one PDAL execution, only their sum is known outside of a split
+            logging.info(f"reclassify: {os.path.basename(self.input_file)} execute {time.perf_counter() - start:.1f} s "
+                         f"({self.reader_threads or 1} reader threads)")
+        finally:
+            # the log and metadata are serialized by PDAL on access, only for profiled tiles
+            if (profiling.active()):
+                profiling.record("execute_s", time.perf_counter() - start)
+                profiling.record("pdal_log", pipeline_obj.log)
+                profiling.record("pdal_metadata", pipeline_obj.metadata)
+
+    def execute(self, pipeline_obj: pdal.Pipeline) -> None:
+        if (len(self.metrics) > 0):
+            # the metrics need all points of the tile in memory
+            if (self.streaming):
+                logging.warning(f"reclassify: {os.path.basename(self.input_file)} metrics requested, running in standard mode")
+            self.point_count = pipeline_obj.execute()
+            self.write_metrics(pipeline_obj.arrays[0], pipeline_obj.metadata["metadata"]["readers.las"]["srs"]["wkt"])
+            return
+        if (self.streaming):
+            # stream mode keeps only chunk_size points in memory, all stages have to support it
+            if (pipeline_obj.streamable):
+                self.point_count = pipeline_obj.execute_streaming(chunk_size=self.chunk_size)
+                return
+            stages = [stage["type"] for stage in self.pipeline["pipeline"]]
+            logging.warning(f"reclassify: {os.path.basename(self.input_file)} pipeline is not streamable {stages}, "
+                            "running in standard mode")
+        self.point_count = pipeline_obj.execute()
 
     def print_pipeline(self) -> None:
         print(json.dumps(self.pipeline, indent=4))
 
 
+# Run the filters of the pipeline on one sub-tile, the result replaces the sub-tile file
+def run_subtile(filters_json: str, subtile: str) -> None:
+    pipeline_obj = pdal.Pipeline(filters_json, arrays=[np.load(subtile)])
+    pipeline_obj.execute()
+    np.save(subtile, pipeline_obj.arrays[0])
+
+
 def main(
         input_file: str, output_file: str, dem_file: str, etak_file: str, ndvi_file: str, print_pipeline=True,
-    ) -> int:
+        options: Dict[str, Any] | None = None
+    ) -> Tuple[int, datetime, Dict[str, int], int]:
     try:
         # Create reclassification pipeline based on input files
         pipeline = ReclassificationPipeline(
-            input_file, output_file, dem_file, etak_file, ndvi_file
+            input_file, output_file, dem_file, etak_file, ndvi_file, **(options or {})
         )
 
         # Print pipeline
@@ -343,10 +559,10 @@ def main(
 
         # Run pipeline
         pipeline.run()
-        return (3, datetime.now(timezone.utc))
+        return (3, datetime.now(timezone.utc), pipeline.subset_counts(), pipeline.point_count)
     except Exception as e:
         logging.error(f"reclassify : {input_file.split('/')[-1]} failed {e}")
-        return (-3, datetime.now(timezone.utc))
+        return failure(-3, e, {})
 
 
 if __name__ == "__main__":
@@ -373,6 +589,45 @@ if __name__ == "__main__":
         "ndvi_file",
         help="name of NDVI file for summer season"
     )
+    parser.add_argument(
+        "--output_profile",
+        help="extra dimensions of the output: full or compact (default: %(default)s)",
+        choices=["full", "compact"],
+        default="full"
+    )
+    parser.add_argument(
+        "--metrics",
+        help="vegetation metrics written to <output>_metrics.tif, e.g. p95 cover density max (default: none)",
+        nargs="*",
+        default=[]
+    )
+    parser.add_argument(
+        "--metrics_resolution",
+        help="cell size of the metrics rasters in m (default: %(default)s)",
+        type=float,
+        default=10
+    )
+    parser.add_argument(
+        "--subset",
+        help="extra output <output>_<name>.laz with the points matching a PDAL expression, "
+             "e.g. --subset ground \"Classification == 2\" (repeatable)",
+        nargs=2,
+        metavar=("NAME", "EXPRESSION"),
+        action="append",
+        default=[]
+    )
+    parser.add_argument(
+        "--split_size_mb",
+        help="split input files larger than this into sub-tiles (default: no split)",
+        type=float,
+        default=None
+    )
+    parser.add_argument(
+        "--split_workers",
+        help="number of sub-tiles processed in parallel (default: %(default)s)",
+        type=int,
+        default=4
+    )
 
     # Parse the arguments
     args = parser.parse_args()
@@ -382,5 +637,9 @@ if __name__ == "__main__":
     etak_file = args.etak_file
     ndvi_file = args.ndvi_file
 
+    options = {"split_size_mb": args.split_size_mb, "split_workers": args.split_workers,
+               "output_profile": args.output_profile, "metrics": args.metrics,
+               "metrics_resolution": args.metrics_resolution, "subsets": dict(args.subset)}
+
     # Run main function
-    main(input_file, output_file, dem_file, etak_file, ndvi_file)
+    main(input_file, output_file, dem_file, etak_file, ndvi_file, options=options)
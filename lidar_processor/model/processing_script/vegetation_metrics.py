@@ -0,0 +1,97 @@
+from typing import Dict, List
+import re
+import logging
+
+import numpy as np
+from osgeo import gdal
+
+gdal.UseExceptions()
+
+# Classes left out of all metrics (low / high noise)
+noise_classes = [7, 18]
+
+nodata = -9999
+
+
+# Assign every point to a cell of the metrics grid, -1 outside the grid
+def grid_cells(points: np.ndarray, bounds: List[float], resolution: float) -> np.ndarray:
+    cols = np.floor((points["X"] - bounds[0]) / resolution).astype(np.int64)
+    rows = np.floor((bounds[3] - points["Y"]) / resolution).astype(np.int64)
+    ncols = int(round((bounds[2] - bounds[0]) / resolution))
+    nrows = int(round((bounds[3] - bounds[1]) / resolution))
+    inside = (cols >= 0) & (cols < ncols) & (rows >= 0) & (rows < nrows)
+    return np.where(inside, rows * ncols + cols, -1)
+
+
+# Percentile of the values of every cell (linear interpolation, like np.percentile)
+def cell_percentile(cells: np.ndarray, values: np.ndarray, q: float, size: int) -> np.ndarray:
+    order = np.lexsort((values, cells))
+    cells, values = cells[order], values[order]
+    counts = np.bincount(cells, minlength=size)
+    starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+    result = np.full(size, nodata, dtype=np.float32)
+    filled = counts > 0
+    position = starts[filled] + (counts[filled] - 1) * q / 100
+    low = np.floor(position).astype(np.int64)
+    high = np.ceil(position).astype(np.int64)
+    result[filled] = values[low] + (values[high] - values[low]) * (position - low)
+    return result
+
+
+# Compute the metric grids of a tile from its reclassified points in one pass
+def grid_metrics(
+        points: np.ndarray, bounds: List[float], resolution: float, metrics: List[str], cover_height: float = 1.3
+    ) -> Dict[str, np.ndarray]:
+
+    ncols = int(round((bounds[2] - bounds[0]) / resolution))
+    nrows = int(round((bounds[3] - bounds[1]) / resolution))
+    size = ncols * nrows
+
+    # Drop noise and points outside of the grid
+    cells = grid_cells(points, bounds, resolution)
+    keep = (cells >= 0) & ~np.isin(points["Classification"], noise_classes)
+    cells = cells[keep]
+    hag = points["HeightAboveGround"][keep].astype(np.float64)
+    first = points["ReturnNumber"][keep] == 1
+    counts = np.bincount(cells, minlength=size)
+
+    grids = {}
+    for metric in metrics:
+        percentile = re.fullmatch(r"p(\d{1,2})", metric)
+        if (percentile is not None):
+            # Height percentile of all returns
+            grid = cell_percentile(cells, hag, float(percentile.group(1)), size)
+        elif (metric == "max"):
+            grid = np.full(size, -np.inf)
+            np.maximum.at(grid, cells, hag)
+            grid[counts == 0] = nodata
+        elif (metric == "cover"):
+            # Share of first returns above cover_height
+            first_counts = np.bincount(cells[first], minlength=size)
+            above = np.bincount(cells[first & (hag > cover_height)], minlength=size)
+            grid = np.where(first_counts > 0, above / np.maximum(first_counts, 1), nodata)
+        elif (metric == "density"):
+            # Points per square meter
+            grid = counts / resolution ** 2
+        else:
+            raise ValueError(f"unknown metric {metric}")
+        grids[metric] = grid.astype(np.float32).reshape(nrows, ncols)
+    return grids
+
+
+# Write the metric grids as bands of one GeoTIFF (COG when the driver is available)
+def write_metrics(
+        grids: Dict[str, np.ndarray], bounds: List[float], resolution: float, output_file: str, srs_wkt: str
+    ) -> None:
+    nrows, ncols = next(iter(grids.values())).shape
+    mem = gdal.GetDriverByName("MEM").Create("", ncols, nrows, len(grids), gdal.GDT_Float32)
+    mem.SetGeoTransform([bounds[0], resolution, 0, bounds[3], 0, -resolution])
+    mem.SetProjection(srs_wkt)
+    for i, (metric, grid) in enumerate(grids.items()):
+        band = mem.GetRasterBand(i + 1)
+        band.SetDescription(metric)
+        band.SetNoDataValue(nodata)
+        band.WriteArray(grid)
+    driver = "COG" if (gdal.GetDriverByName("COG") is not None) else "GTiff"
+    gdal.GetDriverByName(driver).CreateCopy(output_file, mem, options=["COMPRESS=DEFLATE"])
+    logging.debug(f"metrics: {output_file} {list(grids.keys())}")
@@ -1,14 +1,16 @@
 from typing import List, Tuple
 from lidar_processor.dependencies.db import Database
+from lidar_processor.dependencies.storage import get_storage
+from lidar_processor.dependencies.mapsheet import spatial_order
+from lidar_processor.dependencies.retry import failure, retry_call
+from lidar_processor.dependencies.metrics import registry
+from lidar_processor.dependencies.partition import partition_filter
 # from lidar_processor.dependencies.threading import ReturnValueThread
 
 from concurrent.futures import ThreadPoolExecutor
 import logging
-import tempfile
 import requests
 import urllib3
-import gcsfs
-import io
 from urllib.parse import quote
 from tqdm import tqdm
 from datetime import datetime, timezone
@@ -19,44 +21,51 @@ from psycopg import errors as stateError
 laz_url = "https://geoportaal.maaamet.ee/index.php?lang_id=1&plugin_act=otsing&kaardiruut={mapsheet}&andmetyyp=lidar_laz_{type}&dl=1&f={mapsheet}_{year}_{type}.laz&page_id=614"
 dem_url = "https://geoportaal.maaamet.ee/index.php?lang_id=1&plugin_act=otsing&kaardiruut={mapsheet}&andmetyyp=dem_1m_geotiff&dl=1&f={mapsheet}_{type}_1m{year}.tif&page_id=614"
 
+# shared by all download threads of the process
+http = urllib3.PoolManager(maxsize=10)
+
 
 def download_worker(url: str, filepath: str) -> int:
     try:
         #  logging.info(f'download_worker: downloading {filepath.split("/")[-1]}')
         logging.debug(f'download_worker: {url}')
-        http = urllib3.PoolManager()
-        r = http.requests("GET", url, retries=15)
-        if (r.headers['content-type'].lower() == 'application/octet-stream'):
-            if (filepath.startswith('gs://')):
-                fs = gcsfs.GCSFileSystem()
-                temp = tempfile.NamedTemporaryFile('wb')
-                temp.write(r.data)
-                fs.put_file(temp.name, filepath)
+        r = http.request("GET", url, retries=15, preload_content=False)
+        try:
+            if (r.headers['content-type'].lower() == 'application/octet-stream'):
+                # stream the response body straight into the storage backend
+                with get_storage(filepath).open(filepath, 'wb') as f:
+                    for chunk in r.stream(2**20):
+                        f.write(chunk)
+                        registry.inc('download_bytes_total', len(chunk))
+                #  logging.info(f'download_worker: download {filepath.split("/")[-1]} done')
+                return (1, datetime.now(timezone.utc))
             else:
-                with open(filepath, 'wb') as f:
-                    f.write(r.content)
-            #  logging.info(f'download_worker: download {filepath.split("/")[-1]} done')
-            return (1, datetime.now(timezone.utc))
-        else:
-            logging.error(f'download_worker: {filepath.split("/")[-1]} repsones is not in correct format. {url}')
-            return (-1, datetime.now(timezone.utc))
+                logging.error(f'download_worker: {filepath.split("/")[-1]} repsones is not in correct format. {url}')
+                # transient when the geoportal answers with a server error page
+                return (-1, datetime.now(timezone.utc), r.status >= 500)
+        finally:
+            # the connection goes back to the shared pool also when the stream or the upload fails
+            r.release_conn()
 
     except requests.exceptions.RequestException as e:
         logging.error(f'download_worker: requests failed: {e}')
-        return (-1, datetime.now(timezone.utc))
+        return failure(-1, e)
     except urllib3.exceptions.RequestError as e:
         logging.error(f'download_worker: requests failed: {e}')
-        return (-1, datetime.now(timezone.utc))
+        return failure(-1, e)
     except urllib3.exceptions.MaxRetryError as e:
         logging.error(f'download_worker: requests failed: {e}')
-        return (-1, datetime.now(timezone.utc))
+        return failure(-1, e)
+    except urllib3.exceptions.HTTPError as e:
+        logging.error(f'download_worker: requests failed: {e}')
+        return failure(-1, e)
     except OSError as e:
         logging.error(f'download_worker: upload file failed: {e}')
-        return (-1, datetime.now(timezone.utc))
+        return failure(-1, e)
 
 
 def download_files(db: Database, filename_list: List[str],
-                   filepath: str, table='laz_files') -> List[str]:
+                   filepath: str, table='laz_files', retries: int = 3, backoff: float = 30) -> List[str]:
     # entry action null
     # do action
     pos = 2 if filepath.startswith('gs://') else 1
@@ -67,10 +76,15 @@ def download_files(db: Database, filename_list: List[str],
         cur = db.conn.cursor()
         with db.conn.transaction():
             # lock laz_files, dem_files rows with state=0 (created) for update.
-            cur.execute(f'select filename from {table} where filename = ANY(%(laz_filenames)s) and state=0 for update nowait;',
-                        {'laz_filenames': filename_list})
+            # dem sheets are shared: rows locked by a concurrent job are downloaded by that job
+            lock = 'for update nowait' if (table == 'laz_files') else 'for update skip locked'
+            partition, partition_data = partition_filter(table, filename_list)
+            cur.execute(f'select filename from {table} where filename = ANY(%(laz_filenames)s) and state=0 and {partition} {lock};',
+                        {'laz_filenames': filename_list, **partition_data})
             file_list = [i[0] for i in cur.fetchall()]
             if (table == 'laz_files'):
+                # neighbouring tiles are downloaded together
+                file_list = [file_list[i] for i in spatial_order([int(f.split('_')[0]) for f in file_list])]
                 downloadurls = [laz_url.format(mapsheet=name.split('.')[0].split('_')[0],
                                                type=name.split('.')[0].split('_')[2],
                                                year=name.split('.')[0].split('_')[1]) for name in file_list]
@@ -85,13 +99,25 @@ def download_files(db: Database, filename_list: List[str],
             logging.info('download_files: threads')
             # to avoid too many concurrent download which may get blocked.
             download_batch = 10
+            stage = f'download_{table}'
+            registry.set('queue_depth', len(downloadurls), stage=stage)
+
+            def download_task(url: str, path: str) -> Tuple:
+                registry.add('active_workers', 1, stage=stage)
+                # transient failures are retried in the thread with backoff
+                result = retry_call(download_worker, (url, path), retries, backoff)
+                registry.add('active_workers', -1, stage=stage)
+                registry.add('queue_depth', -1, stage=stage)
+                registry.inc('tiles_total' if (result[0] > 0) else 'failures_total', stage=stage)
+                return result
+
             with ThreadPoolExecutor(max_workers=download_batch) as executor:
-                download_result = list(tqdm(executor.map(download_worker, downloadurls, download_paths), total=len(downloadurls)))
+                download_result = list(tqdm(executor.map(download_task, downloadurls, download_paths), total=len(downloadurls)))
 
-            failed = [filename_list[i] for i, r in enumerate(download_result) if (r[0] == -1)]
+            failed = [file_list[i] for i, r in enumerate(download_result) if (r[0] == -1)]
             logging.info(f'download_files: all threads completed , failed: {len(failed)}')
             # update download state to laz_files and dem_files
-            data = [(result[0], bucket, download_path, result[1], quote(downloadurls[i]), filename_list[i]) for i, result in enumerate(download_result)]
+            data = [(result[0], bucket, download_path, result[1], quote(downloadurls[i]), file_list[i]) for i, result in enumerate(download_result)]
             statement = f'update {table} set (state, bucket, path, download_time, download_url) = (%s,%s,%s,%s,%s) where filename=%s'
             cur.executemany(statement, data)
             logging.info('download_files: update state completed.')
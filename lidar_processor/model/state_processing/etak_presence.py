@@ -0,0 +1,88 @@
+from typing import Dict, List
+from lidar_processor.dependencies.db import Database
+from lidar_processor.dependencies.storage import gdal_path
+from lidar_processor.dependencies.mapsheet import mapsheet_bounds
+
+import logging
+from psycopg import Error as dbError
+
+# overlays of the reclassification pipeline: layers and attribute filter (setup/db_scripts/etak_overlays.sql)
+overlay_layers = {'sea': (['E_201_meri_a'], None),
+                  'powerline': (['E_601_elektriliin_j'], 'nimipinge IN (110, 220, 330)'),
+                  'water': (['E_202_seisuveekogu_a', 'E_203_vooluveekogu_a'], None),
+                  'building': (['E_401_hoone_ka', 'E_403_muu_rajatis_ka'], None)}
+
+# the tile is taken from its map sheet, the margin covers points on the sheet edges
+tile_margin = 50
+
+# PostGIS is usually installed in public, the connection only searches the processing schema
+postgis_search_path = "select set_config('search_path', current_setting('search_path') || ', public', true)"
+
+
+def load_etak(db: Database, etak_file: str, edition: str) -> Dict[str, int]:
+    """Import the overlay layers of an ETAK GPKG into etak_overlays, replacing the rows of the edition."""
+    from osgeo import ogr
+    ogr.UseExceptions()
+    ds = ogr.Open(gdal_path(etak_file))
+    counts = {}
+    cur = db.conn.cursor()
+    with db.conn.transaction():
+        cur.execute(postgis_search_path)
+        cur.execute('delete from etak_overlays where edition = %(edition)s', {'edition': edition})
+        cur.execute('create temporary table etak_staging (overlay text, layer text, wkb bytea) on commit drop')
+        with cur.copy('copy etak_staging (overlay, layer, wkb) from stdin') as copy:
+            for overlay, (layers, where) in overlay_layers.items():
+                for name in layers:
+                    layer = ds.GetLayerByName(name)
+                    if (layer is None):
+                        logging.warning(f'load_etak: {name} not found in {etak_file}')
+                        continue
+                    layer.SetAttributeFilter(where)
+                    counts[name] = 0
+                    for feature in layer:
+                        geometry = feature.GetGeometryRef()
+                        if (geometry is not None):
+                            copy.write_row((overlay, name, bytes(geometry.ExportToWkb())))
+                            counts[name] += 1
+        cur.execute('insert into etak_overlays (edition, overlay, layer, geom) \
+                     select %(edition)s, overlay, layer, ST_GeomFromWKB(wkb, 3301) from etak_staging', {'edition': edition})
+        cur.execute('analyze etak_overlays')
+    logging.info(f'load_etak: {edition}: {counts}')
+    return counts
+
+
+def etak_presence(db: Database, edition: str, filenames: List[str]) -> Dict[str, List[str]] | None:
+    """Overlays having features in each tile, for the whole batch in one query.
+
+    None when the edition is not loaded or PostGIS fails, the pipeline then checks the GPKG per tile.
+    """
+    if (len(filenames) == 0):
+        return {}
+    bounds = [mapsheet_bounds(int(f.split('_')[0])) for f in filenames]
+    statement = 'select t.filename, o.overlay \
+                 from unnest(%(filenames)s::text[], %(minx)s::float8[], %(miny)s::float8[], %(maxx)s::float8[], %(maxy)s::float8[]) \
+                 as t(filename, minx, miny, maxx, maxy) \
+                 cross join unnest(%(overlays)s::text[]) as o(overlay) \
+                 where exists (select 1 from etak_overlays e where e.edition = %(edition)s and e.overlay = o.overlay \
+                               and ST_Intersects(e.geom, ST_MakeEnvelope(t.minx, t.miny, t.maxx, t.maxy, 3301)))'
+    data = {'filenames': filenames, 'edition': edition, 'overlays': list(overlay_layers.keys()),
+            'minx': [b[0] - tile_margin for b in bounds], 'miny': [b[1] - tile_margin for b in bounds],
+            'maxx': [b[2] + tile_margin for b in bounds], 'maxy': [b[3] + tile_margin for b in bounds]}
+    cur = db.conn.cursor()
+    try:
+        with db.conn.transaction():
+            cur.execute(postgis_search_path)
+            cur.execute('select exists (select 1 from etak_overlays where edition = %(edition)s)', {'edition': edition})
+            if (not cur.fetchone()[0]):
+                logging.warning(f'etak_presence: {edition} is not loaded, run etak_postgis.py')
+                return None
+            cur.execute(statement, data)
+            rows = cur.fetchall()
+    except dbError as e:
+        logging.warning(f'etak_presence: query failed, checking the ETAK file per tile: {e}')
+        return None
+    presence: Dict[str, List[str]] = {f: [] for f in filenames}
+    for filename, overlay in rows:
+        presence[filename].append(overlay)
+    logging.info(f'etak_presence: {edition}: {len(filenames)} tiles, {len(rows)} overlays present')
+    return presence
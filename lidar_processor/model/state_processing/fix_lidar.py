@@ -1,49 +1,106 @@
-from typing import List, Tuple
+from typing import Any, Dict, List, Tuple
+from functools import partial
 from lidar_processor.dependencies.db import Database
-from lidar_processor.dependencies.threading import ReturnValueThread
-from lidar_processor.model.processing_script.fix_laz_file import main as fix_process
+from lidar_processor.dependencies.staging import UploadStager
+from lidar_processor.dependencies.pool import TaskPool
+from lidar_processor.dependencies.codec import codec_threads
+from lidar_processor.dependencies.mapsheet import spatial_order
+from lidar_processor.dependencies.storage import get_storage
+from lidar_processor.dependencies.fingerprint import code_version, fingerprint
+from lidar_processor.dependencies.metrics import registry
+from lidar_processor.dependencies.profiling import profiled, profile_tiles
+from lidar_processor.dependencies.partition import partition_filter
 
 import logging
-import os
-from tqdm import tqdm
-import concurrent.futures
-from multiprocessing import cpu_count
 from datetime import datetime, timezone
 from psycopg import Error as dbError
 from psycopg import errors as stateError
 
+# fix killed by the per-file timeout (also in the heavy lane)
+fix_timeout_state = -12
 
-def fix_lidar(db: Database, laz_list: List[str], fixed_filepath: str, to_crs: str) -> Tuple[List[str], List[str], List[str]] | None:
+def laz_fingerprints(laz_set: List[Tuple], to_crs: str, dedup: Dict[str, Any] | None = None) -> List[str | None]:
+    # fixed output depends on the downloaded object, the target crs, the dedup options and the fix script
+    inputs = [r[2] + '/' + r[3] + '/' + r[0] for r in laz_set]
+    versions = get_storage(inputs[0]).versions(inputs)
+    code = code_version('lidar_processor.model.processing_script.fix_laz_file')
+    # the chunk size only changes how the duplicates are searched, not which points are removed
+    dedup = {k: v for k, v in dedup.items() if (k != 'chunk_size')} if (dedup is not None) else None
+    return [fingerprint(input=v, to_crs=to_crs, dedup=dedup, code=code) if (v is not None) else None for v in versions]
+
+
+def fix_lidar(db: Database, laz_list: List[str], fixed_filepath: str, to_crs: str, stager: UploadStager, pool: TaskPool,
+              codec: str = 'default', profile: Dict[str, Any] | None = None,
+              dedup: Dict[str, Any] | None = None) -> Tuple[List[str], List[str], List[str]] | None:
+    # laspy / pyproj are only loaded when there is something to fix
+    from lidar_processor.model.processing_script.fix_laz_file import main as fix_process
     cur = db.conn.cursor()
-    statement = 'update laz_files set (state, processing_time, to_crs) = (%s,%s,%s) where filename=%s'
+    statement = 'update laz_files set (state, processing_time, to_crs, fix_fingerprint, duplicates_removed) = (%s,%s,%s,%s,%s) where filename=%s'
     try:
         with db.conn.transaction():
             # lock laz_files rows with state=1 (downloaded) for update.
-            cur.execute('select filename,laz_map_sheet,bucket,path from laz_files where filename = ANY(%(laz_filenames)s) and state=1 for update nowait;',
-                        {'laz_filenames': laz_list})
+            partition, partition_data = partition_filter('laz_files', laz_list)
+            cur.execute(f'select filename,laz_map_sheet,bucket,path,fix_fingerprint from laz_files where filename = ANY(%(laz_filenames)s) and state=1 and {partition} for update nowait;',
+                        {'laz_filenames': laz_list, **partition_data})
             laz_set = cur.fetchall()
-            cur.execute('select filename from laz_files where filename = ANY(%(laz_filenames)s) and state=2 for update nowait;',
-                        {'laz_filenames': laz_list})
+            laz_set = [laz_set[i] for i in spatial_order([r[1] for r in laz_set])]
+            cur.execute(f'select filename from laz_files where filename = ANY(%(laz_filenames)s) and state=2 and {partition} for update nowait;',
+                        {'laz_filenames': laz_list, **partition_data})
             excluded_laz_set = [r[0] for r in cur.fetchall()]
             if (len(excluded_laz_set) == len(laz_list)):
                 logging.info(f'fix_lidar: nothing to fix : excluded: {len(excluded_laz_set)}')
                 return ([], [], [], excluded_laz_set)
+            if (len(laz_set) > 0):
+                # skip the tiles whose fixed output exists and was made from the same input, crs and code
+                fingerprints = laz_fingerprints(laz_set, to_crs, dedup)
+                targets = [fixed_filepath + '/' + r[0].replace('.laz', '_fixed.laz') for r in laz_set]
+                exists = get_storage(targets[0]).exists(targets)
+                unchanged = [r[0] for i, r in enumerate(laz_set) if ((fingerprints[i] is not None) and (fingerprints[i] == r[4]) and exists[i])]
+                if (len(unchanged) > 0):
+                    logging.info(f'fix_lidar: {len(unchanged)} fixed files are up to date, skipped')
+                    cur.executemany('update laz_files set state=2 where filename=%s', [(f,) for f in unchanged])
+                    excluded_laz_set += unchanged
+                    fingerprints = [fingerprints[i] for i, r in enumerate(laz_set) if (r[0] not in unchanged)]
+                    laz_set = [r for r in laz_set if (r[0] not in unchanged)]
+                    if (len(laz_set) == 0):
+                        return ([], [], [], excluded_laz_set)
 
             if (len(laz_set) > 0):
                 # mp = int(os.environ.get('SLURM_CPUS_PER_TASK', cpu_count() - 1))
                 # logging.info(f'fix_lidar: parallel process {mp}')
-                with concurrent.futures.ThreadPoolExecutor() as executor:
-                    params = [(r[2] + '/' + r[3] + '/' + r[0], fixed_filepath + '/' + r[0].replace('.laz', '_fixed.laz'), to_crs)
-                              for r in laz_set]
-                    fix_result = list(tqdm(executor.map(fix_process, *zip(*params)), total=len(params)))
-                fix_failed = [laz_set[i][0] for i, r in enumerate(fix_result) if (r[0] == -2)]
+                # fixed files are written to local scratch and uploaded in the background
+                targets = [fixed_filepath + '/' + r[0].replace('.laz', '_fixed.laz') for r in laz_set]
+                logging.info(f'fix_lidar: codec {codec}, {codec_threads(min(pool.workers, len(laz_set)))} threads per worker')
+                params = [(r[2] + '/' + r[3] + '/' + r[0], stager.local_path(targets[i]), to_crs, codec, 1, dedup)
+                          for i, r in enumerate(laz_set)]
+
+                def prepare(i: int, args: Tuple) -> Tuple:
+                    # codec threads of the running lane, the heavy lane has fewer workers and more cores each
+                    return (*args[:4], codec_threads(min(pool.lane_workers, len(laz_set))), *args[5:])
+                fn = fix_process
+                if (profile is not None):
+                    fn = partial(profiled, fix_process, profile['dir'], profile_tiles([p[0] for p in params], profile['count']))
+                def on_done(i: int, result: Tuple) -> None:
+                    if (result[0] > 0):
+                        registry.inc('points_total', result[3], stage=pool.name)
+                        registry.inc('duplicates_removed_total', result[2], stage=pool.name)
+
+                fix_result = stager.map(pool, fn, params, [[(p[1], targets[i])] for i, p in enumerate(params)],
+                                        prepare=prepare, on_done=on_done)
+                fix_result = [r if (r is not None) else (fix_timeout_state if (i in pool.timed_out) else -2, datetime.now(timezone.utc))
+                              for i, r in enumerate(fix_result)]
+                fix_failed = [laz_set[i][0] for i, r in enumerate(fix_result) if (r[0] in (-2, fix_timeout_state))]
                 fixed = [laz_set[i][0] for i, r in enumerate(fix_result) if (r[0] == 2)]
                 not_found = list(set(laz_list) - set(fixed) - set(fix_failed) - set(excluded_laz_set))
-                data = [(result[0], result[1], to_crs, laz_set[i][0]) for i, result in enumerate(fix_result)]
+                data = [(result[0], result[1], to_crs, fingerprints[i] if (result[0] == 2) else None,
+                         result[2] if (result[0] == 2) else None, laz_set[i][0])
+                        for i, result in enumerate(fix_result)]
+                if (dedup is not None):
+                    logging.info(f'fix_lidar: {sum(r[2] for r in fix_result if (r[0] == 2))} duplicate points removed')
                 logging.info(f'fix_lidar: all threads completed , fixed : {len(fixed)}, fix failed: {len(fix_failed)}, not found: {len(not_found)}, excluded: {len(excluded_laz_set)}')
                 cur.executemany(statement, data)
                 if (len(not_found) > 0):
-                    data = [(-2, datetime.now(timezone.utc), to_crs, i) for i in not_found]
+                    data = [(-2, datetime.now(timezone.utc), to_crs, None, None, i) for i in not_found]
                     cur.executemany(statement, data)
                 return (fixed, fix_failed, not_found, excluded_laz_set)
             else:
@@ -54,7 +111,7 @@ def fix_lidar(db: Database, laz_list: List[str], fixed_filepath: str, to_crs: st
         raise
     except dbError as e:
         logging.error(f'fix_lidar: db error {e}')
-        data = [(-2, datetime.now(timezone.utc), to_crs, i) for i in laz_set]
+        data = [(-2, datetime.now(timezone.utc), to_crs, None, None, i[0]) for i in laz_set]
         cur.executemany(statement, data)
         raise
 
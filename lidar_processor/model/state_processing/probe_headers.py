@@ -0,0 +1,72 @@
+from typing import Any, Callable, Dict, List
+from lidar_processor.dependencies.db import Database
+from lidar_processor.dependencies.storage import get_storage
+from lidar_processor.dependencies.las_header import probe
+from lidar_processor.dependencies.partition import partition_filter
+from lidar_processor.model.state_processing.download_files import http, laz_url
+
+from concurrent.futures import ThreadPoolExecutor
+import logging
+import urllib3
+from psycopg import Error as dbError
+
+
+def http_reader(url: str) -> Callable[[int, int], bytes]:
+    def read(start: int, length: int) -> bytes:
+        r = http.request("GET", url, headers={'Range': f'bytes={start}-{start + length - 1}'}, retries=3, preload_content=False)
+        try:
+            if (r.headers.get('content-type', '').lower() != 'application/octet-stream'):
+                raise ValueError(f'response is not a file {url}')
+            if (r.status == 206):
+                return r.read()
+            # no range support: read up to the range from the start of the body and drop the connection
+            data = r.read(start + length)
+            return data[start:]
+        finally:
+            r.close()
+    return read
+
+
+def probe_worker(path: str, url: str | None) -> Dict[str, Any] | None:
+    # the stored object when downloaded, the geoportal otherwise
+    try:
+        if (path is not None):
+            storage = get_storage(path)
+            return probe(lambda start, length: storage.read_range(path, start, length))
+        return probe(http_reader(url))
+    except (OSError, ValueError, urllib3.exceptions.HTTPError) as e:
+        logging.warning(f'probe_headers: {(path or url).split("/")[-1]} failed: {e}')
+        return None
+
+
+def probe_headers(db: Database, laz_list: List[str]) -> List[str]:
+    """Read the LAS header and VLRs of the tiles not probed yet with range requests, no point data is moved.
+
+    Stores point_count, bounds, las_version, point_format and has_crs in laz_files, returns the probed filenames.
+    """
+    if (len(laz_list) == 0):
+        return []
+    partition, partition_data = partition_filter('laz_files', laz_list)
+    try:
+        result = db.execute_sql(f'select filename, bucket, path from laz_files where filename = ANY(%(filename)s) and point_count is null and {partition}',
+                                {'filename': laz_list, **partition_data})
+    except dbError as e:
+        logging.error(f'probe_headers: select failed {e}')
+        raise
+    if (len(result) == 0):
+        return []
+    paths = [(r[1] + '/' + r[2] + '/' + r[0]) if (r[1] is not None) else None for r in result]
+    urls = [laz_url.format(mapsheet=r[0].split('.')[0].split('_')[0], type=r[0].split('.')[0].split('_')[2],
+                           year=r[0].split('.')[0].split('_')[1]) for r in result]
+    logging.info(f'probe_headers: {len(result)} tiles, {sum(p is not None for p in paths)} from storage')
+    # same concurrency as the downloads, the geoportal blocks more
+    with ThreadPoolExecutor(max_workers=10) as executor:
+        headers = list(executor.map(probe_worker, paths, urls))
+    data = [(h['point_count'], h['bounds'], h['las_version'], h['point_format'], h['has_crs'], result[i][0])
+            for i, h in enumerate(headers) if (h is not None)]
+    if (len(data) > 0):
+        cur = db.conn.cursor()
+        with db.conn.transaction():
+            cur.executemany('update laz_files set (point_count, bounds, las_version, point_format, has_crs) = (%s,%s,%s,%s,%s) where filename=%s', data)
+    logging.info(f'probe_headers: {len(data)} probed, {len(headers) - len(data)} failed')
+    return [d[-1] for d in data]
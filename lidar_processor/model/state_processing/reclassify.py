@@ -1,14 +1,21 @@
-from typing import List, Tuple
+from typing import Any, Dict, List, Tuple
 from lidar_processor.dependencies.db import Database
-from lidar_processor.dependencies.threading import ReturnValueThread
-from lidar_processor.model.state_processing.records_creation import dem_file_naming
-from lidar_processor.model.processing_script.reclassify_laz_file import main as reclassify_process
+from lidar_processor.dependencies.staging import UploadStager
+from lidar_processor.dependencies.pool import TaskPool
+from lidar_processor.dependencies.codec import codec_threads
+from lidar_processor.dependencies.mapsheet import spatial_order, mapsheet_bounds
+from lidar_processor.dependencies.prefetch import AncillaryPrefetcher
+from lidar_processor.dependencies.storage import sibling_path, get_storage
+from lidar_processor.dependencies.fingerprint import code_version, fingerprint
+from lidar_processor.dependencies.metrics import registry
+from lidar_processor.dependencies.profiling import profiled, profile_tiles
+from lidar_processor.dependencies.partition import partition_filter, dem_edition
+from lidar_processor.model.state_processing.etak_presence import etak_presence
+from lidar_processor.schemas.config import Campaign
 
-import concurrent.futures
-from multiprocessing import cpu_count
+from functools import partial
 import os
 import logging
-from tqdm import tqdm
 from datetime import datetime, timezone
 from psycopg import Error as dbError
 from psycopg import errors as stateError
@@ -23,24 +30,52 @@ etak_mapping = {2017: "ETAK_EESTI_GPKG_2017_12_15",
                 2023: "ETAK_EESTI_GPKG_2024_01_01",
                 2024: "ETAK_EESTI_GPKG_2025_01_01"}
 
+# reclassification killed by the per-file timeout (also in the heavy lane)
+reclassify_timeout_state = -13
+
+# options changing the content of the outputs, the others (split, streaming, codec) only change how they are made
+output_options = ['output_profile', 'metrics', 'metrics_resolution', 'cover_height', 'subsets']
+
 ndvi_mapping = {'mets': '{year}/est_s2_ndvi_{year}-06-01_{year}-08-31_cog.tif',
                 'tava': '{year}/est_s2_ndvi_{year}-04-01_{year}-05-31_cog.tif'}
 
 
-def reclassify(db: Database, laz_list: List[str], laz_year: int, laz_type: str, dem_year: int, laz_fixed_filepath: str,
-               reclassify_path: str, etak_path: str, ndvi_path: str):
-    # determinate the file name of dem by year
-    etak_folder = etak_mapping.get(laz_year)
-    statement = 'update laz_files set (state, processing_time, etak_path, reclassify_path, dem_path, ndvi_path) = (%s,%s,%s,%s,%s,%s) where filename=%s'
-    if (etak_folder is None):
+def reclassify_fingerprints(filenames: List[str], dem_filenames: List[str], laz_fixed_filepath: str, etak_full_path: str,
+                            ndvi_full_path: str, options: Dict[str, Any] | None) -> List[str | None]:
+    # reclassified output depends on the fixed file, ETAK edition, DEM sheet, NDVI, rules (code) and output options
+    inputs = [laz_fixed_filepath + '/' + f.replace('.laz', '_fixed.laz') for f in filenames]
+    versions = get_storage(inputs[0]).versions(inputs)
+    code = code_version('lidar_processor.model.processing_script.reclassify_laz_file',
+                        'lidar_processor.model.processing_script.vegetation_metrics')
+    outputs = {k: (options or {}).get(k) for k in output_options}
+    return [fingerprint(input=inputs[i], version=v, etak=etak_full_path, dem=dem_filenames[i], ndvi=ndvi_full_path,
+                        code=code, options=outputs) if (v is not None) else None
+            for i, v in enumerate(versions)]
+
+
+def reclassify(db: Database, laz_list: List[str], campaigns: List[Campaign], laz_fixed_filepath: str,
+               reclassify_path: str, etak_path: str, ndvi_path: str, stager: UploadStager,
+               pool: TaskPool, options: Dict[str, Any] | None = None, prefetch: Dict[str, Any] | None = None,
+               profile: Dict[str, Any] | None = None, etak_postgis: bool = False):
+    # pdal / gdal are only loaded when there is something to reclassify
+    from lidar_processor.model.processing_script.reclassify_laz_file import main as reclassify_process
+    # ETAK edition of every campaign
+    etak_folders = [c.etak_edition or etak_mapping.get(c.laz_year) for c in campaigns]
+    statement = 'update laz_files set (state, processing_time, etak_path, reclassify_path, dem_path, ndvi_path, metrics_path, reclassify_fingerprint) = (%s,%s,%s,%s,%s,%s,%s,%s) where filename=%s'
+    metrics = len((options or {}).get('metrics') or []) > 0
+    subsets = list(((options or {}).get('subsets') or {}).keys())
+    subset_statement = 'insert into laz_subsets (filename, subset, path, point_count) values (%s,%s,%s,%s) \
+                        on conflict (filename, subset) do update set (path, point_count) = (excluded.path, excluded.point_count)'
+    if (None in etak_folders):
         logging.error('reclassify: etak mapping failed.')
         raise ValueError('reclassify: etak mapping failed.')
     cur = db.conn.cursor()
     try:
         with db.conn.transaction():
             # lock laz_files rows with state=2 (fixed) for update.
-            cur.execute('select filename,laz_map_sheet,bucket from laz_files where filename = ANY(%(laz_filenames)s) and state=2 for update nowait;',
-                        {'laz_filenames': laz_list})
+            partition, partition_data = partition_filter('laz_files', laz_list)
+            cur.execute(f'select filename,laz_map_sheet,bucket from laz_files where filename = ANY(%(laz_filenames)s) and state=2 and {partition} for update nowait;',
+                        {'laz_filenames': laz_list, **partition_data})
             laz_set = cur.fetchall()
             if (len(laz_set) > 0):
                 # select corresponding dem_files by joining mapsheets_mapping
@@ -48,41 +83,117 @@ def reclassify(db: Database, laz_list: List[str], laz_year: int, laz_type: str,
                 # where dem_state = 1 (downloaded) and laz_state = 2 (fixed)
                 filtered_laz_list = [i[0] for i in laz_set]
                 merged_statement = "select laz_files.filename, laz_files.bucket, laz_files.state, laz_files.laz_map_sheet, \
-                                    dem_filename, dem_vrt_path, dem_state, nr, nr10000 \
+                                    dem_filename, dem_vrt_path, dem_state, nr, nr10000, laz_files.reclassify_fingerprint, laz_files.point_count \
                              from laz_files LEFT join \
                              (select  dem_files.filename as dem_filename, dem_files.vrt_path as dem_vrt_path, dem_files.state as dem_state,\
                              dem_files.year as dem_year, nr, nr10000 from dem_files\
                              LEFT join mapsheets_mapping on dem_files.dem_map_sheet = mapsheets_mapping.nr10000) as tmp \
                              on laz_files.laz_map_sheet = tmp.nr  \
-                             where tmp.dem_state=1 and laz_files.state = 2 and laz_files.filename = ANY (%(laz_filenames)s)"
-                if (dem_year > 2020):
-                    merged_statement += ' and tmp.dem_year = %(dem_year)s'
-                    cur.execute(merged_statement, {'laz_filenames': filtered_laz_list, 'dem_year': dem_year})
-                else:
-                    merged_statement += "and tmp.dem_filename like '%%dem%%'"
-                    cur.execute(merged_statement, {'laz_filenames': filtered_laz_list})
-                merged_set = cur.fetchall()
-                etak_full_path = etak_path + '/' + etak_folder + '/' + etak_filename
-                ndvi_full_path = ndvi_path + '/' + ndvi_mapping[laz_type].format(year=laz_year)
+                             where tmp.dem_state=1 and laz_files.state = 2 and laz_files.filename = ANY (%(laz_filenames)s) \
+                             and tmp.dem_year = %(dem_year)s and laz_files.year = %(laz_year)s and laz_files.laz_type = %(laz_type)s"
+                merged_set = []
+                for c, etak_folder in zip(campaigns, etak_folders):
+                    # the ETAK edition and NDVI season of the campaign are appended to its rows
+                    etak_full_path = etak_path + '/' + etak_folder + '/' + etak_filename
+                    ndvi_full_path = ndvi_path + '/' + ndvi_mapping[c.laz_type].format(year=c.laz_year)
+                    cur.execute(merged_statement, {'laz_filenames': filtered_laz_list, 'dem_year': dem_edition(c.dem_year),
+                                                   'laz_year': c.laz_year, 'laz_type': c.laz_type})
+                    merged_set += [m + (etak_full_path, ndvi_full_path) for m in cur.fetchall()]
+                # tiles of the same DEM sheet run back-to-back, the sheets follow a Hilbert curve and the campaigns
+                # of a map sheet follow each other, so its DEM, ETAK and cached windows are loaded once
+                merged_set = [merged_set[i] for i in spatial_order([m[7] for m in merged_set], {m[7]: m[8] for m in merged_set})]
                 if (len(merged_set) > 0):
-                    mp = int(os.environ.get('SLURM_CPUS_PER_TASK', cpu_count() - 1))
-                    logging.info(f'reclassify: parallel process {mp}')
-                    with concurrent.futures.ProcessPoolExecutor(mp) as executor:
-                        params = [(laz_fixed_filepath + '/' + m[0].replace('.laz', '_fixed.laz'),
-                                  reclassify_path + '/' + m[0].replace('.laz', '_reclassified.laz'),
-                                  m[5],
-                                  etak_full_path, ndvi_full_path, False) for m in merged_set]
-                        reclassify_result = list(tqdm(executor.map(reclassify_process, *zip(*params)), total=len(params)))
-                    data = [(result[0], result[1], etak_full_path, reclassify_path + '/' + merged_set[i][0].replace('.laz', '_reclassified.laz'),
-                            merged_set[i][5], ndvi_full_path,
+                    # skip the tiles whose outputs exist and were made from the same inputs, rules and options
+                    suffixes = (['_metrics.tif'] if (metrics) else []) + [f'_{name}.laz' for name in subsets]
+                    fingerprints = [None] * len(merged_set)
+                    for ancillary in sorted({(m[11], m[12]) for m in merged_set}):
+                        group = [i for i, m in enumerate(merged_set) if ((m[11], m[12]) == ancillary)]
+                        group_fingerprints = reclassify_fingerprints([merged_set[i][0] for i in group], [merged_set[i][4] for i in group],
+                                                                     laz_fixed_filepath, *ancillary, options)
+                        for i, f in zip(group, group_fingerprints):
+                            fingerprints[i] = f
+                    targets = [reclassify_path + '/' + m[0].replace('.laz', '_reclassified.laz') for m in merged_set]
+                    exists = get_storage(targets[0]).exists(targets + [sibling_path(t, suffix) for suffix in suffixes for t in targets])
+                    unchanged = [m[0] for i, m in enumerate(merged_set)
+                                 if ((fingerprints[i] is not None) and (fingerprints[i] == m[9]) and all(exists[i::len(merged_set)]))]
+                    if (len(unchanged) > 0):
+                        logging.info(f'reclassify: {len(unchanged)} reclassified files are up to date, skipped')
+                        cur.executemany('update laz_files set state=3 where filename=%s', [(f,) for f in unchanged])
+                        fingerprints = [fingerprints[i] for i, m in enumerate(merged_set) if (m[0] not in unchanged)]
+                        merged_set = [m for m in merged_set if (m[0] not in unchanged)]
+                    logging.info(f'reclassify: parallel process {pool.workers}')
+                    options = dict(options or {})
+                    # PDAL writes to local scratch, the upload runs in the background
+                    targets = [reclassify_path + '/' + m[0].replace('.laz', '_reclassified.laz') for m in merged_set]
+                    presence: Dict[str, List[str]] = {}
+                    if (etak_postgis):
+                        # overlay presence of the whole batch from PostGIS, the pipelines skip the per tile ETAK queries
+                        for etak_full_path in sorted({m[11] for m in merged_set}):
+                            edition = os.path.basename(os.path.dirname(etak_full_path))
+                            presence.update(etak_presence(db, edition, [m[0] for m in merged_set if (m[11] == etak_full_path)]) or {})
+                    params = [(laz_fixed_filepath + '/' + m[0].replace('.laz', '_fixed.laz'),
+                              stager.local_path(targets[i]),
+                              m[5],
+                              m[11], m[12], False,
+                              dict(options, overlays=presence[m[0]]) if (m[0] in presence) else options) for i, m in enumerate(merged_set)]
+                    # the metrics raster and the subsets are written next to the local output and uploaded with it
+                    outputs = [[(p[1], targets[i])] + [(sibling_path(p[1], suffix), sibling_path(targets[i], suffix)) for suffix in suffixes]
+                               for i, p in enumerate(params)]
+                    prefetcher = None
+                    if (prefetch is not None):
+                        # DEM / NDVI windows and ETAK subsets of the next tiles are staged locally while earlier tiles compute,
+                        # the raster window covers the queued tiles of the DEM sheet and is shared by them
+                        bounds = [mapsheet_bounds(m[7]) for m in merged_set]
+                        sheets: Dict[int, List[float]] = {}
+                        for i, m in enumerate(merged_set):
+                            b = sheets.get(m[8], bounds[i])
+                            sheets[m[8]] = [min(b[0], bounds[i][0]), min(b[1], bounds[i][1]), max(b[2], bounds[i][2]), max(b[3], bounds[i][3])]
+                        prefetcher = AncillaryPrefetcher([(bounds[i], m[5], m[11], m[12]) for i, m in enumerate(merged_set)],
+                                                         windows=[sheets[m[8]] for m in merged_set], **prefetch)
+
+                    def prepare(i: int, args: Tuple) -> Tuple | None:
+                        args = prefetcher.prepare(i, args) if (prefetcher is not None) else args
+                        if (args is None):
+                            return None
+                        # the cores of a worker in the running lane (normal or heavy) are shared by its codec threads
+                        # and, for a split tile, its split processes, so splitting never oversubscribes the node
+                        cores = codec_threads(min(pool.lane_workers, len(merged_set)), prefetch['workers'] if (prefetch is not None) else 0)
+                        return (*args[:6], dict(args[6], codec_threads=cores, split_workers=min(args[6].get('split_workers', 1), cores)))
+
+                    def on_done(i: int, result: Tuple) -> None:
+                        if (prefetcher is not None):
+                            prefetcher.release(i)
+                        if (result[0] > 0):
+                            registry.inc('points_total', result[3], stage=pool.name)
+
+                    fn = reclassify_process
+                    if (profile is not None):
+                        fn = partial(profiled, reclassify_process, profile['dir'], profile_tiles([p[0] for p in params], profile['count']))
+                    try:
+                        reclassify_result = stager.map(pool, fn, params, outputs, prepare=prepare, on_done=on_done,
+                                                       on_lost=prefetcher.release if (prefetcher is not None) else None)
+                    finally:
+                        if (prefetcher is not None):
+                            prefetcher.close()
+                    reclassify_result = [r if (r is not None) else (reclassify_timeout_state if (i in pool.timed_out) else -3,
+                                                                    datetime.now(timezone.utc))
+                                         for i, r in enumerate(reclassify_result)]
+                    data = [(result[0], result[1], merged_set[i][11], targets[i],
+                            merged_set[i][5], merged_set[i][12],
+                            sibling_path(targets[i], '_metrics.tif') if (metrics and (result[0] == 3)) else None,
+                            fingerprints[i] if (result[0] == 3) else None,
                             merged_set[i][0])
                             for i, result in enumerate(reclassify_result)]
                     cur.executemany(statement, data)
-                    reclassify_failed = [merged_set[i][0] for i, r in enumerate(reclassify_result) if (r[0] == -3)]
-                    reclassified = [merged_set[i][0] for i, r in enumerate(reclassify_result) if (r[0] == 3)]
+                    data = [(merged_set[i][0], name, sibling_path(targets[i], f'_{name}.laz'), count)
+                            for i, result in enumerate(reclassify_result) if (result[0] == 3) for name, count in result[2].items()]
+                    if (len(data) > 0):
+                        cur.executemany(subset_statement, data)
+                    reclassify_failed = [merged_set[i][0] for i, r in enumerate(reclassify_result) if (r[0] in (-3, reclassify_timeout_state))]
+                    reclassified = [merged_set[i][0] for i, r in enumerate(reclassify_result) if (r[0] == 3)] + unchanged
                     not_found = list(set(laz_list) - set(reclassified) - set(reclassify_failed))
                     if (len(not_found) > 0):
-                        data = [(-3, datetime.now(timezone.utc), etak_path, None, None, None, i) for i in not_found]
+                        data = [(-3, datetime.now(timezone.utc), etak_path, None, None, None, None, None, i) for i in not_found]
                         cur.executemany(statement, data)
                     logging.info(f'reclassify: all threads completed , fixed : {len(reclassified)}, fix failed: {len(reclassify_failed)}, not found: {len(not_found)}')
                     return (reclassified, reclassify_failed, not_found)
@@ -96,7 +207,7 @@ def reclassify(db: Database, laz_list: List[str], laz_year: int, laz_type: str,
         logging.error(f'reclassify: db lock error {e}')
         raise
     except dbError as e:
-        data = [(-3, datetime.now(timezone.utc), etak_path, None, None, None, i) for i in laz_list]
+        data = [(-3, datetime.now(timezone.utc), etak_path, None, None, None, None, None, i) for i in laz_list]
         cur.executemany(statement, data)
         logging.error(f'reclassify: db error {e}')
         raise
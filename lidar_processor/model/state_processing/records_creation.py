@@ -1,5 +1,7 @@
 from typing import List, Tuple
 from lidar_processor.dependencies.db import Database
+from lidar_processor.dependencies.mapsheet import mapsheet_grid, grid_mapsheet
+from lidar_processor.dependencies.partition import partition_filter, ensure_partitions, dem_edition
 from psycopg import Error as dbError
 import logging
 
@@ -9,42 +11,76 @@ dem_file_naming= {2017: "{mapsheet}_dem_1m_2017-2020.tif", 2021: "{mapsheet}_dtm
 
 def laz_files_creation(db: Database, file_name: List[str], to_crs: str, etak_path: str, id_: str) -> List[Tuple[str, int, int]]:
     # entry action
+    partition, partition_data = partition_filter('laz_files', file_name)
     try:
-        statement = 'select filename from laz_files where filename = ANY(%(file_name)s)'
-        result = db.execute_sql(statement, {'file_name': file_name})
+        statement = f'select filename from laz_files where filename = ANY(%(file_name)s) and {partition}'
+        result = db.execute_sql(statement, {'file_name': file_name, **partition_data})
     except dbError as e:
         logging.error(f'laz_files_creation: select failed {e}')
         raise
-    logging.info(f'create laz_files records: {len(file_name)}')
-    logging.debug(f'create laz_files records: {file_name}')
-    if (len(result) == 0):
+    existing = [r[0] for r in result]
+    new_file_name = [f for f in file_name if (f not in existing)]
+    logging.info(f'create laz_files records: {len(new_file_name)}, rerun existing: {len(existing)}')
+    logging.debug(f'create laz_files records: {new_file_name}')
+    created = []
+    if (len(new_file_name) > 0):
         # do action
+        ensure_partitions(db, 'laz_files', new_file_name)
         statement = "insert into laz_files (filename, laz_map_sheet, year, laz_type, to_crs, etak_path, identifier) \
-                     values (%s,%s,%s,%s,%s,%s,%s) returning filename, laz_map_sheet, state"
+                     values (%s,%s,%s,%s,%s,%s,%s) on conflict do nothing returning filename, laz_map_sheet, state"
         data = [(f, f.split('.')[0].split('_')[0],
                  f.split('.')[0].split('_')[1],
                  f.split('.')[0].split('_')[2], to_crs, etak_path, id_)
-                for f in file_name]
+                for f in new_file_name]
         try:
-            result = db.execute_many(statement, data)
+            created = [r for r in db.execute_many(statement, data) if (r is not None)]
             logging.info(f'create laz_files records success.')
-            logging.debug(f'create laz_files records: {result}')
-            return result
+            logging.debug(f'create laz_files records: {created}')
         except dbError as e:
             # exist fail
             logging.error(f'laz_files_creation: insert failed {e}')
             raise
-    else:
-        # exist fail
-        logging.error(f'laz_files_creation: filename exists {result}')
-        raise ValueError('laz_files_creation: filename exists {result}')
+    if (len(existing) > 0):
+        # rerun: downloaded tiles go back to state 1, the fix and reclassify stages skip the ones whose
+        # fingerprint still matches. Rows locked by a running job are left to that job.
+        statement = f"update laz_files set (state, identifier) = (case when bucket is null then 0 else 1 end, %(id)s) \
+                     where {partition} and filename in (select filename from laz_files where filename = ANY(%(file_name)s) \
+                     and {partition} for update skip locked) returning filename, laz_map_sheet, state"
+        try:
+            rerun = db.execute_sql(statement, {'file_name': existing, 'id': id_, **partition_data})
+        except dbError as e:
+            logging.error(f'laz_files_creation: rerun update failed {e}')
+            raise
+        logging.info(f'laz_files_creation: {len(rerun)} existing records queued for rerun, {len(existing) - len(rerun)} locked by another job')
+        created += [r for r in rerun if (r[2] == 0)]
+    return created
+
+
+def neighbour_ring(mapsheets: List[int]) -> List[int]:
+    # the map sheets and their 8 neighbours in the 1 km grid
+    ring = set()
+    for m in mapsheets:
+        row, col = mapsheet_grid(m)
+        ring.update(grid_mapsheet(row + i, col + j) for i in (-1, 0, 1) for j in (-1, 0, 1))
+    return sorted(ring)
 
 
-def dem_files_creation(db: Database, dem_year: int, id_: str) -> List[Tuple[str, int]]:
+def dem_files_creation(db: Database, dem_year: int, id_: str, laz_filenames: List[str] | None = None) -> List[Tuple[str, int]]:
     # entry action
     try:
-        statement = 'select nr10000 from mapsheets_mapping'
-        result = db.execute_sql(statement)
+        if (laz_filenames is None):
+            statement = 'select nr10000 from mapsheets_mapping'
+            result = db.execute_sql(statement)
+        else:
+            # demand mode: only the DEM sheets of the pending laz tiles (state < 3, or no record yet)
+            # and of their neighbours (edge HAG)
+            partition, partition_data = partition_filter('laz_files', laz_filenames)
+            statement = f'select filename from laz_files where state = 3 and filename = ANY(%(laz_filenames)s) and {partition}'
+            done = [r[0] for r in db.execute_sql(statement, {'laz_filenames': laz_filenames, **partition_data})]
+            pending = [int(f.split('_')[0]) for f in set(laz_filenames) - set(done)]
+            logging.info(f'dem_files_creation: {len(pending)} pending laz map sheets')
+            statement = 'select distinct nr10000 from mapsheets_mapping where nr = ANY(%(ring)s)'
+            result = db.execute_sql(statement, {'ring': neighbour_ring(pending)})
     except dbError as e:
         logging.error(f'dem_files_creation: select mapsheet mapping failed {e}')
         raise
@@ -57,9 +93,9 @@ def dem_files_creation(db: Database, dem_year: int, id_: str) -> List[Tuple[str,
         dem_filenames = [dem_filename[-1].format(mapsheet=dem_mapsheet[0], year=dem_year) for dem_mapsheet in result]
         # find non-existing dem files
         while (True):
-            statement = 'select filename from dem_files where filename = ANY(%(dem_filenames)s)'
+            statement = 'select filename from dem_files where filename = ANY(%(dem_filenames)s) and year = %(year)s'
             try:
-                result = db.execute_sql(statement, {'dem_filenames': dem_filenames})
+                result = db.execute_sql(statement, {'dem_filenames': dem_filenames, 'year': dem_edition(dem_year)})
                 result = [r[0] for r in result]
             except dbError as e:
                 # exist fail
@@ -71,10 +107,13 @@ def dem_files_creation(db: Database, dem_year: int, id_: str) -> List[Tuple[str,
             logging.debug(f'create dem_files records: {non_exits_dem_filenames}')
             # create records for non-existing dem files
             if (len(non_exits_dem_mapsheet) > 0):
-                statement = "insert into dem_files (filename, year, dem_map_sheet, identifier) values (%s,%s,%s,%s) returning filename,state"
-                data = [(f, dem_year, non_exits_dem_mapsheet[i], id_) for i, f in enumerate(non_exits_dem_filenames)]
+                # records created meanwhile by a concurrent job are left to that job
+                ensure_partitions(db, 'dem_files', non_exits_dem_filenames)
+                statement = "insert into dem_files (filename, year, dem_map_sheet, identifier) values (%s,%s,%s,%s) \
+                             on conflict do nothing returning filename,state"
+                data = [(f, dem_edition(dem_year), non_exits_dem_mapsheet[i], id_) for i, f in enumerate(non_exits_dem_filenames)]
                 try:
-                    result = db.execute_many(statement, data)
+                    result = [r for r in db.execute_many(statement, data) if (r is not None)]
                     logging.info('create dem_files records success.')
                     return result
                 except dbError as e:
@@ -86,6 +125,6 @@ def dem_files_creation(db: Database, dem_year: int, id_: str) -> List[Tuple[str,
                 return []
     else:
         # exist fail
-        logging.error(f'dem_files_creation: select mapsheet mapping failed, no records found {laz_map_sheets}')
-        raise ValueError(f'dem_files_creation: select mapsheet mapping failed, no records found {laz_map_sheets}')
+        logging.error(f'dem_files_creation: select mapsheet mapping failed, no records found {laz_filenames}')
+        raise ValueError(f'dem_files_creation: select mapsheet mapping failed, no records found {laz_filenames}')
 
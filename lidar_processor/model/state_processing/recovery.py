@@ -1,5 +1,6 @@
 from typing import List, Tuple
 from lidar_processor.dependencies.db import Database
+from lidar_processor.dependencies.partition import partition_filter
 from psycopg import Error as dbError
 from psycopg import errors as stateError
 import logging
@@ -7,21 +8,26 @@ from datetime import datetime, timezone
 
 
 # reset laz, dem files state and return a list of laz filename for recovery
-def recovery(db: Database, id_: str) -> Tuple[str, List[Tuple[str,]], List[Tuple[str,]]]:
+# laz_filenames / dem_years (the files and DEM editions of the config) restrict the locking queries to their
+# partitions, the identifier alone makes Postgres scan and lock every partition
+def recovery(db: Database, id_: str, laz_filenames: List[str] | None = None,
+             dem_years: List[int] | None = None) -> Tuple[str, List[Tuple[str,]], List[Tuple[str,]]]:
     cur = db.conn.cursor()
     try:
         with db.conn.transaction():
             # lock laz_files rows with state=1 (downloaded) for update.
-            recovery_statement = "select filename, laz_map_sheet, state\
-                                  from laz_files where (state <> 3 and identifier = %(id_)s)  \
+            partition, partition_data = partition_filter('laz_files', laz_filenames) if (laz_filenames) else ('true', {})
+            recovery_statement = f"select filename, laz_map_sheet, state\
+                                  from laz_files where (state <> 3 and identifier = %(id_)s) and {partition} \
                                   for update nowait;"
-            cur.execute(recovery_statement, {'id_': id_})
+            cur.execute(recovery_statement, {'id_': id_, **partition_data})
             laz_recovery_set = cur.fetchall()
             laz_reset_state = []
             laz_recovery_filenames = []
             dem_reset_state = {}
-            recovery_statement = "select filename,state from dem_files where identifier=%(id_)s and state<>1 for update nowait;"
-            cur.execute(recovery_statement, {'id_': id_})
+            partition = 'year = ANY(%(dem_years)s)' if (dem_years) else 'true'
+            recovery_statement = f"select filename,state from dem_files where identifier=%(id_)s and state<>1 and {partition} for update nowait;"
+            cur.execute(recovery_statement, {'id_': id_, 'dem_years': dem_years})
             dem_recovery_set = cur.fetchall()
             logging.info(f'recovery: {len(laz_recovery_set)} laz_files to recover, {len(dem_recovery_set)} dem_files to recover')
             if ((len(dem_recovery_set) > 0) or (len(laz_recovery_set) > 0)):
@@ -30,7 +36,8 @@ def recovery(db: Database, id_: str) -> Tuple[str, List[Tuple[str,]], List[Tuple
                         if (dem_reset_state.get(i[0]) is None):
                             dem_reset_state[i[0]] = ((0, f'{id_}_R', None, i[0]))
                 for i in laz_recovery_set:
-                    laz_state = i[2] if (i[2] >= 0) else abs(i[2]) - 1
+                    # failing state -n and timeout state -(10 + n) both go back to n - 1
+                    laz_state = i[2] if (i[2] >= 0) else abs(i[2]) % 10 - 1
                     laz_reset_state.append((laz_state, f'{id_}_R', datetime.now(timezone.utc), i[0]))
                     laz_recovery_filenames.append((i[0],))
                 reset_statement = 'update laz_files set (state, identifier, processing_time) = (%s,%s,%s) where filename=%s'
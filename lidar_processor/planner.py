@@ -0,0 +1,243 @@
+import yaml
+import argparse
+import logging
+import math
+import os
+from typing import Any, Dict, List, Tuple
+from psycopg import Error as dbError
+
+from lidar_processor.dependencies.db import Database
+from lidar_processor.dependencies.storage import get_storage
+from lidar_processor.dependencies.mapsheet import mapsheet_bounds, point_mapsheet, spatial_order
+from lidar_processor.dependencies.partition import partition_filter
+from lidar_processor.schemas.config import DBConfig, StorageConfig, LidarConfig
+
+
+loglevel = {'info': logging.INFO,
+            'debug': logging.DEBUG,
+            'error': logging.ERROR,
+            'warning': logging.WARNING}
+
+# ETAK layers whose features drive the overlay cost of a tile
+etak_cost_layers = ['E_401_hoone_ka', 'E_403_muu_rajatis_ka', 'E_202_seisuveekogu_a', 'E_203_vooluveekogu_a', 'E_601_elektriliin_j']
+
+# bytes of a point record by LAS point format (the decompressed laspy array of fix)
+record_lengths = {0: 20, 1: 28, 2: 26, 3: 34, 4: 57, 5: 63, 6: 30, 7: 36, 8: 38, 9: 59, 10: 67}
+# bytes of a point in the PDAL point table of reclassify: the LAS dimensions (X, Y, Z, GpsTime as doubles)
+# and the seven double dimensions the pipeline adds (overlay masks, NDVI, HAG, OriginalClassification)
+pdal_point_bytes = 110
+
+job_template = """#!/bin/bash
+#SBATCH -J {name}
+#SBATCH -N 1
+#SBATCH --cpus-per-task={cpus}
+#SBATCH --partition={partition}
+#SBATCH -o {name}_%A_%a.log
+# generated by lidar_processor/planner.py, memory and time are given per shard in {submit}
+export GOOGLE_APPLICATION_CREDENTIALS=<path to GCP access json>
+cd $HOME/lidar_processing/apps/lidar_processor
+configpath={outdir}/{name}_${{SLURM_ARRAY_TASK_ID}}.yaml
+$HOME/micromamba/envs/lidar_processing/bin/python lidar_processor/main.py -c $configpath -i ${{SLURM_ARRAY_JOB_ID}}_${{SLURM_ARRAY_TASK_ID}}
+"""
+
+
+def parse_args(arg_list: List[str] | None):
+    parser = argparse.ArgumentParser(description='Split the laz map sheets of a config into cost balanced SLURM shards.')
+    parser.add_argument("-c", "--config", help="configuration path", default='./config.yaml')
+    parser.add_argument("-o", "--outdir", help="output folder for shard configs and scripts", default='./shards')
+    parser.add_argument("-n", "--name", help="job / file name prefix", default=None)
+    parser.add_argument("--shards", help="number of shards (derived from --max-hours if omitted)", type=int, default=None)
+    parser.add_argument("--max-hours", help="target wall time of one shard", type=float, default=20)
+    parser.add_argument("--cpus", help="cpus per task", type=int, default=12)
+    parser.add_argument("--partition", help="SLURM partition", default='amd')
+    parser.add_argument("--etak", help="ETAK gpkg used to weight tiles by overlay density", default=None)
+    parser.add_argument("--etak-weight", help="cost weight of the ETAK density", type=float, default=0.5)
+    parser.add_argument("--sec-per-mb", help="processing seconds per MB of laz", type=float, default=1.5)
+    parser.add_argument("--bytes-per-point", help="peak RAM of one worker per point (default: from the point format)", type=float, default=None)
+    parser.add_argument("--default-mb", help="assumed size of tiles not downloaded yet", type=float, default=350)
+    parser.add_argument("--probe", help="read the laz headers of tiles without point count (range requests)", action='store_true')
+    parser.add_argument("--mb-per-mpoint", help="laz MB per million points, sizes tiles known only by their header", type=float, default=4)
+    parser.add_argument("-log", "--loglevel", help="log level", default='info')
+    args = parser.parse_args(arg_list)
+    return args
+
+
+def tile_sizes(db: Database, filenames: List[str], mb_per_mpoint: float) -> Dict[str, float]:
+    # size in MB of the already downloaded tiles
+    partition, partition_data = partition_filter('laz_files', filenames)
+    result = db.execute_sql(f'select filename, bucket, path from laz_files where filename = ANY(%(filename)s) and state <> 0 and bucket is not null and {partition}',
+                            {'filename': filenames, **partition_data})
+    paths = [r[1] + '/' + r[2] + '/' + r[0] for r in result]
+    sizes = {}
+    if (len(paths) > 0):
+        for i, size in enumerate(get_storage(paths[0]).sizes(paths)):
+            if (size is not None):
+                sizes[result[i][0]] = size / 2**20
+    # estimated from the point count of the probed headers for the others
+    result = db.execute_sql(f'select filename, point_count from laz_files where filename = ANY(%(filename)s) and point_count is not null and {partition}',
+                            {'filename': [f for f in filenames if (f not in sizes)], **partition_data})
+    for r in result:
+        sizes[r[0]] = r[1] / 1e6 * mb_per_mpoint
+    return sizes
+
+
+def tile_points(db: Database, filenames: List[str]) -> Dict[str, Tuple[int, int | None]]:
+    # point count and point format of the probed tiles
+    partition, partition_data = partition_filter('laz_files', filenames)
+    result = db.execute_sql(f'select filename, point_count, point_format from laz_files where filename = ANY(%(filename)s) \
+                              and point_count is not null and {partition}', {'filename': filenames, **partition_data})
+    return {r[0]: (r[1], r[2]) for r in result}
+
+
+def point_bytes(point_format: int | None) -> float:
+    # peak of one worker per point, the larger of the two stages:
+    # fix holds the laspy array, the filtered copy and the dedup keys (4 int64 columns and the sort order),
+    # reclassify the PDAL table and, for a split tile, the numpy copy of the points and the merged result
+    record = record_lengths.get(point_format, max(record_lengths.values()))
+    return max(2 * record + 40, 2 * pdal_point_bytes)
+
+
+def etak_density(etak_file: str, mapsheets: List[int]) -> Dict[int, int]:
+    # number of overlay features per tile, counted in one pass over the batch extent
+    from osgeo import ogr
+    bounds = [mapsheet_bounds(m) for m in mapsheets]
+    minx, miny = min(b[0] for b in bounds), min(b[1] for b in bounds)
+    maxx, maxy = max(b[2] for b in bounds), max(b[3] for b in bounds)
+    ds = ogr.Open(etak_file)
+    density: Dict[int, int] = {}
+    for name in etak_cost_layers:
+        layer = ds.GetLayerByName(name)
+        if (layer is None):
+            continue
+        layer.SetSpatialFilterRect(minx, miny, maxx, maxy)
+        for feature in layer:
+            envelope = feature.GetGeometryRef().GetEnvelope()
+            m = point_mapsheet((envelope[0] + envelope[1]) / 2, (envelope[2] + envelope[3]) / 2)
+            density[m] = density.get(m, 0) + 1
+    return density
+
+
+def balance(costs: Dict[Any, float], shards: int, order: List[Any]) -> List[List[Any]]:
+    # contiguous segments of the spatially ordered tiles, so neighbours and DEM sheets stay in one shard:
+    # each cut goes where the running cost is closest to its share of the total
+    total = sum(costs[f] for f in order)
+    result: List[List[Any]] = []
+    start, load = 0, 0.0
+    for k in range(1, shards):
+        target = total * k / shards
+        end = start + 1
+        load += costs[order[start]]
+        # the remaining shards keep at least one tile each
+        while ((end < len(order) - (shards - k)) and (abs(load + costs[order[end]] - target) <= abs(load - target))):
+            load += costs[order[end]]
+            end += 1
+        result.append(order[start:end])
+        start = end
+    result.append(order[start:])
+    return [r for r in result if (len(r) > 0)]
+
+
+def shard_resources(memory: List[float], costs: List[float], args) -> Tuple[int, int]:
+    # memory (MB per tile): the largest tiles running together on all cores, plus the interpreter / pool overhead
+    largest = sorted(memory, reverse=True)[:args.cpus]
+    mem_gb = 4 + sum(largest) / 1024
+    mem_gb = int(math.ceil(mem_gb * 1.25 / 8) * 8)
+    # time: the balanced work over all cores, with margin for download and upload
+    hours = sum(costs) * args.sec_per_mb / args.cpus / 3600
+    hours = int(math.ceil(hours * 1.3 + 0.5))
+    return (mem_gb, hours)
+
+
+def main(arg_list: List[str] | None = None):
+    args = parse_args(arg_list)
+    logging.basicConfig(format='%(asctime)s.%(msecs)03d %(levelname)7s {%(module)s} [%(funcName)s] %(message)s',
+                        datefmt='%Y-%m-%d,%H:%M:%S', level=loglevel[args.loglevel.lower()])
+    try:
+        with open(args.config) as f:
+            config = yaml.safe_load(f)
+        dbconfig = DBConfig(**config['db'])
+        StorageConfig(**config['storage'])
+        lidarconfig = LidarConfig(**config['lidar'])
+    except (yaml.YAMLError, OSError, KeyError) as e:
+        logging.error(f'planner: load {args.config} failed: {e}')
+        os.sys.exit(-1)
+    name = args.name or '_'.join(f'{c.laz_year}_{c.laz_type}' for c in lidarconfig.campaigns)
+    try:
+        db = Database(**dbconfig.__dict__)
+        mapping = db.execute_sql('select nr, nr10000 from mapsheets_mapping where nr = ANY (%(laz_mapsheets)s)',
+                                 {'laz_mapsheets': lidarconfig.laz_mapsheets})
+        # the tiles of every campaign, a shard runs all campaigns of its map sheets
+        filenames = {f'{m[0]}_{c.laz_year}_{c.laz_type}.laz': m[0] for m in mapping for c in lidarconfig.campaigns}
+        groups = {m[0]: m[1] for m in mapping}
+        partition, partition_data = partition_filter('laz_files', list(filenames.keys()))
+        done = db.execute_sql(f'select filename from laz_files where filename = ANY(%(filename)s) and state = 3 and {partition}',
+                              {'filename': list(filenames.keys()), **partition_data})
+        for r in done:
+            del filenames[r[0]]
+        if (args.probe):
+            from lidar_processor.model.state_processing.probe_headers import probe_headers
+            probe_headers(db, list(filenames.keys()))
+        sizes = tile_sizes(db, list(filenames.keys()), args.mb_per_mpoint)
+    except dbError as e:
+        logging.error(f'planner: db error {e}')
+        os.sys.exit(-1)
+    if (len(filenames) == 0):
+        logging.warning('planner: nothing to plan, all map sheets are reclassified or out of range.')
+        os.sys.exit(0)
+    default_mb = sorted(sizes.values())[len(sizes) // 2] if (len(sizes) > 0) else args.default_mb
+    known = len(sizes)
+    sizes = {f: sizes.get(f, default_mb) for f in filenames.keys()}
+    logging.info(f'planner: {len(filenames)} tiles, {known} with known size, {sum(sizes.values()) / 1024:.1f} GB')
+
+    density = etak_density(args.etak, list(filenames.values())) if (args.etak is not None) else {}
+    mean_density = (sum(density.values()) / len(filenames)) or 1
+    costs = {f: sizes[f] * (1 + args.etak_weight * density.get(m, 0) / mean_density) for f, m in filenames.items()}
+    # peak memory of a worker from the decompressed points, tiles without header from their laz size
+    try:
+        points = tile_points(db, list(filenames.keys()))
+    except dbError as e:
+        logging.error(f'planner: db error {e}')
+        os.sys.exit(-1)
+    memory = {}
+    for f in filenames.keys():
+        count, point_format = points.get(f, (sizes[f] / args.mb_per_mpoint * 1e6, None))
+        memory[f] = count * (args.bytes_per_point or point_bytes(point_format)) / 2**20
+
+    shards = args.shards
+    if (shards is None):
+        shards = math.ceil(sum(costs.values()) * args.sec_per_mb / args.cpus / 3600 / args.max_hours)
+    # shards are cut between map sheets, the config of a shard lists map sheets and not tiles
+    sheet_costs: Dict[int, float] = {}
+    for f, m in filenames.items():
+        sheet_costs[m] = sheet_costs.get(m, 0) + costs[f]
+    mapsheets = list(sheet_costs.keys())
+    order = [mapsheets[i] for i in spatial_order(mapsheets, groups)]
+    plan = balance(sheet_costs, max(1, min(shards, len(sheet_costs))), order)
+
+    os.makedirs(args.outdir, exist_ok=True)
+    submit = os.path.join(args.outdir, f'{name}_submit.sh')
+    job = os.path.join(args.outdir, f'{name}_job.sh')
+    resources: Dict[Tuple[int, int], List[int]] = {}
+    for i, shard in enumerate(plan):
+        shard_config = dict(config)
+        shard_config['lidar'] = dict(config['lidar'], laz_mapsheets=shard)
+        with open(os.path.join(args.outdir, f'{name}_{i}.yaml'), 'w') as f:
+            yaml.safe_dump(shard_config, f, sort_keys=False)
+        tiles = [f for f, m in filenames.items() if (m in set(shard))]
+        mem_gb, hours = shard_resources([memory[f] for f in tiles], [costs[f] for f in tiles], args)
+        resources.setdefault((mem_gb, hours), []).append(i)
+        logging.info(f'planner: shard {i}: {len(shard)} map sheets, {len(tiles)} tiles, {mem_gb} GB, {hours} h')
+    with open(job, 'w') as f:
+        f.write(job_template.format(name=name, cpus=args.cpus, partition=args.partition,
+                                    outdir=os.path.abspath(args.outdir), submit=submit))
+    with open(submit, 'w') as f:
+        f.write('#!/bin/bash\n')
+        # shards with the same request share one array job
+        for (mem_gb, hours), ids in sorted(resources.items()):
+            f.write(f'sbatch --array={",".join(str(i) for i in ids)} --mem={mem_gb}GB -t {hours}:00:00 {os.path.abspath(job)}\n')
+    logging.info(f'planner: {len(plan)} shards written to {args.outdir}, submit with {submit}')
+    os.sys.exit(0)
+
+
+if __name__ == "__main__":
+    main()
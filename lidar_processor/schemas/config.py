@@ -1,5 +1,8 @@
-from typing import Optional,  List
-from pydantic import BaseModel, field_validator
+from typing import Optional,  Dict, List
+import re
+from pydantic import BaseModel, field_validator, model_validator
+
+from lidar_processor.dependencies.codec import laz_codecs
 
 
 class DBConfig(BaseModel):
@@ -21,15 +24,142 @@ class StorageConfig(BaseModel):
     ndvi_path: str
 
 
-class LidarConfig(BaseModel):
-    laz_mapsheets: List[int]
-    laz_to_crs: Optional[str] = 'EPSG:3301'
+def check_laz_type(value):
+    if ((value is not None) and (value not in ['mets', 'tava'])):
+        raise ValueError('laz_type must be either "mets" or "tava".')
+    return value
+
+
+class Campaign(BaseModel):
     laz_year: int
     laz_type: str
     dem_year: int
+    etak_edition: Optional[str] = None
+
+    @field_validator('laz_type')
+    def mets_or_tava(cls, value):
+        return check_laz_type(value)
+
+
+class LidarConfig(BaseModel):
+    laz_mapsheets: List[int]
+    laz_to_crs: Optional[str] = 'EPSG:3301'
+    laz_year: Optional[int] = None
+    laz_type: Optional[str] = None
+    dem_year: Optional[int] = None
+    # ETAK folder under storage.etak_path, overrides the edition of laz_year in reclassify.etak_mapping
+    etak_edition: Optional[str] = None
+    # several campaigns over the map sheets in one job, instead of laz_year / laz_type / dem_year
+    campaigns: List[Campaign] = []
 
     @field_validator('laz_type')
     def mets_or_tava(cls, value):
-        if value not in ['mets', 'tava']:
-            raise ValueError('laz_type must be either "mets" or "tava".')
+        return check_laz_type(value)
+
+    @model_validator(mode='after')
+    def one_or_more_campaigns(self):
+        if (len(self.campaigns) == 0):
+            if ((self.laz_year is None) or (self.laz_type is None) or (self.dem_year is None)):
+                raise ValueError('lidar needs laz_year, laz_type and dem_year, or campaigns.')
+            self.campaigns = [Campaign(laz_year=self.laz_year, laz_type=self.laz_type, dem_year=self.dem_year,
+                                       etak_edition=self.etak_edition)]
+        elif (self.laz_year is None):
+            # laz_year / laz_type / dem_year mirror the first campaign for the log and file names,
+            # the tools go through all campaigns
+            first = self.campaigns[0]
+            self.laz_year, self.laz_type, self.dem_year, self.etak_edition = first.laz_year, first.laz_type, first.dem_year, first.etak_edition
+        return self
+
+
+class ReclassifyOptions(BaseModel):
+    # tiles larger than split_size_mb are split into split_length m sub-tiles run by split_workers processes,
+    # capped to the cores of one worker in the running lane
+    split_size_mb: Optional[float] = None
+    split_length: float = 250
+    split_workers: int = 4
+    # PDAL stream mode, falls back to standard mode when a stage is not streamable
+    streaming: bool = False
+    chunk_size: int = 100000
+    # 'full' writes all added dimensions as doubles, 'compact' packs them (see processing_script/README.md)
+    output_profile: str = 'full'
+    # vegetation metrics rasters written next to the output: p<percentile>, max, cover, density,
+    # standard mode only (not with streaming)
+    metrics: List[str] = []
+    metrics_resolution: float = 10
+    cover_height: float = 1.3
+    # extra outputs <output>_<name>.laz holding the points matching a PDAL expression
+    subsets: Dict[str, str] = {}
+
+    @field_validator('output_profile')
+    def full_or_compact(cls, value):
+        if value not in ['full', 'compact']:
+            raise ValueError('output_profile must be either "full" or "compact".')
+        return value
+
+    @field_validator('subsets')
+    def subset_names(cls, value):
+        for name in value.keys():
+            if (re.fullmatch(r'\w+', name) is None):
+                raise ValueError(f'subset name {name} must only contain letters, digits and underscores.')
+        return value
+
+    @field_validator('metrics')
+    def known_metrics(cls, value):
+        for metric in value:
+            if ((metric not in ['max', 'cover', 'density']) and (re.fullmatch(r'p\d{1,2}', metric) is None)):
+                raise ValueError(f'unknown metric {metric}, use p<percentile>, max, cover or density.')
+        return value
+
+    @model_validator(mode='after')
+    def metrics_not_streamed(self):
+        # the metrics need all points of a tile in memory, every tile would run in standard mode
+        if (self.streaming and (len(self.metrics) > 0)):
+            raise ValueError('metrics need all points in memory, set streaming: false or leave metrics empty.')
+        return self
+
+
+class ProcessingConfig(BaseModel):
+    # node-local scratch for outputs waiting for upload, defaults to $TMPDIR
+    scratch_path: Optional[str] = None
+    scratch_limit_gb: float = 50
+    upload_workers: int = 4
+    upload_retries: int = 3
+    # per-file timeouts (seconds), timed-out files are retried in the heavy lane
+    fix_timeout: Optional[int] = 1800
+    reclassify_timeout: Optional[int] = 3600
+    heavy_workers: int = 2
+    heavy_timeout_factor: float = 4
+    # transient failures (network, 5xx, remote read errors) are retried in the job with exponential backoff
+    retries: int = 3
+    retry_backoff: float = 30
+    retry_backoff_cap: float = 600
+    # fix removes duplicate points: same cell of dedup_tolerance m in XYZ (0: same scaled coordinates)
+    # and of dedup_time_tolerance s in GPS time (0: same time, null: GPS time is not compared)
+    dedup: bool = False
+    dedup_tolerance: float = 0
+    dedup_time_tolerance: Optional[float] = 0
+    dedup_chunk_size: int = 5000000
+    # LAZ codec: default, lazrs, lazrs_parallel or auto (parallel when workers have spare cores)
+    laz_codec: str = 'default'
+    reclassify: ReclassifyOptions = ReclassifyOptions()
+    # stage DEM / NDVI / ETAK of the next prefetch_lookahead tiles on local disk (0 disables)
+    prefetch_lookahead: int = 0
+    prefetch_limit_gb: float = 10
+    prefetch_workers: int = 2
+    # folder of the staged ancillary data, scratch_path when omitted; /dev/shm keeps it in shared memory,
+    # counted in the memory of the job
+    prefetch_path: Optional[str] = None
+    # ETAK overlay presence of the batch from PostGIS (etak_postgis.py), instead of per tile GPKG queries
+    etak_postgis: bool = False
+    # read point count, bounds, version and CRS of the laz headers with range requests before downloading
+    probe_headers: bool = False
+    # live metrics: Prometheus textfile ({id} is replaced by the identifier) and/or http://127.0.0.1:<port>/metrics
+    metrics_path: Optional[str] = None
+    metrics_port: Optional[int] = None
+    metrics_interval: float = 5
+
+    @field_validator('laz_codec')
+    def known_codec(cls, value):
+        if value not in laz_codecs:
+            raise ValueError(f'laz_codec must be one of {laz_codecs}.')
         return value
@@ -0,0 +1,75 @@
+import yaml
+import argparse
+import logging
+import os
+from typing import Any, Dict, List, Tuple
+from psycopg import Error as dbError
+
+# keep this module light: it runs on login nodes and from cron, no geospatial imports here
+from lidar_processor.dependencies.db import Database
+from lidar_processor.dependencies.partition import dem_edition
+from lidar_processor.schemas.config import DBConfig
+
+
+def parse_args(arg_list: List[str] | None):
+    parser = argparse.ArgumentParser(prog='lidarprocessing status', description='Print state counts and throughput of laz_files / dem_files.')
+    parser.add_argument("-c", "--config", help="configuration path", default='./config.yaml')
+    parser.add_argument("-i", "--id", help="identifier (recovery identifiers {id}_R included)", default=None)
+    parser.add_argument("-m", "--mapsheets", help="laz map sheet range, e.g. 440000-450000", default=None)
+    parser.add_argument("-y", "--year", help="laz / dem year", type=int, default=None)
+    parser.add_argument("-t", "--type", help="laz type (mets / tava)", default=None)
+    parser.add_argument("--hours", help="window for the recent throughput", type=float, default=1)
+    args = parser.parse_args(arg_list)
+    return args
+
+
+def filters(args, table: str) -> Tuple[str, Dict[str, Any]]:
+    where, data = ['true'], {}
+    if (args.id is not None):
+        where.append("identifier like %(id_)s || '%%'")
+        data['id_'] = args.id
+    if (args.year is not None):
+        # the 2017-2020 DEM rows are kept under 2017
+        where.append('year = %(year)s')
+        data['year'] = args.year if (table == 'laz_files') else dem_edition(args.year)
+    if ((args.type is not None) and (table == 'laz_files')):
+        where.append('laz_type = %(laz_type)s')
+        data['laz_type'] = args.type
+    if (args.mapsheets is not None):
+        start, end = args.mapsheets.split('-')
+        if (table == 'laz_files'):
+            where.append('laz_map_sheet between %(start)s and %(end)s')
+        else:
+            # the range is given in laz map sheets, the DEM rows hold the 1:10000 sheet covering them
+            where.append('dem_map_sheet in (select nr10000 from mapsheets_mapping where nr between %(start)s and %(end)s)')
+        data['start'], data['end'] = int(start), int(end)
+    return (' and '.join(where), data)
+
+
+def main(arg_list: List[str] | None = None):
+    args = parse_args(arg_list)
+    try:
+        with open(args.config) as f:
+            config = yaml.safe_load(f)
+        db = Database(**DBConfig(**config['db']).__dict__)
+    except (yaml.YAMLError, OSError, KeyError, dbError) as e:
+        logging.error(f'status: load {args.config} failed: {e}')
+        os.sys.exit(-1)
+    for table, time_column in [('laz_files', 'processing_time'), ('dem_files', 'download_time')]:
+        where, data = filters(args, table)
+        counts = db.execute_sql(f'select state, count(*) from {table} where {where} group by state order by state', data)
+        print(f'{table}: {sum(c[1] for c in counts)} files')
+        for state, count in counts:
+            print(f'  state {state:>4}: {count}')
+        data['hours'] = args.hours
+        rate = db.execute_sql(f"select count(*) filter (where {time_column} > now() - make_interval(secs => %(hours)s * 3600)), \
+                                       min({time_column}), max({time_column}), count({time_column}) \
+                                from {table} where {where} and state > 0", data)
+        recent, first, last, total = rate[0]
+        overall = total / ((last - first).total_seconds() / 3600) if ((total > 1) and (last > first)) else 0
+        print(f'  throughput: {recent / args.hours:.1f} files/h (last {args.hours:g} h), {overall:.1f} files/h overall')
+    os.sys.exit(0)
+
+
+if __name__ == "__main__":
+    main()
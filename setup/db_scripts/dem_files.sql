@@ -13,6 +13,7 @@ CREATE TABLE IF NOT EXISTS lidar_processing.dem_files
     dem_map_sheet integer NOT NULL,
     identifier text COLLATE pg_catalog."default" NOT NULL,
     download_url text COLLATE pg_catalog."default",
+    vrt_path text COLLATE pg_catalog."default",
     CONSTRAINT dem_files_pkey PRIMARY KEY (filename)
 )
 
@@ -0,0 +1,25 @@
+-- Table: lidar_processing.etak_overlays
+-- ETAK overlay layers of the reclassification, loaded by lidar_processor/etak_postgis.py (requires PostGIS)
+
+-- DROP TABLE IF EXISTS lidar_processing.etak_overlays;
+
+CREATE EXTENSION IF NOT EXISTS postgis;
+
+CREATE TABLE IF NOT EXISTS lidar_processing.etak_overlays
+(
+    edition text COLLATE pg_catalog."default" NOT NULL,
+    overlay text COLLATE pg_catalog."default" NOT NULL,
+    layer text COLLATE pg_catalog."default" NOT NULL,
+    geom public.geometry(Geometry, 3301) NOT NULL
+)
+
+TABLESPACE pg_default;
+
+CREATE INDEX IF NOT EXISTS etak_overlays_geom_idx
+    ON lidar_processing.etak_overlays USING gist (geom);
+
+CREATE INDEX IF NOT EXISTS etak_overlays_edition_idx
+    ON lidar_processing.etak_overlays (edition, overlay);
+
+ALTER TABLE IF EXISTS lidar_processing.etak_overlays
+    OWNER to waiti84;
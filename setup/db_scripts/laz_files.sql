@@ -20,6 +20,15 @@ CREATE TABLE IF NOT EXISTS lidar_processing.laz_files
     reclassify_path text COLLATE pg_catalog."default",
     dem_path text COLLATE pg_catalog."default",
     ndvi_path text COLLATE pg_catalog."default",
+    metrics_path text COLLATE pg_catalog."default",
+    fix_fingerprint text COLLATE pg_catalog."default",
+    reclassify_fingerprint text COLLATE pg_catalog."default",
+    point_count bigint,
+    bounds double precision[],
+    las_version text COLLATE pg_catalog."default",
+    point_format smallint,
+    has_crs boolean,
+    duplicates_removed bigint,
     CONSTRAINT laz_files_pkey PRIMARY KEY (filename)
 )
 
@@ -0,0 +1,19 @@
+-- Table: lidar_processing.laz_subsets
+
+-- DROP TABLE IF EXISTS lidar_processing.laz_subsets;
+
+CREATE TABLE IF NOT EXISTS lidar_processing.laz_subsets
+(
+    filename text COLLATE pg_catalog."default" NOT NULL,
+    subset text COLLATE pg_catalog."default" NOT NULL,
+    path text COLLATE pg_catalog."default" NOT NULL,
+    point_count bigint,
+    CONSTRAINT laz_subsets_pkey PRIMARY KEY (filename, subset),
+    CONSTRAINT laz_subsets_filename_fkey FOREIGN KEY (filename)
+        REFERENCES lidar_processing.laz_files (filename) ON DELETE CASCADE
+)
+
+TABLESPACE pg_default;
+
+ALTER TABLE IF EXISTS lidar_processing.laz_subsets
+    OWNER to waiti84;
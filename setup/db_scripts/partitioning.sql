@@ -0,0 +1,80 @@
+-- Partitions laz_files by year and laz_type, dem_files by year: row locks, vacuum and the state queries
+-- of a campaign stay within its partitions as the history of other campaigns grows.
+-- Run after laz_files.sql, dem_files.sql and upgrade.sql. Existing rows are copied into the partitioned
+-- tables, the old tables are kept as laz_files_unpartitioned / dem_files_unpartitioned.
+-- Partitions of new campaigns are created by lidar_processor before the first insert.
+
+CREATE OR REPLACE FUNCTION lidar_processing.create_laz_partition(p_year integer, p_type text)
+    RETURNS void
+    LANGUAGE 'plpgsql'
+AS $BODY$
+BEGIN
+    BEGIN
+        EXECUTE format('CREATE TABLE IF NOT EXISTS lidar_processing.%I PARTITION OF lidar_processing.laz_files
+                        FOR VALUES IN (%s) PARTITION BY LIST (laz_type)', 'laz_files_' || p_year, p_year);
+    EXCEPTION WHEN duplicate_table THEN
+        -- created by a concurrent job
+        NULL;
+    END;
+    BEGIN
+        EXECUTE format('CREATE TABLE IF NOT EXISTS lidar_processing.%I PARTITION OF lidar_processing.%I
+                        FOR VALUES IN (%L)', 'laz_files_' || p_year || '_' || p_type, 'laz_files_' || p_year, p_type);
+    EXCEPTION WHEN duplicate_table THEN
+        NULL;
+    END;
+END;
+$BODY$;
+
+CREATE OR REPLACE FUNCTION lidar_processing.create_dem_partition(p_year integer)
+    RETURNS void
+    LANGUAGE 'plpgsql'
+AS $BODY$
+BEGIN
+    EXECUTE format('CREATE TABLE IF NOT EXISTS lidar_processing.%I PARTITION OF lidar_processing.dem_files
+                    FOR VALUES IN (%s)', 'dem_files_' || p_year, p_year);
+EXCEPTION WHEN duplicate_table THEN
+    NULL;
+END;
+$BODY$;
+
+DO $BODY$
+BEGIN
+    IF ((SELECT relkind FROM pg_class WHERE oid = 'lidar_processing.laz_files'::regclass) = 'r') THEN
+        -- the primary key of a partitioned table includes the partition keys, filename alone is not
+        -- unique for a foreign key any more
+        ALTER TABLE IF EXISTS lidar_processing.laz_subsets DROP CONSTRAINT IF EXISTS laz_subsets_filename_fkey;
+        ALTER TABLE lidar_processing.laz_files RENAME TO laz_files_unpartitioned;
+        ALTER INDEX lidar_processing.laz_files_pkey RENAME TO laz_files_unpartitioned_pkey;
+        CREATE TABLE lidar_processing.laz_files
+        (
+            LIKE lidar_processing.laz_files_unpartitioned INCLUDING DEFAULTS,
+            CONSTRAINT laz_files_pkey PRIMARY KEY (filename, year, laz_type)
+        ) PARTITION BY LIST (year);
+        CREATE INDEX laz_files_state_idx ON lidar_processing.laz_files (state);
+        CREATE INDEX laz_files_identifier_idx ON lidar_processing.laz_files (identifier);
+        PERFORM lidar_processing.create_laz_partition(k.year, k.laz_type)
+            FROM (SELECT DISTINCT year, laz_type FROM lidar_processing.laz_files_unpartitioned) AS k;
+        INSERT INTO lidar_processing.laz_files SELECT * FROM lidar_processing.laz_files_unpartitioned;
+        ALTER TABLE lidar_processing.laz_files OWNER to waiti84;
+    END IF;
+    IF ((SELECT relkind FROM pg_class WHERE oid = 'lidar_processing.dem_files'::regclass) = 'r') THEN
+        ALTER TABLE lidar_processing.dem_files RENAME TO dem_files_unpartitioned;
+        ALTER INDEX lidar_processing.dem_files_pkey RENAME TO dem_files_unpartitioned_pkey;
+        CREATE TABLE lidar_processing.dem_files
+        (
+            LIKE lidar_processing.dem_files_unpartitioned INCLUDING DEFAULTS,
+            CONSTRAINT dem_files_pkey PRIMARY KEY (filename, year)
+        ) PARTITION BY LIST (year);
+        CREATE INDEX dem_files_state_idx ON lidar_processing.dem_files (state);
+        CREATE INDEX dem_files_identifier_idx ON lidar_processing.dem_files (identifier);
+        PERFORM lidar_processing.create_dem_partition(k.year)
+            FROM (SELECT DISTINCT year FROM lidar_processing.dem_files_unpartitioned) AS k;
+        INSERT INTO lidar_processing.dem_files SELECT * FROM lidar_processing.dem_files_unpartitioned;
+        ALTER TABLE lidar_processing.dem_files OWNER to waiti84;
+    END IF;
+END;
+$BODY$;
+
+-- once the copied rows are checked:
+-- DROP TABLE IF EXISTS lidar_processing.laz_files_unpartitioned;
+-- DROP TABLE IF EXISTS lidar_processing.dem_files_unpartitioned;
@@ -0,0 +1,19 @@
+-- Columns added after the initial release, safe to run on an up to date database
+
+ALTER TABLE IF EXISTS lidar_processing.laz_files
+    ADD COLUMN IF NOT EXISTS metrics_path text COLLATE pg_catalog."default",
+    ADD COLUMN IF NOT EXISTS fix_fingerprint text COLLATE pg_catalog."default",
+    ADD COLUMN IF NOT EXISTS reclassify_fingerprint text COLLATE pg_catalog."default",
+    ADD COLUMN IF NOT EXISTS point_count bigint,
+    ADD COLUMN IF NOT EXISTS bounds double precision[],
+    ADD COLUMN IF NOT EXISTS las_version text COLLATE pg_catalog."default",
+    ADD COLUMN IF NOT EXISTS point_format smallint,
+    ADD COLUMN IF NOT EXISTS has_crs boolean,
+    ADD COLUMN IF NOT EXISTS duplicates_removed bigint;
+
+ALTER TABLE IF EXISTS lidar_processing.dem_files
+    ADD COLUMN IF NOT EXISTS vrt_path text COLLATE pg_catalog."default";
+
+-- the 2017-2020 DEM is one product, its rows are kept under 2017 (one dem_files partition per edition)
+UPDATE lidar_processing.dem_files SET year = 2017
+    WHERE filename LIKE '%\_dem\_1m\_2017-2020.tif' AND year <> 2017;
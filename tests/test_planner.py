@@ -0,0 +1,27 @@
+import pytest
+
+pytest.importorskip("psycopg")
+
+from lidar_processor.planner import balance  # noqa: E402
+
+
+def test_balance_contiguous_segments():
+    order = [f'{i}_2017_tava.laz' for i in range(10)]
+    costs = {f: 1.0 for f in order}
+    plan = balance(costs, 3, order)
+    assert sum(plan, []) == order
+    assert [len(s) for s in plan] == [3, 4, 3]
+
+
+def test_balance_uneven_costs():
+    order = ['a', 'b', 'c', 'd', 'e']
+    costs = {'a': 10, 'b': 1, 'c': 1, 'd': 1, 'e': 7}
+    plan = balance(costs, 2, order)
+    assert plan == [['a'], ['b', 'c', 'd', 'e']]
+
+
+def test_balance_more_shards_than_cheap_tail():
+    order = ['a', 'b', 'c']
+    costs = {'a': 100, 'b': 1, 'c': 1}
+    plan = balance(costs, 3, order)
+    assert plan == [['a'], ['b'], ['c']]
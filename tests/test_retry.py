@@ -0,0 +1,55 @@
+import random
+
+from lidar_processor.dependencies.retry import transient_error, is_transient, backoff_delay
+
+
+def test_transient_status_in_message():
+    assert transient_error(RuntimeError('/vsigs/bucket/fix/540512_2017_tava_fixed.laz: HTTP error code: 503'))
+    assert transient_error(RuntimeError('HTTP response code: 429'))
+
+
+def test_map_sheet_digits_are_not_status_codes():
+    # 540403 / 544041 contain 403 / 404
+    assert transient_error(RuntimeError('/vsigs/bucket/fix/540403_2017_tava_fixed.laz: HTTP error code: 503'))
+    assert transient_error(RuntimeError('/vsigs/bucket/fix/544041_2017_tava_fixed.laz: curl error: connection reset'))
+
+
+def test_permanent_status_in_message():
+    assert not transient_error(RuntimeError('/vsigs/bucket/fix/540512_2017_tava_fixed.laz: HTTP error code: 404'))
+    assert not transient_error(RuntimeError('HTTP response code: 403'))
+
+
+def test_status_attribute():
+    class HttpError(Exception):
+        def __init__(self, code):
+            super().__init__(f'error {code}')
+            self.code = code
+    assert transient_error(HttpError(502))
+    assert not transient_error(HttpError(404))
+
+
+def test_permanent_messages():
+    assert not transient_error(RuntimeError('/vsigs/bucket/fix/540512_2017_tava_fixed.laz: No such file or directory'))
+    assert not transient_error(OSError('540403_2017_tava.laz does not exist'))
+
+
+def test_network_errors():
+    assert transient_error(ConnectionResetError('reset'))
+    assert transient_error(TimeoutError())
+    assert transient_error(RuntimeError('Read timed out'))
+    assert not transient_error(ValueError('bad value'))
+
+
+def test_is_transient():
+    assert is_transient((-2, None, True))
+    assert not is_transient((-2, None, False))
+    assert not is_transient((2, None, True))
+    assert not is_transient(None)
+
+
+def test_backoff_delay():
+    random.seed(0)
+    for attempt in range(8):
+        delay = backoff_delay(attempt, 30, 600)
+        expected = min(600, 30 * 2 ** attempt)
+        assert expected / 2 <= delay <= expected